@@ -0,0 +1,100 @@
+import torch
+import argparse
+import importlib
+
+from convs.dnl import DNL
+from utils import time_function
+
+# nonlocal is a python keyword, the module cannot be imported with a from statement
+NonLocal = importlib.import_module('convs.nonlocal').NonLocal
+
+parser = argparse.ArgumentParser(description='Benchmarking the full, chunked and approximate attention of NonLocal and DNL')
+parser.add_argument('--module', '-m', type=str, default='nonlocal', help='nonlocal or dnl')
+parser.add_argument('--size', '-s', type=int, nargs='+', default=[16, 32, 56, 64], help='H = W of the input')
+parser.add_argument('--batch', '-b', type=int, default=16)
+parser.add_argument('--channels', '-c', type=int, default=128)
+parser.add_argument('--chunk-size', type=int, nargs='+', default=[256, 1024])
+parser.add_argument('--approximation', '-a', type=str, nargs='*', default=['pooled', 'nystrom'])
+parser.add_argument('--rank', type=int, nargs='+', default=[16, 64, 256], help='landmarks of the approximations')
+parser.add_argument('--downsample', action='store_true', help='keys and values max-pooled to H/2 x W/2')
+parser.add_argument('--repeat', '-r', type=int, default=5)
+parser.add_argument('--cuda', action='store_true')
+args = parser.parse_args()
+
+device = torch.device('cuda' if (torch.cuda.is_available() and args.cuda) else 'cpu')
+
+def build(chunk_size=None, approximation=None, rank=64):
+    if args.module == 'dnl':
+        return DNL(args.channels, args.channels, downsample=args.downsample, chunk_size=chunk_size, approximation=approximation, rank=rank)
+    return NonLocal(args.channels, args.channels, downsample=args.downsample, chunk_size=chunk_size, approximation=approximation, rank=rank)
+
+def attention_output(block, x):
+    # the attention term of the block output, without the residual
+    with torch.no_grad():
+        return block(x) - x
+
+def step(block, x):
+    # forward and backward, the input gradient is compared between the variants
+    x.grad = None
+    block(x).sum().backward()
+
+def peak_memory(fn):
+    # peak CUDA memory of fn in MB, None on CPU
+    if device.type != 'cuda':
+        return None
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+    fn()
+    torch.cuda.synchronize()
+    return (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+
+reference_block = build().to(device)
+print('{:>6} {:>14} {:>12} {:>12} {:>14} {:>12} {:>12}'.format('size', 'variant', 'fwd+bwd(ms)', 'peak(MB)', 'map size(MB)', 'out diff', 'grad diff'))
+for size in args.size:
+    x = torch.randn(args.batch, args.channels, size, size, device=device, requires_grad=True)
+    map_size = args.batch * (size * size) * (size // 2 if args.downsample else size) ** 2 * 4 / 2 ** 20
+    try:
+        step(reference_block, x)
+        reference_output = reference_block(x).detach()
+        exact = attention_output(reference_block, x)
+        reference_grad = x.grad.clone()
+        t_full = time_function(lambda: step(reference_block, x), device, repeat=args.repeat, grad=True)
+        m_full = peak_memory(lambda: step(reference_block, x))
+        print('{:>6} {:>14} {:>12.2f} {:>12} {:>14.1f} {:>12} {:>12}'.format(size, 'full', t_full,
+            '-' if m_full is None else '{:.1f}'.format(m_full), map_size, '-', '-'))
+    except RuntimeError:
+        # the similarity map does not fit
+        reference_output = None
+        print('{:>6} {:>14} {:>12} {:>12} {:>14.1f} {:>12} {:>12}'.format(size, 'full', 'OOM', '-', map_size, '-', '-'))
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    for chunk_size in args.chunk_size:
+        block = build(chunk_size=chunk_size).to(device)
+        block.load_state_dict(reference_block.state_dict())
+        step(block, x)
+        if reference_output is None:
+            # the chunked attention is exact, it is the reference of the approximations
+            exact = attention_output(block, x)
+        t_chunk = time_function(lambda: step(block, x), device, repeat=args.repeat, grad=True)
+        m_chunk = peak_memory(lambda: step(block, x))
+        out_diff, grad_diff = '-', '-'
+        if reference_output is not None:
+            step(block, x)
+            out_diff = '{:.2e}'.format((block(x).detach() - reference_output).abs().max().item())
+            grad_diff = '{:.2e}'.format((x.grad - reference_grad).abs().max().item())
+        print('{:>6} {:>14} {:>12.2f} {:>12} {:>14} {:>12} {:>12}'.format(size, chunk_size, t_chunk,
+            '-' if m_chunk is None else '{:.1f}'.format(m_chunk), '-', out_diff, grad_diff))
+
+    # approximations: relative error of the attention term against the exact one
+    for approximation in args.approximation:
+        for rank in args.rank:
+            block = build(approximation=approximation, rank=rank).to(device)
+            block.load_state_dict(reference_block.state_dict())
+            step(block, x)
+            t_approx = time_function(lambda: step(block, x), device, repeat=args.repeat, grad=True)
+            m_approx = peak_memory(lambda: step(block, x))
+            error = (attention_output(block, x) - exact).norm().item() / exact.norm().item()
+            print('{:>6} {:>14} {:>12.2f} {:>12} {:>14} {:>12} {:>12}'.format(size, '{}-{}'.format(approximation, rank), t_approx,
+                '-' if m_approx is None else '{:.1f}'.format(m_approx), '-', 'rel {:.2e}'.format(error), '-'))
@@ -0,0 +1,74 @@
+import torch
+import argparse
+
+from convs.functional import dynamic_conv2d, select_backend
+from utils import time_function
+
+parser = argparse.ArgumentParser(description='Benchmarking the per-sample conv backends')
+parser.add_argument('--network', '-n', type=str, default='all', help='resnet18, alexnet, mobilenetv2 or all')
+parser.add_argument('--batch', '-b', type=int, nargs='+', default=[1, 8, 32, 128])
+parser.add_argument('--num-experts', '-k', type=int, default=3)
+parser.add_argument('--repeat', '-r', type=int, default=10)
+parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 keeps the default')
+parser.add_argument('--cuda', action='store_true')
+args = parser.parse_args()
+
+device = torch.device('cuda' if (torch.cuda.is_available() and args.cuda) else 'cpu')
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+
+# (layer, C_in, C_out, kernel_size, stride, padding, groups, input H/W) of the CIFAR models
+LAYERS = {
+    'resnet18': [
+        ('layer1', 64, 64, 3, 1, 1, 1, 32),
+        ('layer2.0', 64, 128, 3, 2, 1, 1, 32),
+        ('layer2', 128, 128, 3, 1, 1, 1, 16),
+        ('layer3.0', 128, 256, 3, 2, 1, 1, 16),
+        ('layer3', 256, 256, 3, 1, 1, 1, 8),
+        ('layer4.0', 256, 512, 3, 2, 1, 1, 8),
+        ('layer4', 512, 512, 3, 1, 1, 1, 4),
+    ],
+    'alexnet': [
+        ('features.0', 3, 64, 3, 2, 1, 1, 32),
+        ('features.4', 64, 192, 3, 1, 1, 1, 8),
+        ('features.8', 192, 384, 3, 1, 1, 1, 4),
+        ('features.11', 384, 256, 3, 1, 1, 1, 4),
+        ('features.14', 256, 256, 3, 1, 1, 1, 4),
+    ],
+    'mobilenetv2': [
+        ('layers.1', 96, 96, 3, 1, 1, 96, 32),
+        ('layers.3', 144, 144, 3, 2, 1, 144, 32),
+        ('layers.4', 192, 192, 3, 1, 1, 192, 16),
+        ('layers.7', 384, 384, 3, 1, 1, 384, 8),
+        ('layers.13', 576, 576, 3, 2, 1, 576, 8),
+        ('layers.14', 960, 960, 3, 1, 1, 960, 4),
+    ],
+}
+
+networks = list(LAYERS.keys()) if args.network == 'all' else [args.network]
+
+BACKENDS = ['grouped', 'bmm', 'mix']
+
+print(('{:<12} {:<12} {:>6}' + ' {:>12}' * len(BACKENDS) + ' {:>8} {:>8} {:>10}').format(
+    'network', 'layer', 'batch', *['{}(ms)'.format(backend) for backend in BACKENDS], 'winner', 'auto', 'max diff'))
+for network in networks:
+    for name, c_in, c_out, kernel_size, stride, padding, groups, size in LAYERS[network]:
+        for b in args.batch:
+            x = torch.randn(b, c_in, size, size, device=device)
+            routing_weight = torch.softmax(torch.randn(b, args.num_experts, device=device), dim=1)
+            weight = torch.randn(args.num_experts, c_out, c_in // groups, kernel_size, kernel_size, device=device)
+
+            times = {}
+            outputs = {}
+            for backend in BACKENDS:
+                # the expert aggregation is part of the timing, the mix backend never builds per-sample kernels
+                fn = lambda: dynamic_conv2d(x, routing_weight, weight, None, stride, padding, groups, backend)
+                times[backend] = time_function(fn, device, repeat=args.repeat)
+                with torch.no_grad():
+                    outputs[backend] = fn()
+
+            diff = max((outputs[backend] - outputs['grouped']).abs().max().item() for backend in BACKENDS)
+            winner = min(times, key=times.get)
+            auto = select_backend(x, weight, stride, padding, groups, num_experts=args.num_experts)
+            print(('{:<12} {:<12} {:>6}' + ' {:>12.3f}' * len(BACKENDS) + ' {:>8} {:>8} {:>10.2e}').format(
+                network, name, b, *[times[backend] for backend in BACKENDS], winner, auto, diff))
@@ -0,0 +1,66 @@
+import torch
+import torch.nn as nn
+import argparse
+
+from config import INPUT_SIZES
+from utils import get_network, time_function
+
+parser = argparse.ArgumentParser(description='Training memory and speed of the ResNet18 and MobileNetV2 families with activation checkpointing')
+parser.add_argument('--network', '-n', type=str, nargs='+', default=['resnet18', 'cc3resnet18', 'dy3resnet18', 'dyresA3resnet18', 'dds3resnet18',
+                        'mobilenetv2', 'dy3mobilenetv2', 'dyresA3mobilenetv2'])
+parser.add_argument('--dataset', type=str, default='cifar100', help='cifar100 or tiny')
+parser.add_argument('--segments', '-s', type=int, nargs='+', default=[0, 2, 4], help='0 runs without checkpointing')
+parser.add_argument('--batch', '-b', type=int, default=64)
+parser.add_argument('--repeat', '-r', type=int, default=5)
+parser.add_argument('--cuda', action='store_true')
+args = parser.parse_args()
+
+device = torch.device('cuda' if (torch.cuda.is_available() and args.cuda) else 'cpu')
+size = INPUT_SIZES[args.dataset]
+criterion = nn.CrossEntropyLoss()
+
+def step(net, x, labels):
+    net.zero_grad()
+    criterion(net(x), labels).backward()
+
+def saved_memory(net, x, labels):
+    # MB of the tensors autograd saves for backward, outside the checkpointed segments (their inputs are kept
+    # by the checkpoint itself and not counted)
+    storages = {}
+    def pack(t):
+        # untyped_storage from torch 2.0, the typed storage before
+        storage = t.untyped_storage() if hasattr(t, 'untyped_storage') else t.storage()
+        storages[storage.data_ptr()] = storage.size() * storage.element_size()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        loss = criterion(net(x), labels)
+    del loss
+    return sum(storages.values()) / 2 ** 20
+
+def peak_memory(net, x, labels):
+    # peak CUDA memory of a training step in MB, None on CPU
+    if device.type != 'cuda':
+        return None
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+    step(net, x, labels)
+    torch.cuda.synchronize()
+    return (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+
+print('{:<20} {:>8} {:>12} {:>12} {:>14} {:>10}'.format('network', 'segments', 'saved(MB)', 'peak(MB)', 'step(ms)', 'slowdown'))
+for network in args.network:
+    x = torch.randn(args.batch, 3, size, size, device=device)
+    labels = torch.randint(0, 100, (args.batch,), device=device)
+    reference = None
+    for segments in args.segments:
+        net = get_network(network, args.dataset, device, checkpoint_segments=segments)
+        net.train()
+        t = time_function(lambda: step(net, x, labels), device, repeat=args.repeat, grad=True)
+        reference = reference or t
+        peak = peak_memory(net, x, labels)
+        print('{:<20} {:>8} {:>12.1f} {:>12} {:>14.2f} {:>10.2f}'.format(network, segments, saved_memory(net, x, labels),
+            '-' if peak is None else '{:.1f}'.format(peak), t, t / reference))
+        del net
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
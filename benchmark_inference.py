@@ -0,0 +1,115 @@
+import torch
+import torch.nn.functional as F
+import argparse
+
+from convs.condconv import CondConv
+from convs.cc_inf import CondConv_Inf
+from convs.functional import aggregate_channel_experts, pyramid_avg_pool2d
+from utils import time_function
+
+parser = argparse.ArgumentParser(description='Benchmarking the inference modules against the training ones')
+parser.add_argument('--batch', '-b', type=int, nargs='+', default=[1, 8, 32, 128])
+parser.add_argument('--num-experts', '-k', type=int, default=3)
+parser.add_argument('--repeat', '-r', type=int, default=10)
+parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 keeps the default')
+parser.add_argument('--module', '-m', type=str, default='all', help='condconv, channel (DyResConv_Inf/DDSConv_Exp aggregation), pooling (DyRes/DDS routers) or all')
+parser.add_argument('--cuda', action='store_true')
+args = parser.parse_args()
+
+device = torch.device('cuda' if (torch.cuda.is_available() and args.cuda) else 'cpu')
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+
+# (layer, C_in, C_out, kernel_size, stride, padding, groups, input H/W) of CC_ResNet18 and CC_MobileNetV2 on CIFAR
+LAYERS = [
+    ('resnet18.layer1', 64, 64, 3, 1, 1, 1, 32),
+    ('resnet18.layer2', 128, 128, 3, 1, 1, 1, 16),
+    ('resnet18.layer3', 256, 256, 3, 1, 1, 1, 8),
+    ('resnet18.layer4', 512, 512, 3, 1, 1, 1, 4),
+    ('mobilenetv2.layers.4', 192, 192, 3, 1, 1, 192, 16),
+    ('mobilenetv2.layers.14', 960, 960, 3, 1, 1, 960, 4),
+]
+
+def legacy_aggregate(routing_weight, weight):
+    # what DyResConv_Inf and DDSConv_Exp used to do: an N x k x C_out x C_in x kH x kW product
+    # summed over the batch as well as the experts, kept only as a baseline
+    b = routing_weight.size(0)
+    k, c_out, c_in, kh, kw = weight.size()
+    routing_weight = routing_weight.view(-1, k, c_out).unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)
+    combined_weight = (weight.unsqueeze(0) * routing_weight).view(b * k, c_out, c_in, kh, kw)
+    return torch.sum(combined_weight, dim=0)
+
+def peak_memory(fn):
+    # peak CUDA memory of fn in MB, None on CPU
+    if device.type != 'cuda':
+        return None
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+    with torch.no_grad():
+        fn()
+    torch.cuda.synchronize()
+    return (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+
+def megabytes(numel):
+    return numel * 4 / 2 ** 20
+
+if args.module in ['condconv', 'all']:
+    print('CondConv (eval) vs CondConv_Inf')
+    print('{:<24} {:>6} {:>14} {:>14} {:>14} {:>8} {:>10}'.format(
+        'layer', 'batch', 'grouped(ms)', 'auto(ms)', 'inf(ms)', 'speedup', 'max diff'))
+    for name, c_in, c_out, kernel_size, stride, padding, groups, size in LAYERS:
+        conv = CondConv(c_in, c_out, kernel_size, stride=stride, padding=padding, groups=groups,
+                        num_experts=args.num_experts, backend='grouped').to(device).eval()
+        conv_inf = CondConv_Inf.from_condconv(conv)
+        for b in args.batch:
+            x = torch.randn(b, c_in, size, size, device=device)
+            # 'grouped' is what the training module did before it had backends
+            conv.backend = 'grouped'
+            t_grouped = time_function(lambda: conv(x), device, repeat=args.repeat)
+            with torch.no_grad():
+                reference = conv(x)
+            conv.backend = 'auto'
+            t_auto = time_function(lambda: conv(x), device, repeat=args.repeat)
+            t_inf = time_function(lambda: conv_inf(x), device, repeat=args.repeat)
+            with torch.no_grad():
+                diff = (conv_inf(x) - reference).abs().max().item()
+            print('{:<24} {:>6} {:>14.3f} {:>14.3f} {:>14.3f} {:>7.2f}x {:>10.2e}'.format(
+                name, b, t_grouped, t_auto, t_inf, t_grouped / t_inf, diff))
+
+if args.module in ['channel', 'all']:
+    # only the aggregation of the legacy code is comparable, its conv cannot run for N > 1;
+    # memory is measured on CUDA, the size of the largest intermediate is given on both devices
+    print('Per-channel expert aggregation (DyResConv_Inf / DDSConv_Exp): legacy broadcast vs batched matmul')
+    print('{:<24} {:>6} {:>14} {:>14} {:>14} {:>14} {:>14} {:>14}'.format(
+        'layer', 'batch', 'legacy(ms)', 'bmm(ms)', 'legacy(MB)', 'bmm(MB)', 'legacy peak', 'bmm peak'))
+    for name, c_in, c_out, kernel_size, stride, padding, groups, size in LAYERS:
+        if groups != 1:
+            continue
+        k = args.num_experts
+        weight = torch.randn(k, c_out, c_in, kernel_size, kernel_size, device=device)
+        for b in args.batch:
+            routing_weight = torch.sigmoid(torch.randn(b, k * c_in, 1, 1, device=device))
+            legacy = lambda: legacy_aggregate(routing_weight, weight)
+            bmm = lambda: aggregate_channel_experts(routing_weight, weight, routed='in')
+            t_legacy = time_function(legacy, device, repeat=args.repeat)
+            t_bmm = time_function(bmm, device, repeat=args.repeat)
+            m_legacy, m_bmm = peak_memory(legacy), peak_memory(bmm)
+            print('{:<24} {:>6} {:>14.3f} {:>14.3f} {:>14.1f} {:>14.1f} {:>14} {:>14}'.format(
+                name, b, t_legacy, t_bmm, megabytes(b * weight.numel()), megabytes((b + 1) * weight.numel()),
+                '-' if m_legacy is None else '{:.1f}'.format(m_legacy), '-' if m_bmm is None else '{:.1f}'.format(m_bmm)))
+
+if args.module in ['pooling', 'all']:
+    # the 1x1, 3x3 and 5x5 pooling of the DyRes/DDS routers, one adaptive_avg_pool2d per size vs a single pass
+    print('Router pooling [1, 3, 5]: adaptive_avg_pool2d per size vs pyramid_avg_pool2d')
+    print('{:<24} {:>6} {:>14} {:>14} {:>8} {:>10}'.format('layer', 'batch', 'separate(ms)', 'pyramid(ms)', 'speedup', 'max diff'))
+    for name, c_in, c_out, kernel_size, stride, padding, groups, size in LAYERS:
+        for b in args.batch:
+            x = torch.randn(b, c_in, size, size, device=device)
+            separate = lambda: [F.adaptive_avg_pool2d(x, output_size) for output_size in [1, 3, 5]]
+            pyramid = lambda: pyramid_avg_pool2d(x, [1, 3, 5])
+            t_separate = time_function(separate, device, repeat=args.repeat)
+            t_pyramid = time_function(pyramid, device, repeat=args.repeat)
+            diff = max((p1 - p2).abs().max().item() for p1, p2 in zip(separate(), pyramid()))
+            print('{:<24} {:>6} {:>14.3f} {:>14.3f} {:>7.2f}x {:>10.2e}'.format(
+                name, b, t_separate, t_pyramid, t_separate / t_pyramid, diff))
@@ -0,0 +1,50 @@
+import torch
+import argparse
+
+from convs.condconv import CondConv
+from utils import time_function, count_parameters
+
+parser = argparse.ArgumentParser(description='Benchmarking low-rank expert banks against dense ones')
+parser.add_argument('--batch', '-b', type=int, default=32)
+parser.add_argument('--num-experts', '-k', type=int, nargs='+', default=[3, 8])
+parser.add_argument('--rank', type=int, nargs='+', default=[8, 32])
+parser.add_argument('--repeat', '-r', type=int, default=10)
+parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 keeps the default')
+parser.add_argument('--cuda', action='store_true')
+args = parser.parse_args()
+
+device = torch.device('cuda' if (torch.cuda.is_available() and args.cuda) else 'cpu')
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+
+# (layer, C_in, C_out, kernel_size, stride, padding, input H/W) of CC_ResNet18 on ImageNet
+LAYERS = [
+    ('layer1', 64, 64, 3, 1, 1, 56),
+    ('layer2', 128, 128, 3, 1, 1, 28),
+    ('layer3', 256, 256, 3, 1, 1, 14),
+    ('layer4', 512, 512, 3, 1, 1, 7),
+]
+
+def train_step(conv, x):
+    conv.zero_grad()
+    conv(x).sum().backward()
+
+def megabytes(numel):
+    return numel * 4 / 2 ** 20
+
+# parameters are given in MB, the SGD momentum buffer doubles them
+print('{:<8} {:>4} {:>6} {:>12} {:>12} {:>14} {:>14} {:>12} {:>12}'.format(
+    'layer', 'k', 'rank', 'params(MB)', 'dense(MB)', 'train(ms)', 'dense train', 'infer(ms)', 'dense infer'))
+for name, c_in, c_out, kernel_size, stride, padding, size in LAYERS:
+    x = torch.randn(args.batch, c_in, size, size, device=device)
+    for k in args.num_experts:
+        dense = CondConv(c_in, c_out, kernel_size, stride=stride, padding=padding, num_experts=k).to(device)
+        t_dense_train = time_function(lambda: train_step(dense, x), device, repeat=args.repeat, grad=True)
+        t_dense = time_function(lambda: dense(x), device, repeat=args.repeat)
+        for rank in args.rank:
+            conv = CondConv(c_in, c_out, kernel_size, stride=stride, padding=padding, num_experts=k, rank=rank).to(device)
+            t_train = time_function(lambda: train_step(conv, x), device, repeat=args.repeat, grad=True)
+            t_infer = time_function(lambda: conv(x), device, repeat=args.repeat)
+            print('{:<8} {:>4} {:>6} {:>12.2f} {:>12.2f} {:>14.3f} {:>14.3f} {:>12.3f} {:>12.3f}'.format(
+                name, k, rank, megabytes(count_parameters(conv)), megabytes(count_parameters(dense)),
+                t_train, t_dense_train, t_infer, t_dense))
@@ -0,0 +1,44 @@
+import torch
+import torch.nn as nn
+import argparse
+
+from config import INPUT_SIZES
+from utils import get_network, count_parameters, time_function
+
+parser = argparse.ArgumentParser(description='Throughput of the dynamic ResNets with per-conv and per-block shared routing')
+parser.add_argument('--network', '-n', type=str, nargs='+', default=['cc3resnet18', 'dy3resnet18', 'dyresA3resnet18', 'dds3resnet18'])
+parser.add_argument('--dataset', type=str, default='cifar100', help='cifar100 or tiny')
+parser.add_argument('--batch', '-b', type=int, nargs='+', default=[1, 32, 128])
+parser.add_argument('--repeat', '-r', type=int, default=10)
+parser.add_argument('--train', action='store_true', help='time a training step instead of an eval forward')
+parser.add_argument('--cuda', action='store_true')
+args = parser.parse_args()
+
+device = torch.device('cuda' if (torch.cuda.is_available() and args.cuda) else 'cpu')
+size = INPUT_SIZES[args.dataset]
+criterion = nn.CrossEntropyLoss()
+
+def routing_parameters(net):
+    return sum(p.numel() for name, p in net.named_parameters() if 'routing_func' in name)
+
+def step(net, x, labels):
+    if args.train:
+        net.zero_grad()
+        criterion(net(x), labels).backward()
+    else:
+        net(x)
+
+print('{:<18} {:<8} {:>12} {:>12} {:>6} {:>12} {:>10}'.format('network', 'routing', 'params', 'router params', 'batch', 'images/s', 'speedup'))
+for network in args.network:
+    nets = {'conv': get_network(network, args.dataset, device),
+            'block': get_network(network, args.dataset, device, shared_routing=True)}
+    for net in nets.values():
+        net.train(args.train)
+    for b in args.batch:
+        x = torch.randn(b, 3, size, size, device=device)
+        labels = torch.randint(0, 10, (b,), device=device)
+        times = {}
+        for routing, net in nets.items():
+            times[routing] = time_function(lambda: step(net, x, labels), device, repeat=args.repeat, grad=args.train)
+            print('{:<18} {:<8} {:>12} {:>12} {:>6} {:>12.1f} {:>10.2f}'.format(network, routing, count_parameters(net),
+                routing_parameters(net), b, b / times[routing] * 1000, times['conv'] / times[routing]))
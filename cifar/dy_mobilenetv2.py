@@ -6,6 +6,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from convs.dyconv import *
+from convs.checkpoint import checkpoint_blocks
 
 __all__ = ['Dy_MobileNetV2']
 
@@ -48,12 +49,14 @@ class Dy_MobileNetV2(nn.Module):
            (6, 160, 3, 2),
            (6, 320, 1, 1)]
 
-    def __init__(self, num_classes=100, num_experts=3):
+    def __init__(self, num_classes=100, num_experts=3, checkpoint_segments=0):
         super(Dy_MobileNetV2, self).__init__()
         # NOTE: change conv1 stride 2 -> 1 for CIFAR10
         self.conv1 = nn.Conv2d(3, 32, kernel_size=3, stride=1, padding=1, bias=False)
         self.bn1 = nn.BatchNorm2d(32)
         self.layers = self._make_layers(in_planes=32, num_experts=num_experts)
+        # > 0: the inverted residual blocks run in that many checkpointed segments during training
+        self.checkpoint_segments = checkpoint_segments
         self.conv2 = nn.Conv2d(320, 1280, kernel_size=1, stride=1, padding=0, bias=False)
         self.bn2 = nn.BatchNorm2d(1280)
         self.linear = nn.Linear(1280, num_classes)
@@ -67,9 +70,17 @@ class Dy_MobileNetV2(nn.Module):
                 in_planes = out_planes
         return nn.Sequential(*layers)
 
+    @torch.jit.unused
+    def checkpointed_layers(self, x: torch.Tensor) -> torch.Tensor:
+        # eager only, the block internals are recomputed during backward
+        return checkpoint_blocks([self.layers], x, self.checkpoint_segments)
+
     def forward(self, x):
         out = F.relu(self.bn1(self.conv1(x)))
-        out = self.layers(out)
+        if self.checkpoint_segments > 0 and self.training and not torch.jit.is_scripting():
+            out = self.checkpointed_layers(out)
+        else:
+            out = self.layers(out)
         out = F.relu(self.bn2(self.conv2(out)))
         # NOTE: change pooling kernel_size 7 -> 4 for CIFAR10
         out = F.avg_pool2d(out, 4)
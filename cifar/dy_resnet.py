@@ -3,18 +3,22 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from convs.dyconv import *
+from convs.shared_routing import build_shared_routing
+from convs.checkpoint import checkpoint_blocks
 
 __all__ = ['Dy_ResNet18']
 
 class BasicBlock(nn.Module):
     expansion = 1
 
-    def __init__(self, in_channels, channels, stride=1, num_experts=3):
+    def __init__(self, in_channels, channels, stride=1, num_experts=3, shared_routing=False):
         super().__init__()
-        self.conv1 = DyConv(in_channels, channels, kernel_size=3, stride=stride, padding=1, num_experts=num_experts)
+        self.conv1 = DyConv(in_channels, channels, kernel_size=3, stride=stride, padding=1, num_experts=num_experts, routing=not shared_routing)
         self.bn1 = nn.BatchNorm2d(channels)
-        self.conv2 = DyConv(channels, channels, kernel_size=3, stride=1, padding=1, num_experts=num_experts)
+        self.conv2 = DyConv(channels, channels, kernel_size=3, stride=1, padding=1, num_experts=num_experts, routing=not shared_routing)
         self.bn2 = nn.BatchNorm2d(channels)
+        # one routing function for both convs, from the block input
+        self.routing_func = build_shared_routing(self.conv1, self.conv2) if shared_routing else None
 
         self.shortcut = nn.Sequential()
 
@@ -25,45 +29,60 @@ class BasicBlock(nn.Module):
             )
 
     def forward(self, x):
-        out = F.relu(self.bn1(self.conv1(x)))
-        out = self.bn2(self.conv2(out))
+        if self.routing_func is not None:
+            route1, route2 = self.routing_func(x)
+            out = F.relu(self.bn1(self.conv1(x, route1)))
+            out = self.bn2(self.conv2(out, route2))
+        else:
+            out = F.relu(self.bn1(self.conv1(x)))
+            out = self.bn2(self.conv2(out))
         # Addition
         out += self.shortcut(x)
         out = F.relu(out)
         return out
 
 class Dy_ResNet(nn.Module):
-    def __init__(self, block, num_blocks, num_classes=100, num_experts=3):
+    def __init__(self, block, num_blocks, num_classes=100, num_experts=3, shared_routing=False, checkpoint_segments=0):
         super().__init__()
         self.in_channels = 64
+        # > 0: the residual blocks run in that many checkpointed segments during training
+        self.checkpoint_segments = checkpoint_segments
 
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3, padding=1)
         self.bn1 = nn.BatchNorm2d(64)
         
-        self.layer1 = self._make_layer(block, 64, num_blocks[0], stride=1, num_experts=num_experts)
-        self.layer2 = self._make_layer(block, 128, num_blocks[1], stride=2, num_experts=num_experts)
-        self.layer3 = self._make_layer(block, 256, num_blocks[2], stride=2, num_experts=num_experts)
-        self.layer4 = self._make_layer(block, 512, num_blocks[3], stride=2, num_experts=num_experts)
+        self.layer1 = self._make_layer(block, 64, num_blocks[0], stride=1, num_experts=num_experts, shared_routing=shared_routing)
+        self.layer2 = self._make_layer(block, 128, num_blocks[1], stride=2, num_experts=num_experts, shared_routing=shared_routing)
+        self.layer3 = self._make_layer(block, 256, num_blocks[2], stride=2, num_experts=num_experts, shared_routing=shared_routing)
+        self.layer4 = self._make_layer(block, 512, num_blocks[3], stride=2, num_experts=num_experts, shared_routing=shared_routing)
         self.linear = nn.Linear(512*block.expansion, num_classes)
 
-    def _make_layer(self, block, channels, num_blocks, stride, num_experts):
+    def _make_layer(self, block, channels, num_blocks, stride, num_experts, shared_routing):
         strides = [stride] + [1] * (num_blocks - 1)
         layers = []
         for stride in strides:
-            layers.append(block(self.in_channels, channels, stride, num_experts))
+            layers.append(block(self.in_channels, channels, stride, num_experts, shared_routing))
             self.in_channels = channels * block.expansion
         return nn.Sequential(*layers)
 
+    @torch.jit.unused
+    def checkpointed_layers(self, x: torch.Tensor) -> torch.Tensor:
+        # eager only, the block internals are recomputed during backward
+        return checkpoint_blocks([self.layer1, self.layer2, self.layer3, self.layer4], x, self.checkpoint_segments)
+
     def forward(self, x):
         out = F.relu(self.bn1(self.conv1(x)))
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = self.layer3(out)
-        out = self.layer4(out)
+        if self.checkpoint_segments > 0 and self.training and not torch.jit.is_scripting():
+            out = self.checkpointed_layers(out)
+        else:
+            out = self.layer1(out)
+            out = self.layer2(out)
+            out = self.layer3(out)
+            out = self.layer4(out)
         out = F.avg_pool2d(out, 4)
         out = out.view(out.size(0), -1)
         out = self.linear(out)
         return out
 
-def Dy_ResNet18(num_experts=3):
-    return Dy_ResNet(BasicBlock, [2, 2, 2, 2], num_experts=num_experts)
\ No newline at end of file
+def Dy_ResNet18(num_experts=3, shared_routing=False, checkpoint_segments=0):
+    return Dy_ResNet(BasicBlock, [2, 2, 2, 2], num_experts=num_experts, shared_routing=shared_routing, checkpoint_segments=checkpoint_segments)
\ No newline at end of file
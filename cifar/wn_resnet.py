@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from convs.weightnet import *
+from convs.checkpoint import checkpoint_blocks
 
 __all__ = ['WN_ResNet18']
 
@@ -33,9 +34,11 @@ class BasicBlock(nn.Module):
         return out
 
 class WN_ResNet(nn.Module):
-    def __init__(self, block, num_blocks, num_classes=100):
+    def __init__(self, block, num_blocks, num_classes=100, checkpoint_segments=0):
         super(WN_ResNet, self).__init__()
         self.in_channels = 64
+        # > 0: the residual blocks run in that many checkpointed segments during training
+        self.checkpoint_segments = checkpoint_segments
 
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3, padding=1)
         self.bn1 = nn.BatchNorm2d(64)
@@ -54,16 +57,24 @@ class WN_ResNet(nn.Module):
             self.in_channels = channels * block.expansion
         return nn.Sequential(*layers)
 
+    @torch.jit.unused
+    def checkpointed_layers(self, x: torch.Tensor) -> torch.Tensor:
+        # eager only, the block internals are recomputed during backward
+        return checkpoint_blocks([self.layer1, self.layer2, self.layer3, self.layer4], x, self.checkpoint_segments)
+
     def forward(self, x):
         out = F.relu(self.bn1(self.conv1(x)))
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = self.layer3(out)
-        out = self.layer4(out)
+        if self.checkpoint_segments > 0 and self.training and not torch.jit.is_scripting():
+            out = self.checkpointed_layers(out)
+        else:
+            out = self.layer1(out)
+            out = self.layer2(out)
+            out = self.layer3(out)
+            out = self.layer4(out)
         out = F.avg_pool2d(out, 4)
         out = out.view(out.size(0), -1)
         out = self.linear(out)
         return out
 
-def WN_ResNet18():
-    return WN_ResNet(BasicBlock, [2, 2, 2, 2])
\ No newline at end of file
+def WN_ResNet18(checkpoint_segments=0):
+    return WN_ResNet(BasicBlock, [2, 2, 2, 2], checkpoint_segments=checkpoint_segments)
\ No newline at end of file
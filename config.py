@@ -15,4 +15,7 @@ TINY_IMAGENET_STD = (0.2302, 0.2265, 0.2262)
 
 IMAGENET_DATA_DIR = '/home/xuma/DATA/ImageNet2012'
 IMAGENET_MEAN = (0.485, 0.456, 0.406)
-IMAGENET_STD = (0.229, 0.224, 0.225)
\ No newline at end of file
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+# spatial size of the network inputs of every dataset, for exports and benchmarks
+INPUT_SIZES = {'cifar100': 32, 'tiny': 64, 'imagenet': 224}
@@ -0,0 +1,201 @@
+import torch
+import torch.nn.functional as F
+import math
+from torch.autograd.function import once_differentiable
+
+__all__ = ['attention', 'chunked_attention', 'landmark_grid', 'pooled_attention', 'nystrom_attention', 'APPROXIMATIONS']
+
+'''
+    Exact softmax attention softmax(Q K^T) V that never holds the N x L_q x L_k similarity map: the queries
+    and the keys are tiled in chunks, the softmax is accumulated online over the key chunks (running max and
+    running sum, as flash attention), and the backward recomputes the chunk scores from the saved
+    log-sum-exp. Peak memory is N x chunk_size x chunk_size for the scores instead of N x L_q x L_k.
+    The scores and the softmax statistics are kept in fp32 (or fp64 for double inputs)
+'''
+
+def _accumulation_dtype(x):
+    return torch.promote_types(x.dtype, torch.float)
+
+def _attention_forward(query, key, value, chunk_size):
+    n, lq, lk = query.size(0), query.size(1), key.size(1)
+    dtype = _accumulation_dtype(query)
+    output = query.new_empty(n, lq, value.size(2), dtype=dtype)
+    logsumexp = query.new_empty(n, lq, 1, dtype=dtype)
+    for i in range(0, lq, chunk_size):
+        q = query[:, i : i + chunk_size]
+        running_max = q.new_full((n, q.size(1), 1), float('-inf'), dtype=dtype)
+        running_sum = q.new_zeros(n, q.size(1), 1, dtype=dtype)
+        acc = q.new_zeros(n, q.size(1), value.size(2), dtype=dtype)
+        for j in range(0, lk, chunk_size):
+            scores = torch.bmm(q, key[:, j : j + chunk_size].transpose(1, 2)).to(dtype) # N x Bq x Bk
+            new_max = torch.maximum(running_max, scores.max(2, keepdim=True)[0])
+            # rescale what was accumulated under the previous max
+            correction = torch.exp(running_max - new_max)
+            probs = torch.exp(scores - new_max)
+            running_sum = running_sum * correction + probs.sum(2, keepdim=True)
+            acc = acc * correction + torch.bmm(probs.to(value.dtype), value[:, j : j + chunk_size]).to(dtype)
+            running_max = new_max
+        output[:, i : i + chunk_size] = acc / running_sum
+        logsumexp[:, i : i + chunk_size] = running_max + torch.log(running_sum)
+    return output, logsumexp
+
+def _attention_backward(query, key, value, output, logsumexp, grad_output, chunk_size):
+    lq, lk = query.size(1), key.size(1)
+    dtype = _accumulation_dtype(query)
+    grad_output = grad_output.to(dtype)
+    # rowsum(dP * P) = rowsum(dO * O)
+    delta = (grad_output * output).sum(2, keepdim=True) # N x L_q x 1
+    grad_query = torch.zeros_like(query, dtype=dtype)
+    grad_key = torch.zeros_like(key, dtype=dtype)
+    grad_value = torch.zeros_like(value, dtype=dtype)
+    for i in range(0, lq, chunk_size):
+        q = query[:, i : i + chunk_size].to(dtype)
+        grad_o = grad_output[:, i : i + chunk_size]
+        for j in range(0, lk, chunk_size):
+            k = key[:, j : j + chunk_size].to(dtype)
+            v = value[:, j : j + chunk_size].to(dtype)
+            probs = torch.exp(torch.bmm(q, k.transpose(1, 2)) - logsumexp[:, i : i + chunk_size]) # N x Bq x Bk
+            grad_value[:, j : j + chunk_size] += torch.bmm(probs.transpose(1, 2), grad_o)
+            grad_scores = probs * (torch.bmm(grad_o, v.transpose(1, 2)) - delta[:, i : i + chunk_size])
+            grad_query[:, i : i + chunk_size] += torch.bmm(grad_scores, k)
+            grad_key[:, j : j + chunk_size] += torch.bmm(grad_scores.transpose(1, 2), q)
+    return grad_query.to(query.dtype), grad_key.to(key.dtype), grad_value.to(value.dtype)
+
+class _ChunkedAttention(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, query, key, value, chunk_size):
+        output, logsumexp = _attention_forward(query, key, value, chunk_size)
+        ctx.save_for_backward(query, key, value, output, logsumexp)
+        ctx.chunk_size = chunk_size
+        return output.to(value.dtype)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        query, key, value, output, logsumexp = ctx.saved_tensors
+        grad_query, grad_key, grad_value = _attention_backward(query, key, value, output, logsumexp, grad_output, ctx.chunk_size)
+        return grad_query, grad_key, grad_value, None
+
+def chunked_attention(query, key, value, chunk_size=1024):
+    '''
+        softmax(query key^T, dim=2) value, computed by chunks of chunk_size queries and keys
+        query: N x L_q x C (already scaled), key: N x L_k x C, value: N x L_k x C_v
+        returns N x L_q x C_v
+    '''
+    return _ChunkedAttention.apply(query, key, value, chunk_size)
+
+'''
+    Approximate attention, linear in H*W for a fixed rank r:
+    'pooled' : the keys and values are average-pooled to r landmarks, softmax(Q K~^T) V~
+    'nystrom': Nystrom approximation of softmax(Q K^T) from r landmark queries and keys (segment means),
+               softmax(Q K~^T) pinv(softmax(Q~ K~^T)) softmax(Q~ K^T) V, the queries and the keys share one
+               landmark grid so that the kernel inverted is square
+'''
+APPROXIMATIONS = ('pooled', 'nystrom')
+
+def landmark_grid(h, w, rank):
+    # (gh, gw) grid of about rank landmarks on an h x w map, with its aspect ratio
+    gh = min(h, max(1, int(round(math.sqrt(rank * h / w)))))
+    gw = min(w, max(1, rank // gh))
+    return gh, gw
+
+def _shared_landmark_grid(query_size, key_size, rank):
+    # one grid for the query and the key maps, from the smaller map and clamped to both
+    h, w = min(query_size, key_size, key=lambda size: size[0] * size[1])
+    gh, gw = landmark_grid(h, w, rank)
+    return min(gh, query_size[0], key_size[0]), min(gw, query_size[1], key_size[1])
+
+def _landmarks(x, size, grid):
+    # x: N x L x C over an h x w map, returns the N x gh*gw x C means of the cells of the grid
+    n, _, c = x.size()
+    h, w = size
+    x = x.transpose(1, 2).reshape(n, c, h, w)
+    x = F.adaptive_avg_pool2d(x, grid)
+    return x.flatten(2).transpose(1, 2)
+
+def pooled_attention(query, key, value, key_size, rank=64):
+    '''
+        softmax(query landmarks(key)^T) landmarks(value)
+        query: N x L_q x C (already scaled), key: N x L_k x C and value: N x L_k x C_v over a key_size (h, w) map
+    '''
+    grid = landmark_grid(key_size[0], key_size[1], rank)
+    key = _landmarks(key, key_size, grid)
+    value = _landmarks(value, key_size, grid)
+    return torch.bmm(torch.softmax(torch.bmm(query, key.transpose(1, 2)), dim=2), value)
+
+def _iterative_pinv(x, iterations=6):
+    # Moore-Penrose pseudo-inverse of the N x r x r softmax kernels by Newton-Schulz iterations
+    identity = torch.eye(x.size(-1), device=x.device, dtype=x.dtype)
+    inverse = x.transpose(1, 2) / (x.abs().sum(1).max() * x.abs().sum(2).max())
+    with torch.autocast(device_type=x.device.type, enabled=False):
+        for _ in range(iterations):
+            product = torch.bmm(x, inverse)
+            inverse = 0.25 * torch.bmm(inverse, 13 * identity - torch.bmm(product, 15 * identity - torch.bmm(product, 7 * identity - product)))
+    return inverse
+
+def nystrom_attention(query, key, value, query_size, key_size, rank=64):
+    '''
+        Nystrom approximation of softmax(query key^T) value with about rank landmarks
+        query: N x L_q x C (already scaled) over a query_size (h, w) map, key: N x L_k x C and
+        value: N x L_k x C_v over a key_size map, the maps can differ (downsampled keys)
+    '''
+    grid = _shared_landmark_grid(query_size, key_size, rank)
+    query_landmarks = _landmarks(query, query_size, grid)
+    key_landmarks = _landmarks(key, key_size, grid)
+    kernel1 = torch.softmax(torch.bmm(query, key_landmarks.transpose(1, 2)), dim=2) # N x L_q x r
+    kernel2 = torch.softmax(torch.bmm(query_landmarks, key_landmarks.transpose(1, 2)), dim=2) # N x r x r
+    kernel3 = torch.softmax(torch.bmm(query_landmarks, key.transpose(1, 2)), dim=2) # N x r x L_k
+    # the r x r kernel is inverted in fp32 (no autocast), the iterations are unstable in half precision
+    inverse = _iterative_pinv(kernel2.float()).to(kernel1.dtype)
+    return torch.bmm(kernel1, torch.bmm(inverse, torch.bmm(kernel3, value)))
+
+def attention(query, key, value, query_size, key_size, scale=1.0, chunk_size=None, approximation=None, rank=64):
+    '''
+        softmax(query^T key / scale) value^T, the attention of the NonLocal and DNL blocks
+        query: N x C x L_q over a query_size (h, w) map, key: N x C x L_k and value: N x C_v x L_k over a key_size map
+        approximation 'pooled' or 'nystrom' with about rank landmarks, else chunked_attention by chunks of
+        chunk_size, else (both None) the N x L_q x L_k similarity map
+        returns N x L_q x C_v
+    '''
+    query = query.transpose(1, 2) / scale
+    key = key.transpose(1, 2)
+    value = value.transpose(1, 2)
+    if approximation == 'pooled':
+        return pooled_attention(query, key, value, key_size, rank)
+    if approximation == 'nystrom':
+        return nystrom_attention(query, key, value, query_size, key_size, rank)
+    if chunk_size is not None:
+        # online softmax over the key chunks, the similarity map is never held
+        return chunked_attention(query, key, value, chunk_size)
+    similarity_map = torch.softmax(torch.bmm(query, key.transpose(1, 2)), dim=2) # N x L_q x L_k
+    return torch.bmm(similarity_map, value)
+
+def test():
+    query = torch.randn(4, 300, 16, dtype=torch.double, requires_grad=True)
+    key = torch.randn(4, 200, 16, dtype=torch.double, requires_grad=True)
+    value = torch.randn(4, 200, 8, dtype=torch.double, requires_grad=True)
+    reference = torch.bmm(torch.softmax(torch.bmm(query, key.transpose(1, 2)), dim=2), value)
+    output = chunked_attention(query, key, value, chunk_size=64)
+    print((output - reference).abs().max().item())
+    # small enough for gradcheck, chunk 7 leaves a ragged last chunk on both sides
+    small = [torch.randn(1, length, channels, dtype=torch.double, requires_grad=True) for length, channels in [(20, 4), (13, 4), (13, 3)]]
+    print(torch.autograd.gradcheck(lambda q, k, v: chunked_attention(q, k, v, 7), small))
+    # the approximations get closer to the exact attention as the rank grows, queries on 20 x 15, keys on 20 x 10
+    for rank in [16, 64, 300]:
+        print(rank, (pooled_attention(query, key, value, (20, 10), rank) - reference).norm().item() / reference.norm().item(),
+              (nystrom_attention(query, key, value, (20, 15), (20, 10), rank) - reference).norm().item() / reference.norm().item())
+    # the NonLocal and DNL blocks with downsample=True on a 14 x 14 map (ImageNet layer3): the keys are on 7 x 7
+    import importlib
+    from convs.dnl import DNL
+    NonLocal = importlib.import_module('convs.nonlocal').NonLocal
+    x = torch.randn(2, 32, 14, 14)
+    for block in [NonLocal, DNL]:
+        exact = block(32, 32, downsample=True)
+        with torch.no_grad():
+            reference = exact(x) - x
+            for approximation in APPROXIMATIONS:
+                approximate = block(32, 32, downsample=True, approximation=approximation)
+                approximate.load_state_dict(exact.state_dict())
+                print(block.__name__, approximation, (approximate(x) - x - reference).norm().item() / reference.norm().item())
+
+# test()
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from convs.functional import at_least_fp32, dynamic_conv2d, topk_dynamic_conv2d, MIX_MIN_BATCH_PER_EXPERT
+
 __all__ = ['CondConv_Inf']
 
 class route_func(nn.Module):
@@ -16,43 +18,67 @@ class route_func(nn.Module):
         x = self.avgpool(x)
         x = x.view(x.size(0), -1)
         x = self.fc(x)
-        x = self.sigmoid(x)
+        x = self.sigmoid(at_least_fp32(x))
         return x
 
 class CondConv_Inf(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, num_experts=3, stride=1, padding=0, groups=1, reduction=16, mode='A'):
+    '''
+        Inference-only CondConv, parameters are named as in CondConv so a trained
+        CondConv state_dict loads directly (or use CondConv_Inf.from_condconv)
+    '''
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, groups=1, bias=False, num_experts=3, top_k=None):
         super().__init__()
-        self.num_experts = num_experts
+        self.in_channels = in_channels
         self.out_channels = out_channels
         self.kernel_size = kernel_size
         self.stride = stride
         self.padding = padding
         self.groups = groups
+        self.num_experts = num_experts
+        self.top_k = top_k
 
         # routing function
         self.routing_func = route_func(in_channels, num_experts)
-        # convs
-        self.convs = [nn.Parameter(torch.Tensor(out_channels, in_channels, kernel_size, kernel_size)) for i in range(num_experts)]
-    
+        # experts
+        self.weight = nn.Parameter(torch.Tensor(num_experts, out_channels, in_channels // groups, kernel_size, kernel_size))
+        if bias:
+            self.bias = nn.Parameter(torch.Tensor(num_experts, out_channels))
+        else:
+            self.register_parameter('bias', None)
+
+    @classmethod
+    def from_condconv(cls, conv):
+        layer = cls(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                    groups=conv.groups, bias=conv.bias is not None, num_experts=conv.num_experts, top_k=conv.top_k)
+        layer.routing_func.load_state_dict(conv.routing_func.state_dict())
+        with torch.no_grad():
+            # a low-rank bank is expanded to the dense one
+            weight = conv.expert_weight()
+            layer.weight.copy_(weight)
+            if layer.bias is not None:
+                layer.bias.copy_(conv.bias)
+        return layer.to(weight.device).eval()
+
     def forward(self, x):
         routing_weight = self.routing_func(x) # N x k
-        convs = []
-        for i in range(self.num_experts):
-            route = routing_weight[:, i]
-            weight = self.convs[i]
-            weight = weight * route
-            convs.append(weight)
-        conv = sum(convs)
-        output = F.conv2d(x, weight=conv, stride=self.stride, padding=self.padding, groups=self.groups)
-        return None
+        if self.top_k is not None and self.top_k < self.num_experts:
+            return topk_dynamic_conv2d(x, routing_weight, self.weight, self.bias, self.top_k,
+                            stride=self.stride, padding=self.padding, groups=self.groups)
+        # per-sample kernels at small batch, mixing the expert outputs once the batch dwarfs the number of experts
+        backend = 'mix' if x.size(0) >= MIX_MIN_BATCH_PER_EXPERT * self.num_experts else 'grouped'
+        output = dynamic_conv2d(x, routing_weight, self.weight, self.bias,
+                            stride=self.stride, padding=self.padding, groups=self.groups, backend=backend)
+        return output
 
 def test():
-    x = torch.randn(1, 16, 32, 32)
-    conv = CondConv_Inf(16, 64, 3, padding=1)
-    y = conv(x)
-    print(y.shape)
-    conv = CondConv_Inf(16, 64, 3, padding=1)
-    y = conv(x)
-    print(y.shape)
-
-# test()
\ No newline at end of file
+    from convs.condconv import CondConv
+    # dense and low-rank expert banks
+    for rank in [None, 4]:
+        conv = CondConv(16, 64, 3, padding=1, rank=rank).eval()
+        conv_inf = CondConv_Inf.from_condconv(conv)
+        for b in [1, 64]:
+            x = torch.randn(b, 16, 32, 32)
+            with torch.no_grad():
+                print(rank, b, (conv(x) - conv_inf(x)).abs().max().item())
+
+# test()
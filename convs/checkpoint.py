@@ -0,0 +1,77 @@
+import inspect
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+__all__ = ['checkpoint_blocks', 'REENTRANT_CHECKPOINT']
+
+'''
+    Activation checkpointing of the residual blocks of a network: the blocks are split in segments and only the
+    segment inputs are kept for backward. The internals of a segment (routing, modulated copies of the input,
+    per-sample kernels, expert outputs) are recomputed when its gradient is needed, one segment at a time.
+    The recomputation runs the batch norms in train mode a second time, with momentum 0 so that their running
+    statistics are updated once per step (restoring them in place afterwards would invalidate the tensors the
+    reentrant checkpoint saved), and their batch counters are restored
+    The non-reentrant checkpoint is used where torch has it (1.11+), on torch 1.10 the reentrant one, which
+    needs the segment inputs to require grad (they do in training, they come out of the stem)
+'''
+
+REENTRANT_CHECKPOINT = 'use_reentrant' not in inspect.signature(checkpoint).parameters
+_CHECKPOINT_KWARGS = {} if REENTRANT_CHECKPOINT else {'use_reentrant': False}
+
+class _Segment:
+    # runs blocks in sequence, the calls after the first one are the recomputations of the backward
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.calls = 0
+
+    def __call__(self, x):
+        self.calls += 1
+        if self.calls == 1:
+            return self.run(x)
+        bns = [m for block in self.blocks for m in block.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        momenta = [bn.momentum for bn in bns]
+        counts = [(bn.num_batches_tracked, bn.num_batches_tracked.clone()) for bn in bns if bn.num_batches_tracked is not None]
+        for bn in bns:
+            bn.momentum = 0.0
+        try:
+            return self.run(x)
+        finally:
+            # also when the recomputation stops early, once the tensors needed by the backward are there
+            for bn, momentum in zip(bns, momenta):
+                bn.momentum = momentum
+            with torch.no_grad():
+                for num_batches_tracked, count in counts:
+                    num_batches_tracked.copy_(count)
+
+    def run(self, x):
+        for block in self.blocks:
+            x = block(x)
+        return x
+
+def checkpoint_blocks(layers, x, segments):
+    '''
+        Runs the blocks of layers (a list of nn.Sequential) on x, in segments checkpointed segments of about the
+        same number of blocks
+    '''
+    blocks = [block for layer in layers for block in layer]
+    segments = min(segments, len(blocks))
+    bounds = [round(i * len(blocks) / segments) for i in range(segments + 1)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        x = checkpoint(_Segment(blocks[start:end]), x, **_CHECKPOINT_KWARGS)
+    return x
+
+def test():
+    from cifar.dy_resnet import Dy_ResNet18
+    x = torch.randn(8, 3, 32, 32)
+    net = Dy_ResNet18()
+    checkpointed = Dy_ResNet18(checkpoint_segments=4)
+    checkpointed.load_state_dict(net.state_dict())
+    net(x).sum().backward()
+    checkpointed(x).sum().backward()
+    grads = dict(checkpointed.named_parameters())
+    print(max((p.grad - grads[name].grad).abs().max().item() for name, p in net.named_parameters()))
+    buffers = dict(checkpointed.named_buffers())
+    print(max((b.float() - buffers[name].float()).abs().max().item() for name, b in net.named_buffers()))
+
+# test()
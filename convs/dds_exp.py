@@ -2,14 +2,14 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from convs.functional import at_least_fp32, aggregate_channel_experts, per_sample_conv2d, pyramid_avg_pool2d
+
 __all__ = ['DDSConv_Exp']
 
 class route_func(nn.Module):
     def __init__(self, in_channels, out_channels, num_experts=3, reduction=16):
         super().__init__()
-        # Global Average Pool
-        self.gap1 = nn.AdaptiveAvgPool2d(1)
-        self.gap3 = nn.AdaptiveAvgPool2d(3)
+        # Global Average Pool to 1x1 and 3x3, in a single pass over x (see pyramid_avg_pool2d)
 
         squeeze_channels = max(in_channels // reduction, reduction)
         
@@ -24,12 +24,10 @@ class route_func(nn.Module):
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
-        b, _, _, _ = x.size()
-        a1 = self.gap1(x)
-        a3 = self.gap3(x)
+        a1, a3 = pyramid_avg_pool2d(x, [1, 3])
         a1 = a1.expand_as(a3)
         attention = torch.cat([a1, a3], dim=1)
-        attention = self.sigmoid(self.dwise_separable(attention))
+        attention = self.sigmoid(at_least_fp32(self.dwise_separable(attention)))
         return attention
 
 class DDSConv_Exp(nn.Module):
@@ -45,19 +43,13 @@ class DDSConv_Exp(nn.Module):
         # routing function
         self.routing_func = route_func(in_channels, out_channels, num_experts, reduction)
         # convs
-        self.convs = nn.Parameter(torch.Tensor(num_experts, out_channels, in_channels, kernel_size, kernel_size))
+        self.convs = nn.Parameter(torch.Tensor(num_experts, out_channels, in_channels // groups, kernel_size, kernel_size))
        
     def forward(self, x):
-        routing_weight = self.routing_func(x) # N x k*C
-        routing_weight = routing_weight.view(-1, self.num_experts, self.out_channels).unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)
-        b, c_in, h, w = x.size()
-        x = x.view(1, -1, h, w)
-        weight = self.convs.unsqueeze(0)
-        combined_weight = (weight * routing_weight).view(b*self.num_experts, self.out_channels, c_in, self.kernel_size, self.kernel_size)
-        combined_weight = torch.sum(combined_weight, dim=0)
-        output = F.conv2d(x, weight=combined_weight,
-                            stride=self.stride, padding=self.padding, groups=self.groups * b)
-        output = output.view(b, self.out_channels, output.size(-2), output.size(-1))
+        routing_weight = self.routing_func(x) # N x k*C_out x 1 x 1
+        combined_weight = aggregate_channel_experts(routing_weight, self.convs, self.groups, routed='out') # N x C_out x C_in x kH x kW
+        output = per_sample_conv2d(x, combined_weight, None, 
+                            stride=self.stride, padding=self.padding, groups=self.groups)
         return output
 
 def test():
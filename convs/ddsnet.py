@@ -1,15 +1,28 @@
 import torch
+import torch.fx
 import torch.nn as nn
 import torch.nn.functional as F
+from typing import Optional
+
+from convs.functional import at_least_fp32, aggregate_channel_experts, aggregate_channel_bias, per_sample_conv2d, pyramid_avg_pool2d, EXPERT_BACKENDS
+from convs.expert_conv import ExpertConv
 
 __all__ = ['DDSConv']
 
+# leaves of torch.fx.symbolic_trace, they read tensor shapes
+torch.fx.wrap('aggregate_channel_experts')
+torch.fx.wrap('aggregate_channel_bias')
+torch.fx.wrap('per_sample_conv2d')
+torch.fx.wrap('pyramid_avg_pool2d')
+torch.fx.wrap('at_least_fp32')
+
 class route_func(nn.Module):
-    def __init__(self, in_channels, out_channels, num_experts=3, reduction=16, mode='out'):
+    def __init__(self, in_channels, out_channels, num_experts=3, reduction=16, mode='out', routed_channels=None):
         super().__init__()
-        # Global Average Pool
-        self.gap1 = nn.AdaptiveAvgPool2d(1)
-        self.gap3 = nn.AdaptiveAvgPool2d(3)
+        # the channels routed per expert, more than one conv's when the router is shared by several convs
+        if routed_channels is None:
+            routed_channels = out_channels if mode == 'out' else in_channels
+        # Global Average Pool to 1x1 and 3x3, in a single pass over x (see pyramid_avg_pool2d)
 
         squeeze_channels = max(in_channels // reduction, reduction)
         
@@ -18,24 +31,25 @@ class route_func(nn.Module):
             nn.ReLU(inplace=True),
             nn.Conv2d(squeeze_channels, squeeze_channels, kernel_size=3, stride=1, groups=squeeze_channels, bias=False),
             nn.ReLU(inplace=True),
-            nn.Conv2d(squeeze_channels, num_experts * out_channels if mode=='out' else num_experts * in_channels, kernel_size=1, stride=1, groups=1, bias=False)
+            nn.Conv2d(squeeze_channels, num_experts * routed_channels, kernel_size=1, stride=1, groups=1, bias=False)
         )
         
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
-        b, _, _, _ = x.size()
-        a1 = self.gap1(x)
-        a3 = self.gap3(x)
+        a1, a3 = pyramid_avg_pool2d(x, [1, 3])
         a1 = a1.expand_as(a3)
         attention = torch.cat([a1, a3], dim=1)
-        attention = self.sigmoid(self.dwise_separable(attention))
+        attention = self.sigmoid(at_least_fp32(self.dwise_separable(attention)))
         return attention
 
-class DDSConv(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, num_experts=3, stride=1, padding=0, groups=1, reduction=16, deploy=False, mode='in'):
+class DDSConv(ExpertConv):
+    def __init__(self, in_channels, out_channels, kernel_size, num_experts=3, stride=1, padding=0, groups=1, reduction=16, deploy=False, mode='in', backend='fused', routing=True):
         super().__init__()
+        assert mode == 'in' or mode == 'out'
+        assert backend in EXPERT_BACKENDS
         self.deploy = deploy
+        self.backend = backend
         self.mode = mode
         self.num_experts = num_experts
         self.in_channels = in_channels
@@ -45,46 +59,37 @@ class DDSConv(nn.Module):
         self.padding = padding
         self.groups = groups
 
-        # routing function
-        self.routing_func = route_func(in_channels, out_channels, num_experts, reduction, mode)
+        # routing function, None if the block computes the routing (see convs.shared_routing)
+        self.routing_func = route_func(in_channels, out_channels, num_experts, reduction, mode) if routing else None
         # convs
         if deploy:
-            self.convs = [nn.Parameter(torch.Tensor(out_channels, in_channels, kernel_size, kernel_size)) for i in range(num_experts)]
+            # the experts with their batch norms folded in, stacked (see ExpertConv.fold_bns)
+            self.weight = nn.Parameter(torch.Tensor(num_experts, out_channels, in_channels // groups, kernel_size, kernel_size))
+            self.bias = nn.Parameter(torch.Tensor(num_experts, out_channels))
         else:
+            self.register_parameter('weight', None)
+            self.register_parameter('bias', None)
             self.convs = nn.ModuleList([nn.Conv2d(in_channels, out_channels, kernel_size, stride=stride, padding=padding, groups=groups) for i in range(num_experts)])
             self.bns = nn.ModuleList([nn.BatchNorm2d(out_channels) for i in range(num_experts)])
         
-    def forward(self, x):
-        routing_weight = self.routing_func(x) # N x k*C
-        if self.deploy:
-            convs = []
-            for i in range(self.num_experts):
-                route = routing_weight[:, i * self.out_channels : (i+1) * self.out_channels].squeeze(0).unsqueeze(-1)
-                weight = self.convs[i]
-                weight = weight * route
-                convs.append(weight)
-            conv = sum(convs)
-            output = F.conv2d(x, weight=conv, stride=self.stride, padding=self.padding, groups=self.groups)
-        else:
-            outputs = []
+    def forward(self, x, routing_weight: Optional[torch.Tensor] = None):
+        if self.routing_func is not None:
+            if routing_weight is None:
+                routing_weight = self.routing_func(x) # N x k*C x 1 x 1
+        assert routing_weight is not None, 'the routing weights are computed by the block'
+        if self.weight is not None and self.bias is not None:
+            weight = aggregate_channel_experts(routing_weight, self.weight, self.groups, routed=self.mode)
+            bias = aggregate_channel_bias(routing_weight, self.bias, routed=self.mode)
+            output = per_sample_conv2d(x, weight, bias, stride=self.stride, padding=self.padding, groups=self.groups)
+        elif self.backend == 'fused':
             if self.mode == 'out':
-                for i in range(self.num_experts):
-                    route = routing_weight[:, i * self.out_channels : (i+1) * self.out_channels]
-                    # X * W
-                    out = self.convs[i](x)
-                    out = self.bns[i](out)
-                    out = out * route.expand_as(out)
-                    outputs.append(out)
-                output = sum(outputs)
+                output = self.routed_forward(x, routing_weight)
             else:
-                for i in range(self.num_experts):
-                    route = routing_weight[:, i * self.in_channels : (i+1) * self.in_channels]
-                    attention = x * route.expand_as(x)
-                    # X * W
-                    out = self.convs[i](attention)
-                    out = self.bns[i](out)
-                    outputs.append(out)
-                output = sum(outputs)
+                output = self.modulated_forward(x, routing_weight)
+        elif self.mode == 'out':
+            output = self.routed_loop_forward(x, routing_weight)
+        else:
+            output = self.modulated_loop_forward(x, routing_weight)
         return output
 
 def test():
@@ -95,5 +100,27 @@ def test():
     conv = DDSConv(16, 64, 3, padding=1, mode='in')
     y = conv(x)
     print(y.shape)
+    # the fused backend matches the loop over experts, in training and in eval mode
+    for mode in ['in', 'out']:
+        conv = DDSConv(16, 64, 3, padding=1, mode=mode, backend='loop')
+        for train in [True, False]:
+            conv.train(train)
+            conv.backend = 'loop'
+            y1 = conv(x)
+            conv.backend = 'fused'
+            y2 = conv(x)
+            print(mode, train, (y1 - y2).abs().max().item())
+    # deploy mode with the folded experts and biases matches the trained layer in eval mode
+    for mode in ['in', 'out']:
+        conv = DDSConv(16, 64, 3, padding=1, mode=mode)
+        conv(x)
+        conv.eval()
+        deployed = DDSConv(16, 64, 3, padding=1, mode=mode, deploy=True).eval()
+        deployed.load_state_dict(conv.state_dict(), strict=False)
+        with torch.no_grad():
+            weight, bias = conv.fold_bns(*conv.expert_params())
+            deployed.weight.copy_(weight)
+            deployed.bias.copy_(bias)
+            print(mode, (conv(x) - deployed(x)).abs().max().item())
 
 # test()
\ No newline at end of file
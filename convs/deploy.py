@@ -0,0 +1,128 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import Optional
+
+from convs.functional import modulate_experts, routed_expert_conv2d, stack_expert_params, fuse_expert_bn, concat_expert_weight
+from convs.dyres_conv import DyResConv
+from convs.ddsnet import DDSConv
+from convs.dysep_conv import DySepConv
+from convs.dychannel import DyChannel
+
+__all__ = ['ExpertConv_Inf', 'convert_to_deploy']
+
+class ExpertConv_Inf(nn.Module):
+    '''
+        Inference form of the layers that keep one Conv2d + BatchNorm2d per expert.
+        The batch norms are folded into the experts, which are stored stacked.
+        mode 'in' : sum_i conv(x * r_i, W_i) + b, r_i modulates the input channels
+        mode 'out': sum_i r_i * (conv(x, W_i) + b_i), r_i weights the output channels
+    '''
+    def __init__(self, routing_func, in_channels, out_channels, kernel_size, num_experts=3, stride=1, padding=0, groups=1, mode='in'):
+        super().__init__()
+        assert mode == 'in' or mode == 'out'
+        self.mode = mode
+        self.num_experts = num_experts
+        self.stride = stride
+        self.padding = padding
+        self.groups = groups
+
+        # routing function, None if the block computes the routing (see convs.shared_routing)
+        self.routing_func = routing_func
+        # convs
+        if mode == 'in': # experts concatenated along the input channels
+            self.weight = nn.Parameter(torch.Tensor(out_channels, num_experts * in_channels // groups, kernel_size, kernel_size))
+            self.bias = nn.Parameter(torch.Tensor(out_channels))
+        else:
+            self.weight = nn.Parameter(torch.Tensor(num_experts, out_channels, in_channels // groups, kernel_size, kernel_size))
+            self.bias = nn.Parameter(torch.Tensor(num_experts, out_channels))
+
+    def load_experts(self, weight, bias):
+        # weight: k x C_out x C_in/groups x kH x kW, bias: k x C_out, with the batch norms already folded in
+        with torch.no_grad():
+            if self.mode == 'in':
+                weight = concat_expert_weight(weight, self.groups)
+                bias = bias.sum(0)
+            self.weight.copy_(weight)
+            self.bias.copy_(bias)
+
+    def forward(self, x, routing_weight: Optional[torch.Tensor] = None):
+        if self.routing_func is not None:
+            if routing_weight is None:
+                routing_weight = self.routing_func(x) # N x k*C x 1 x 1
+        assert routing_weight is not None, 'the routing weights are computed by the block'
+        if self.mode == 'in':
+            x = modulate_experts(x, routing_weight, self.num_experts, self.groups) # N x k*C_in x H x W
+            return F.conv2d(x, weight=self.weight, bias=self.bias, stride=self.stride, padding=self.padding, groups=self.groups)
+        return routed_expert_conv2d(x, routing_weight, self.weight, self.bias,
+                            stride=self.stride, padding=self.padding, groups=self.groups)
+
+def _experts(module):
+    # (routing function, expert convs, expert batch norms, mode) of a training layer, None if it has no deploy form
+    if isinstance(module, DyResConv) and not module.deploy:
+        return module.routing_func, module.convs, module.bns, 'in'
+    if isinstance(module, DDSConv) and not module.deploy:
+        return module.routing_func, module.convs, module.bns, module.mode
+    if isinstance(module, DyChannel):
+        return module.routing_func, module.convs, module.bns, 'in'
+    if isinstance(module, DySepConv):
+        routing_func = nn.Sequential(module.gap5, module.dwise_separable, module.sigmoid)
+        return routing_func, [module.one_conv, module.two_conv, module.three_conv], [module.one_bn, module.two_bn, module.three_bn], 'in'
+    return None
+
+def _deploy_layer(module):
+    experts = _experts(module)
+    if experts is None:
+        return None
+    routing_func, convs, bns, mode = experts
+    conv = convs[0]
+    with torch.no_grad():
+        weight, bias = stack_expert_params(convs)
+        weight, bias = fuse_expert_bn(weight, bias, bns)
+    layer = ExpertConv_Inf(routing_func, conv.in_channels, conv.out_channels, conv.kernel_size[0], num_experts=len(convs),
+                    stride=conv.stride[0], padding=conv.padding[0], groups=conv.groups, mode=mode)
+    layer.to(conv.weight.device)
+    layer.load_experts(weight, bias)
+    return layer.eval()
+
+def _convert(module):
+    for name, child in module.named_children():
+        layer = _deploy_layer(child)
+        if layer is not None:
+            setattr(module, name, layer)
+        else:
+            _convert(child)
+
+def convert_to_deploy(net, input_size=None, batch=8, atol=1e-4):
+    '''
+        Replaces every DyResConv, DDSConv, DySepConv and DyChannel of a trained network with an
+        ExpertConv_Inf, in place. The network is put in eval mode.
+        If input_size (C, H, W) is given, the outputs on a random batch are checked before and after.
+    '''
+    net.eval()
+    if input_size is not None:
+        device = next(net.parameters()).device
+        x = torch.randn(batch, *input_size, device=device)
+        with torch.no_grad():
+            reference = net(x)
+
+    _convert(net)
+
+    if input_size is not None:
+        with torch.no_grad():
+            diff = (net(x) - reference).abs().max().item()
+        assert diff <= atol, 'deployed network differs from the trained one by {}'.format(diff)
+    return net
+
+def test():
+    from cifar.dyresA_resnet import DyResA_ResNet18
+    from cifar.dds_mobilenetv2 import DDS_MobileNetV2
+    for net in [DyResA_ResNet18(), DDS_MobileNetV2(mode='out')]:
+        # some training steps so that the batch norms have non-trivial statistics
+        net.train()
+        for _ in range(3):
+            net(torch.randn(8, 3, 32, 32))
+        convert_to_deploy(net, input_size=(3, 32, 32))
+        print(net.layer1[0].conv1 if hasattr(net, 'layer1') else net.layers[0].conv2)
+
+# test()
@@ -3,13 +3,17 @@ import torch.nn as nn
 import torch.nn.functional as F
 import math
 
+from convs.attention import attention, APPROXIMATIONS
+
 __all__ = ['DNL']
 '''
     Vanilla Non-Local Block for 2D only
 '''
 class DNL(nn.Module):
-    def __init__(self, in_channels, channels, with_unary=True, whiten_type=['channel'], downsample=False, temperature=1.0):
+    def __init__(self, in_channels, channels, with_unary=True, whiten_type=['channel'], downsample=False, temperature=1.0, chunk_size=None, approximation=None, rank=64):
         super().__init__()
+        assert approximation is None or approximation in APPROXIMATIONS
+        assert approximation is None or chunk_size is None
         
         self.conv_query = nn.Conv2d(in_channels, channels, kernel_size=1) #Q
         self.conv_key = nn.Conv2d(in_channels, channels, kernel_size=1) #K
@@ -19,6 +23,11 @@ class DNL(nn.Module):
         self.softmax = nn.Softmax(2)
         self.scale = math.sqrt(channels)
         self.temperature = temperature
+        # None builds the H*W x H*W similarity map, else the exact attention by chunks of chunk_size queries and keys
+        self.chunk_size = chunk_size
+        # 'pooled' or 'nystrom' approximate the attention with about rank landmarks, linear in H*W
+        self.approximation = approximation
+        self.rank = rank
 
         if downsample:
             max_pool = nn.MaxPool2d(2, 2)
@@ -75,13 +84,9 @@ class DNL(nn.Module):
             key -= key_mean
             query -= query_mean
 
-        # torch.bmm() is batch mm
-        similiarity_map = torch.bmm(query.transpose(1, 2), key) # N x H*W x H*W
-        similiarity_map = similiarity_map / self.scale
-        similiarity_map = similiarity_map / self.temperature
-        similiarity_map = self.softmax(similiarity_map)
-
-        out = torch.bmm(similiarity_map, value.transpose(1, 2)) # N x H*W x C'
+        # the similarity map, the chunked attention or an approximation (see convs.attention)
+        out = attention(query, key, value, x.size()[2:], input_x.size()[2:], self.scale * self.temperature,
+                        self.chunk_size, self.approximation, self.rank) # N x H*W x C'
         out = out.transpose(1, 2) # N x C' x H*W
         out = out.view(out.size(0), out.size(1), *x.size()[2:]) # N x C' x H x W
 
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from convs.functional import per_sample_conv2d
+
 __all__ = ['DNLCWN', 'DNLCWN_DW']
 
 class DNLCLayer(nn.Module):
@@ -79,11 +81,8 @@ class DNLCWN(nn.Module):
         x_w = self.dnlc(x) # N x c_in/r x 1 x 1
         x_w = self.fc(x_w) # N x (C_out)(C_in)(kH)(kW) x 1 x 1
 
-        x = x.view(1, -1, x.size(2), x.size(3)) # 1 x N(C_in) x H x W
-        x_w = x_w.view(-1, self.in_channels, self.kernel_size, self.kernel_size) # (C_out)(N) x C_in x kH, kW
-        x = F.conv2d(x, weight=x_w, stride=self.stride, padding=self.padding, groups=b)
-        x = x.view(-1, self.out_channels, x.size(2), x.size(3)) # N x C_out x H x W
-        return x
+        x_w = x_w.view(b, self.out_channels, self.in_channels, self.kernel_size, self.kernel_size) # N x C_out x C_in x kH x kW
+        return per_sample_conv2d(x, x_w, None, stride=self.stride, padding=self.padding)
 
 class DNLCWN_DW(nn.Module):
     def __init__(self, channels, kernel_size, stride=1, bn=False, reduction=2, gap_mode='prior'):
@@ -104,11 +103,8 @@ class DNLCWN_DW(nn.Module):
         x_w = self.dnlc(x) # N x c_in/r x 1 x 1
         x_w = self.fc(x_w) # N x (C_out)(C_in)(kH)(kW) x 1 x 1
 
-        x = x.view(1, -1, x.size(2), x.size(3)) # 1 x N(C_in) x H x W
-        x_w = x_w.view(-1, 1, self.kernel_size, self.kernel_size) # (C_out)(N) x C_in x kH, kW
-        x = F.conv2d(x, weight=x_w, stride=self.stride, padding=self.padding, groups=self.channels * b)
-        x = x.view(-1, self.channels, x.size(2), x.size(3)) # N x C_out x H x W
-        return x
+        x_w = x_w.view(b, self.channels, 1, self.kernel_size, self.kernel_size) # N x C x 1 x kH x kW
+        return per_sample_conv2d(x, x_w, None, stride=self.stride, padding=self.padding, groups=self.channels)
 
 def test():
     x = torch.randn(64, 128, 32, 32)
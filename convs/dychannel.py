@@ -3,6 +3,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import math
 
+from convs.functional import at_least_fp32, EXPERT_BACKENDS
+from convs.expert_conv import ExpertConv
+
 __all__ = ['DyChannel']
 
 # TODO: if use bias, out_channels is used in route_func instead
@@ -23,19 +26,24 @@ class route_func(nn.Module):
             self.activation = nn.Softmax(2)
 
     def forward(self, x):
-        b, c, _, _ = x.size()
-        x = self.avgpool(x).view(b, c)
+        x = self.avgpool(x)
+        x = x.view(x.size(0), -1)
         x = F.relu(self.fc1(x))
         x = self.fc2(x)
-        x = self.activation(x)
+        x = self.activation(at_least_fp32(x))
         return x.unsqueeze(-1).unsqueeze(-1)
 
-class DyChannel(nn.Module):
+class DyChannel(ExpertConv):
 
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, groups=1, num_experts=3, reduction=16, activation='sigmoid'):
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, groups=1, num_experts=3, reduction=16, activation='sigmoid', backend='fused'):
         super().__init__()
+        assert backend in EXPERT_BACKENDS
 
         self.num_experts = num_experts
+        self.backend = backend
+        self.stride = stride
+        self.padding = padding
+        self.groups = groups
 
         # routing function
         self.routing_func = route_func(in_channels, num_experts, reduction)
@@ -44,19 +52,10 @@ class DyChannel(nn.Module):
         self.bns = nn.ModuleList([nn.BatchNorm2d(out_channels) for i in range(num_experts)])
 
     def forward(self, x):
-        outputs = []
-        
-        _, c_in, _, _ = x.size()
-        routing_weight = self.routing_func(x) # N x k x C
-
-        for i in range(self.num_experts):
-            route = routing_weight[:, i*c_in:(i+1)*c_in]
-            attention = x * route.expand_as(x)
-            out = self.convs[i](attention)
-            out = self.bns[i](out)
-            outputs.append(out)
-        
-        return sum(outputs)
+        routing_weight = self.routing_func(x) # N x k*C x 1 x 1
+        if self.backend == 'fused':
+            return self.modulated_forward(x, routing_weight)
+        return self.modulated_loop_forward(x, routing_weight)
 
 def test():
     x = torch.randn(4, 16 , 32, 32)
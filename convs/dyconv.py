@@ -1,31 +1,50 @@
 import torch
+import torch.fx
 import torch.nn as nn
 import torch.nn.functional as F
 import math
+from typing import Optional
+
+from convs.functional import at_least_fp32, dynamic_conv2d, topk_dynamic_conv2d, lowrank_dynamic_conv2d, lowrank_expert_weight, BACKENDS
+from convs.recompute import recomputed_dynamic_conv2d
 
 __all__ = ['DyConv']
 
+# leaves of torch.fx.symbolic_trace, they read tensor shapes
+torch.fx.wrap('dynamic_conv2d')
+torch.fx.wrap('topk_dynamic_conv2d')
+torch.fx.wrap('lowrank_dynamic_conv2d')
+torch.fx.wrap('recomputed_dynamic_conv2d')
+torch.fx.wrap('at_least_fp32')
+
 class route_func(nn.Module):
 
-    def __init__(self, in_channels, num_experts, reduction=16):
+    def __init__(self, in_channels, num_experts, reduction=16, num_routes=1):
         super().__init__()
         reduction_channels = max(in_channels // reduction, reduction)
+        self.num_experts = num_experts
         self.avgpool = nn.AdaptiveAvgPool2d(1)
         self.fc1 = nn.Linear(in_channels, reduction_channels)
-        self.fc2 = nn.Linear(reduction_channels, num_experts)
-        self.softmax = nn.Softmax(1)
+        # num_routes routings of k experts each, for convs sharing the router
+        self.fc2 = nn.Linear(reduction_channels, num_routes * num_experts)
+        self.softmax = nn.Softmax(2)
 
     def forward(self, x):
+        b = x.size(0)
         x = self.avgpool(x)
-        x = x.view(x.size(0), -1)
+        x = x.view(b, -1)
         x = F.relu(self.fc1(x))
         x = self.fc2(x)
-        x = self.softmax(x)
-        return x
+        x = self.softmax(at_least_fp32(x).view(b, -1, self.num_experts))
+        return x.view(b, -1)
 
 class DyConv(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, groups=1, bias=False, num_experts=3):
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, groups=1, bias=False, num_experts=3, backend='auto', top_k=None, rank=None, routing=True, recompute=False):
         super(DyConv, self).__init__()
+        assert backend in BACKENDS
+        assert top_k is None or 0 < top_k <= num_experts
+        assert top_k is None or rank is None
+        assert not recompute or (top_k is None and rank is None), 'recompute is for the dense expert bank'
         
         self.in_channels = in_channels
         self.out_channels = out_channels
@@ -34,38 +53,66 @@ class DyConv(nn.Module):
         self.padding = padding
         self.groups = groups
         self.num_experts = num_experts
+        self.backend = backend
+        self.top_k = top_k if top_k is not None and top_k < num_experts else None # None aggregates all the experts
+        self.rank = rank # None keeps a dense expert bank
+        self.recompute = recompute # rebuild the combined kernels in backward instead of keeping them (training only)
 
-        # routing function
-        self.routing_func = route_func(in_channels, num_experts)
+        # routing function, None if the block computes the routing (see convs.shared_routing)
+        self.routing_func = route_func(in_channels, num_experts) if routing else None
 
-        self.weight = nn.Parameter(torch.Tensor(num_experts, out_channels, in_channels // groups, kernel_size, kernel_size))
+        if rank is None:
+            self.weight = nn.Parameter(torch.Tensor(num_experts, out_channels, in_channels // groups, kernel_size, kernel_size))
+        else:
+            # low-rank bank, expert i is base + expert_u[i] @ expert_v[i]
+            self.register_parameter('weight', None)
+            self.base = nn.Parameter(torch.Tensor(out_channels, in_channels // groups, kernel_size, kernel_size))
+            self.expert_u = nn.Parameter(torch.Tensor(num_experts, out_channels, rank))
+            self.expert_v = nn.Parameter(torch.Tensor(num_experts, rank, in_channels // groups * kernel_size * kernel_size))
         if bias:
             self.bias = nn.Parameter(torch.Tensor(num_experts, out_channels))
         else:
             self.register_parameter('bias', None)
-        nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
+        if rank is None:
+            nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
+        else:
+            nn.init.kaiming_uniform_(self.base, a=math.sqrt(5))
+            nn.init.uniform_(self.expert_u, -1 / math.sqrt(rank), 1 / math.sqrt(rank))
+            bound = 1 / math.sqrt(self.expert_v.size(-1))
+            nn.init.uniform_(self.expert_v, -bound, bound)
         if self.bias is not None:
-            fan_in, _ = nn.init._calculate_fan_in_and_fan_out(self.weight)
+            fan_in, _ = nn.init._calculate_fan_in_and_fan_out(self.expert_weight())
             bound = 1 / math.sqrt(fan_in)
             nn.init.uniform_(self.bias, -bound, bound)
 
-    def forward(self, x):
-        routing_weight = self.routing_func(x)
-        b, c_in, h, w = x.size()
-        k, c_out, c_in, kh, kw = self.weight.size()
-        x = x.view(1, -1, h, w) # 1 x N*C_in x H x W
-        weight = self.weight.view(k, -1) # k x C_out*C_in*kH*hW
-        combined_weight = torch.mm(routing_weight, weight).view(-1, c_in, kh, kw)
+    def expert_weight(self):
+        # the k x C_out x C_in/groups x kH x kW expert bank
+        if self.rank is None:
+            return self.weight
+        return lowrank_expert_weight(self.base, self.expert_u, self.expert_v)
 
-        if self.bias is not None:
-            combined_bias = torch.mm(routing_weight, self.bias).view(-1)
-            output = F.conv2d(x, weight=combined_weight, bias=combined_bias, 
-                            stride=self.stride, padding=self.padding, groups=self.groups * b)
-        else:
-            output = F.conv2d(x, weight=combined_weight, bias=None, 
-                            stride=self.stride, padding=self.padding, groups=self.groups * b)
+    @torch.jit.unused
+    def recomputed_forward(self, x: torch.Tensor, routing_weight: torch.Tensor) -> torch.Tensor:
+        # eager only, see convs.recompute
+        return recomputed_dynamic_conv2d(x, routing_weight, self.weight, self.bias,
+                        stride=self.stride, padding=self.padding, groups=self.groups, backend=self.backend)
 
-        output = output.view(b, c_out, output.size(-2), output.size(-1))
+    def forward(self, x, routing_weight: Optional[torch.Tensor] = None):
+        if self.routing_func is not None:
+            if routing_weight is None:
+                routing_weight = self.routing_func(x) # N x k
+        assert routing_weight is not None, 'the routing weights are computed by the block'
+        if self.rank is not None:
+            output = lowrank_dynamic_conv2d(x, routing_weight, self.base, self.expert_u, self.expert_v, self.bias,
+                            stride=self.stride, padding=self.padding, groups=self.groups, backend=self.backend)
+        elif self.top_k is not None:
+            output = topk_dynamic_conv2d(x, routing_weight, self.weight, self.bias, self.top_k,
+                            stride=self.stride, padding=self.padding, groups=self.groups, backend=self.backend, normalize=True)
+        elif self.recompute and self.training and not torch.jit.is_scripting():
+            output = self.recomputed_forward(x, routing_weight)
+        else:
+            output = dynamic_conv2d(x, routing_weight, self.weight, self.bias, 
+                            stride=self.stride, padding=self.padding, groups=self.groups, backend=self.backend)
         return output
 
 def test():
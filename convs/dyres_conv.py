@@ -1,22 +1,33 @@
 import torch
+import torch.fx
 import torch.nn as nn
 import torch.nn.functional as F
+from typing import Optional
+
+from convs.functional import at_least_fp32, aggregate_channel_experts, aggregate_channel_bias, per_sample_conv2d, pyramid_avg_pool2d, bicubic_upsample_matrix, \
+                             attention_conv1x1, attention_grouped_conv3x3, EXPERT_BACKENDS
+from convs.expert_conv import ExpertConv
 
 __all__ = ['DyResConv']
 
+# leaves of torch.fx.symbolic_trace, they read tensor shapes
+torch.fx.wrap('aggregate_channel_experts')
+torch.fx.wrap('aggregate_channel_bias')
+torch.fx.wrap('per_sample_conv2d')
+torch.fx.wrap('pyramid_avg_pool2d')
+torch.fx.wrap('attention_conv1x1')
+torch.fx.wrap('attention_grouped_conv3x3')
+torch.fx.wrap('at_least_fp32')
+
 class route_func(nn.Module):
-    def __init__(self, in_channels, num_experts=3, reduction=16, mode='A'):
+    def __init__(self, in_channels, num_experts=3, reduction=16, mode='A', routed_channels=None):
         super().__init__()
         assert mode == 'A' or mode == 'B' or mode == 'S'
+        # the channels routed per expert, more than in_channels when the router is shared by several convs
+        routed_channels = in_channels if routed_channels is None else routed_channels
+        assert mode != 'B' or (num_experts * routed_channels) % in_channels == 0
         self.mode = mode
-        # Global Average Pool
-        if mode == 'A' or mode == 'B':
-            self.gap1 = nn.AdaptiveAvgPool2d(1)
-            self.gap3 = nn.AdaptiveAvgPool2d(3)
-            self.gap5 = nn.AdaptiveAvgPool2d(5)
-        else:
-            self.gap1 = nn.AdaptiveAvgPool2d(1)
-            self.gap3 = nn.AdaptiveAvgPool2d(3)
+        # Global Average Pool to 1x1, 3x3 (and 5x5), in a single pass over x (see pyramid_avg_pool2d)
 
         squeeze_channels = max(in_channels // reduction, reduction)
         
@@ -28,7 +39,7 @@ class route_func(nn.Module):
                 nn.ReLU(inplace=True),
                 nn.Conv2d(squeeze_channels, squeeze_channels, kernel_size=3, stride=1, groups=squeeze_channels, bias=False),
                 nn.ReLU(inplace=True),
-                nn.Conv2d(squeeze_channels, num_experts * in_channels, kernel_size=1, stride=1, groups=1, bias=False)
+                nn.Conv2d(squeeze_channels, num_experts * routed_channels, kernel_size=1, stride=1, groups=1, bias=False)
             )
         elif mode == 'B': # 3-1-1-3
             self.dwise_separable = nn.Sequential(
@@ -38,7 +49,7 @@ class route_func(nn.Module):
                 nn.ReLU(inplace=True),
                 nn.Conv2d(squeeze_channels, in_channels, kernel_size=1, stride=1, groups=1, bias=False),
                 nn.ReLU(inplace=True),
-                nn.Conv2d(in_channels, num_experts * in_channels, kernel_size=3, stride=1, groups=in_channels, bias=False)
+                nn.Conv2d(in_channels, num_experts * routed_channels, kernel_size=3, stride=1, groups=in_channels, bias=False)
             )
         elif mode == 'S': # simplified mode
             self.dwise_separable = nn.Sequential(
@@ -46,68 +57,73 @@ class route_func(nn.Module):
                 nn.ReLU(inplace=True),
                 nn.Conv2d(squeeze_channels, squeeze_channels, kernel_size=3, stride=1, groups=squeeze_channels, bias=False),
                 nn.ReLU(inplace=True),
-                nn.Conv2d(squeeze_channels, num_experts * in_channels, kernel_size=1, stride=1, groups=1, bias=False)
+                nn.Conv2d(squeeze_channels, num_experts * routed_channels, kernel_size=1, stride=1, groups=1, bias=False)
             )
         
         self.sigmoid = nn.Sigmoid()
+        # modes A and B: the 3x3 -> 5x5 bicubic upsampling, folded into the first layer (not saved in the state dict)
+        self.register_buffer('upsample', bicubic_upsample_matrix(3, 5), persistent=False)
 
     def forward(self, x):
-        b, _, _, _ = x.size()
-        a1 = self.gap1(x)
         if self.mode == 'A' or self.mode == 'B':
-            a3 = F.interpolate(self.gap3(x), 5, mode='bicubic', align_corners=False)
-            a5 = self.gap5(x)
-            a1 = a1.expand_as(a5)
-            attention = torch.cat([a1, a3, a5], dim=1)
+            # the first layer of dwise_separable over cat([a1, interpolate(a3), a5]), without building it
+            a1, a3, a5 = pyramid_avg_pool2d(x, [1, 3, 5])
+            if self.mode == 'A':
+                attention = attention_conv1x1(a1, a3, a5, self.dwise_separable[0].weight, self.upsample)
+            else:
+                attention = attention_grouped_conv3x3(a1, a3, a5, self.dwise_separable[0].weight, self.upsample)
+            for i, layer in enumerate(self.dwise_separable):
+                if i > 0:
+                    attention = layer(attention)
         else:
-            a3 = self.gap3(x)
+            a1, a3 = pyramid_avg_pool2d(x, [1, 3])
             a1 = a1.expand_as(a3)
-            attention = torch.cat([a1, a3], dim=1)
+            attention = self.dwise_separable(torch.cat([a1, a3], dim=1))
 
-        attention = self.sigmoid(self.dwise_separable(attention))
+        attention = self.sigmoid(at_least_fp32(attention))
         return attention
 
-class DyResConv(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, num_experts=3, stride=1, padding=0, groups=1, reduction=16, mode='A', deploy=False):
+class DyResConv(ExpertConv):
+    def __init__(self, in_channels, out_channels, kernel_size, num_experts=3, stride=1, padding=0, groups=1, reduction=16, mode='A', deploy=False, backend='fused', routing=True):
         super().__init__()
         assert mode == 'A' or mode == 'B' or mode == 'S'
+        assert backend in EXPERT_BACKENDS
         self.deploy = deploy
+        self.backend = backend
         self.num_experts = num_experts
+        self.in_channels = in_channels
+        self.mode = mode
 
         self.stride = stride
         self.padding = padding
         self.groups = groups
 
-        # routing function
-        self.routing_func = route_func(in_channels, num_experts, reduction, mode)
+        # routing function, None if the block computes the routing (see convs.shared_routing)
+        self.routing_func = route_func(in_channels, num_experts, reduction, mode) if routing else None
         # convs
         if deploy:
-            self.convs = [nn.Parameter(torch.Tensor(out_channels, in_channels, kernel_size, kernel_size)) for i in range(num_experts)]
+            # the experts with their batch norms folded in, stacked (see ExpertConv.fold_bns)
+            self.weight = nn.Parameter(torch.Tensor(num_experts, out_channels, in_channels // groups, kernel_size, kernel_size))
+            self.bias = nn.Parameter(torch.Tensor(num_experts, out_channels))
         else:
+            self.register_parameter('weight', None)
+            self.register_parameter('bias', None)
             self.convs = nn.ModuleList([nn.Conv2d(in_channels, out_channels, kernel_size, stride=stride, padding=padding, groups=groups) for i in range(num_experts)])
             self.bns = nn.ModuleList([nn.BatchNorm2d(out_channels) for i in range(num_experts)])
         
-    def forward(self, x):
-        _, c_in, _, _ = x.size()
-        routing_weight = self.routing_func(x) # N x k x C
-        if self.deploy:
-            convs = []
-            for i in range(self.num_experts):
-                route = routing_weight[:, i * c_in : (i+1) * c_in]
-                weight = self.convs[i]
-                weight = weight * route
-                convs.append(weight)
-            conv = sum(convs)
-            output = F.conv2d(x, weight=conv, stride=self.stride, padding=self.padding, groups=self.groups)
+    def forward(self, x, routing_weight: Optional[torch.Tensor] = None):
+        if self.routing_func is not None:
+            if routing_weight is None:
+                routing_weight = self.routing_func(x) # N x k*C x 1 x 1
+        assert routing_weight is not None, 'the routing weights are computed by the block'
+        if self.weight is not None and self.bias is not None:
+            weight = aggregate_channel_experts(routing_weight, self.weight, self.groups, routed='in')
+            bias = aggregate_channel_bias(routing_weight, self.bias, routed='in')
+            output = per_sample_conv2d(x, weight, bias, stride=self.stride, padding=self.padding, groups=self.groups)
+        elif self.backend == 'fused':
+            output = self.modulated_forward(x, routing_weight)
         else:
-            outputs = []
-            for i in range(self.num_experts):
-                route = routing_weight[:, i*c_in:(i+1)*c_in]
-                attention = x * route.expand_as(x)
-                out = self.convs[i](attention)
-                out = self.bns[i](out)
-                outputs.append(out)
-            output = sum(outputs)
+            output = self.modulated_loop_forward(x, routing_weight)
         return output
 
 def test():
@@ -121,5 +137,28 @@ def test():
     conv = DyResConv(16, 64, 3, padding=1, mode='S')
     y = conv(x)
     print(y.shape)
+    # the fused backend matches the loop over experts, in training and in eval mode
+    x = torch.randn(8, 16, 32, 32)
+    for groups in [1, 16]:
+        conv = DyResConv(16, 16, 3, padding=1, groups=groups, mode='A', backend='loop')
+        for train in [True, False]:
+            conv.train(train)
+            conv.backend = 'loop'
+            y1 = conv(x)
+            conv.backend = 'fused'
+            y2 = conv(x)
+            print(groups, train, (y1 - y2).abs().max().item())
+    # deploy mode with the folded experts and biases matches the trained layer in eval mode
+    for mode in ['A', 'B', 'S']:
+        conv = DyResConv(16, 32, 3, padding=1, mode=mode)
+        conv(x)
+        conv.eval()
+        deployed = DyResConv(16, 32, 3, padding=1, mode=mode, deploy=True).eval()
+        deployed.load_state_dict(conv.state_dict(), strict=False)
+        with torch.no_grad():
+            weight, bias = conv.fold_bns(*conv.expert_params())
+            deployed.weight.copy_(weight)
+            deployed.bias.copy_(bias)
+            print(mode, (conv(x) - deployed(x)).abs().max().item())
 
 # test()
\ No newline at end of file
@@ -2,16 +2,16 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from convs.functional import at_least_fp32, aggregate_channel_experts, per_sample_conv2d, pyramid_avg_pool2d, bicubic_upsample_matrix, \
+                             attention_conv1x1, attention_grouped_conv3x3
+
 __all__ = ['DyResConv_Inf']
 
 class route_func(nn.Module):
     def __init__(self, in_channels, num_experts=3, reduction=16, mode='A'):
         super().__init__()
         assert mode == 'A' or mode == 'B'
-        # Global Average Pool
-        self.gap1 = nn.AdaptiveAvgPool2d(1)
-        self.gap3 = nn.AdaptiveAvgPool2d(3)
-        self.gap5 = nn.AdaptiveAvgPool2d(5)
+        # Global Average Pool to 1x1, 3x3 and 5x5, in a single pass over x (see pyramid_avg_pool2d)
 
         squeeze_channels = max(in_channels // reduction, reduction)
         
@@ -36,16 +36,22 @@ class route_func(nn.Module):
                 nn.Conv2d(in_channels, num_experts * in_channels, kernel_size=3, stride=1, groups=in_channels, bias=False)
             )
         
+        self.mode = mode
         self.sigmoid = nn.Sigmoid()
+        # the 3x3 -> 5x5 bicubic upsampling, folded into the first layer (not saved in the state dict)
+        self.register_buffer('upsample', bicubic_upsample_matrix(3, 5), persistent=False)
 
     def forward(self, x):
-        b, _, _, _ = x.size()
-        a1 = self.gap1(x)
-        a3 = F.interpolate(self.gap3(x), 5, mode='bicubic', align_corners=False)
-        a5 = self.gap5(x)
-        a1 = a1.expand_as(a5)
-        attention = torch.cat([a1, a3, a5], dim=1)
-        attention = self.sigmoid(self.dwise_separable(attention))
+        # the first layer of dwise_separable over cat([a1, interpolate(a3), a5]), without building it
+        a1, a3, a5 = pyramid_avg_pool2d(x, [1, 3, 5])
+        if self.mode == 'A':
+            attention = attention_conv1x1(a1, a3, a5, self.dwise_separable[0].weight, self.upsample)
+        else:
+            attention = attention_grouped_conv3x3(a1, a3, a5, self.dwise_separable[0].weight, self.upsample)
+        for i, layer in enumerate(self.dwise_separable):
+            if i > 0:
+                attention = layer(attention)
+        attention = self.sigmoid(at_least_fp32(attention))
         return attention
 
 class DyResConv_Inf(nn.Module):
@@ -61,19 +67,13 @@ class DyResConv_Inf(nn.Module):
         # routing function
         self.routing_func = route_func(in_channels, num_experts, reduction, mode)
         # convs
-        self.convs = nn.Parameter(torch.Tensor(num_experts, out_channels, in_channels, kernel_size, kernel_size))
+        self.convs = nn.Parameter(torch.Tensor(num_experts, out_channels, in_channels // groups, kernel_size, kernel_size))
     
     def forward(self, x):
-        routing_weight = self.routing_func(x) # N x k*C
-        routing_weight = routing_weight.view(-1, self.num_experts, self.out_channels).unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)
-        b, c_in, h, w = x.size()
-        x = x.view(1, -1, h, w)
-        weight = self.convs.unsqueeze(0)
-        combined_weight = (weight * routing_weight).view(b*self.num_experts, self.out_channels, c_in, self.kernel_size, self.kernel_size)
-        combined_weight = torch.sum(combined_weight, dim=0)
-        output = F.conv2d(x, weight=combined_weight,
-                            stride=self.stride, padding=self.padding, groups=self.groups * b)
-        output = output.view(b, self.out_channels, output.size(-2), output.size(-1))
+        routing_weight = self.routing_func(x) # N x k*C_in x 1 x 1
+        combined_weight = aggregate_channel_experts(routing_weight, self.convs, self.groups, routed='in') # N x C_out x C_in x kH x kW
+        output = per_sample_conv2d(x, combined_weight, None, 
+                            stride=self.stride, padding=self.padding, groups=self.groups)
         return output
 
 def test():
@@ -2,13 +2,21 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from convs.functional import at_least_fp32, modulated_expert_conv2d, modulated_expert_outputs, sum_expert_outputs, expert_batch_norm, \
+                             stack_expert_params, fuse_expert_bn, memory_format_like, EXPERT_BACKENDS
+
 __all__ = ['DySepConv'] # Dynamic "Squeeze?" Conv
 
 class DySepConv(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, groups=1, bias=False, reduction=16, mode='A'):
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, groups=1, bias=False, reduction=16, mode='A', backend='fused'):
         super(DySepConv, self).__init__()
         assert mode == 'A' or mode == 'B'
+        assert backend in EXPERT_BACKENDS
         self.mode = mode
+        self.backend = backend
+        self.stride = stride
+        self.padding = padding
+        self.groups = groups
 
         # Number of experts k = 3
         self.k = 3
@@ -52,7 +60,17 @@ class DySepConv(nn.Module):
         b, c, h, w = x.size()
         attention = self.gap5(x) # N x C x 5 x 5
         attention = self.dwise_separable(attention) # N x k*C x 1 x 1
-        attention = self.sigmoid(attention)
+        attention = self.sigmoid(at_least_fp32(attention))
+        if self.backend == 'fused':
+            weight, bias = stack_expert_params([self.one_conv, self.two_conv, self.three_conv])
+            bns = [self.one_bn, self.two_bn, self.three_bn]
+            if not self.one_bn.training and self.one_bn.track_running_stats:
+                weight, bias = fuse_expert_bn(weight, bias, bns)
+                return modulated_expert_conv2d(x, attention, weight, bias,
+                                stride=self.stride, padding=self.padding, groups=self.groups)
+            outputs = modulated_expert_outputs(x, attention, weight, bias,
+                            stride=self.stride, padding=self.padding, groups=self.groups)
+            return memory_format_like(sum_expert_outputs(expert_batch_norm(outputs, bns)), x)
         x1 = x * attention[:, 0:c].expand_as(x)
         y1 = self.one_bn(self.one_conv(x1))
         x2 = x * attention[:, c:2*c].expand_as(x)
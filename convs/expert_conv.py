@@ -0,0 +1,178 @@
+import torch
+import torch.fx
+import torch.nn as nn
+from typing import Optional, Tuple
+
+from convs.functional import modulated_expert_conv2d, routed_expert_conv2d, modulated_expert_outputs, routed_expert_outputs, \
+                             sum_expert_outputs, route_expert_outputs, stacked_batch_norm, fold_expert_bn, memory_format_like
+
+__all__ = ['ExpertConv']
+
+# leaves of torch.fx.symbolic_trace, they read tensor shapes
+torch.fx.wrap('modulated_expert_conv2d')
+torch.fx.wrap('routed_expert_conv2d')
+torch.fx.wrap('modulated_expert_outputs')
+torch.fx.wrap('routed_expert_outputs')
+torch.fx.wrap('sum_expert_outputs')
+torch.fx.wrap('route_expert_outputs')
+torch.fx.wrap('stacked_batch_norm')
+torch.fx.wrap('memory_format_like')
+
+class ExpertConv(nn.Module):
+    '''
+        Base of the layers that keep one Conv2d + BatchNorm2d per expert, in self.convs and self.bns
+        (DyResConv, DDSConv, DyChannel), with the 'fused' backend written to compile with torch.jit.script:
+        the experts are stacked by iterating the ModuleLists, and the batch norms are either folded in
+        (running statistics) or run as a single call whose statistics are written back (training)
+        Subclasses set self.stride, self.padding and self.groups
+    '''
+
+    def expert_params(self) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        # k x C_out x C_in/groups x kH x kW weight and k x C_out bias (or None)
+        weights = []
+        biases = []
+        for conv in self.convs:
+            weights.append(conv.weight)
+            bias = conv.bias
+            if bias is not None:
+                biases.append(bias)
+        if len(biases) == 0:
+            return torch.stack(weights), None
+        return torch.stack(weights), torch.stack(biases)
+
+    def uses_batch_stats(self) -> bool:
+        # the expert batch norms are in the same mode
+        training = self.training
+        track_running_stats = True
+        for bn in self.bns:
+            training = bn.training
+            track_running_stats = bn.track_running_stats
+        return training or not track_running_stats
+
+    def fold_bns(self, weight: torch.Tensor, bias: Optional[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        # the experts with their batch norms folded in, from the running statistics
+        means = []
+        variances = []
+        bn_weights = []
+        bn_biases = []
+        eps = 1e-5
+        for bn in self.bns:
+            running_mean = bn.running_mean
+            running_var = bn.running_var
+            if running_mean is not None and running_var is not None:
+                means.append(running_mean)
+                variances.append(running_var)
+            bn_weight = bn.weight
+            bn_bias = bn.bias
+            if bn_weight is not None and bn_bias is not None:
+                bn_weights.append(bn_weight)
+                bn_biases.append(bn_bias)
+            eps = bn.eps
+        stacked_weight: Optional[torch.Tensor] = None
+        stacked_bias: Optional[torch.Tensor] = None
+        if len(bn_weights) > 0:
+            stacked_weight = torch.stack(bn_weights)
+            stacked_bias = torch.stack(bn_biases)
+        return fold_expert_bn(weight, bias, torch.stack(means), torch.stack(variances), stacked_weight, stacked_bias, eps)
+
+    def expert_batch_norm(self, outputs: torch.Tensor) -> torch.Tensor:
+        # outputs: N x G x k x C_out/G x H x W, normalised with the batch statistics of every expert
+        means = []
+        variances = []
+        bn_weights = []
+        bn_biases = []
+        momentum = 0.0
+        eps = 1e-5
+        track_running_stats = False
+        for bn in self.bns:
+            bn_weight = bn.weight
+            bn_bias = bn.bias
+            if bn_weight is not None and bn_bias is not None:
+                bn_weights.append(bn_weight)
+                bn_biases.append(bn_bias)
+            running_mean = bn.running_mean
+            running_var = bn.running_var
+            if running_mean is not None and running_var is not None:
+                means.append(running_mean)
+                variances.append(running_var)
+            track_running_stats = bn.track_running_stats
+            eps = bn.eps
+            # as nn.BatchNorm2d, momentum None is a cumulative moving average
+            if bn.momentum is not None:
+                momentum = bn.momentum
+            num_batches_tracked = bn.num_batches_tracked
+            if bn.training and track_running_stats and num_batches_tracked is not None:
+                num_batches_tracked.add_(1)
+                if bn.momentum is None:
+                    momentum = 1.0 / float(num_batches_tracked)
+
+        stacked_mean: Optional[torch.Tensor] = None
+        stacked_var: Optional[torch.Tensor] = None
+        if len(means) > 0:
+            stacked_mean = torch.stack(means)
+            stacked_var = torch.stack(variances)
+        stacked_weight: Optional[torch.Tensor] = None
+        stacked_bias: Optional[torch.Tensor] = None
+        if len(bn_weights) > 0:
+            stacked_weight = torch.stack(bn_weights)
+            stacked_bias = torch.stack(bn_biases)
+
+        outputs = stacked_batch_norm(outputs, stacked_mean, stacked_var, stacked_weight, stacked_bias, True, momentum, eps)
+
+        if self.training and track_running_stats and stacked_mean is not None and stacked_var is not None:
+            # stacked_batch_norm updated the stacked copies
+            i = 0
+            for expert_bn in self.bns:
+                running_mean = expert_bn.running_mean
+                running_var = expert_bn.running_var
+                if running_mean is not None and running_var is not None:
+                    running_mean.copy_(stacked_mean[i])
+                    running_var.copy_(stacked_var[i])
+                i += 1
+        return outputs
+
+    def modulated_forward(self, x: torch.Tensor, routing_weight: torch.Tensor) -> torch.Tensor:
+        # sum_i BN_i(conv(x * r_i, W_i) + b_i), r_i modulates the input channels
+        weight, bias = self.expert_params()
+        if not self.uses_batch_stats():
+            weight, folded_bias = self.fold_bns(weight, bias)
+            return modulated_expert_conv2d(x, routing_weight, weight, folded_bias,
+                            stride=self.stride, padding=self.padding, groups=self.groups)
+        # training: every expert needs its own batch statistics, so keep the k outputs apart
+        outputs = modulated_expert_outputs(x, routing_weight, weight, bias,
+                            stride=self.stride, padding=self.padding, groups=self.groups)
+        outputs = self.expert_batch_norm(outputs)
+        return memory_format_like(sum_expert_outputs(outputs), x)
+
+    def routed_forward(self, x: torch.Tensor, routing_weight: torch.Tensor) -> torch.Tensor:
+        # sum_i r_i * BN_i(conv(x, W_i) + b_i), r_i weights the output channels
+        weight, bias = self.expert_params()
+        if not self.uses_batch_stats():
+            weight, folded_bias = self.fold_bns(weight, bias)
+            return routed_expert_conv2d(x, routing_weight, weight, folded_bias,
+                            stride=self.stride, padding=self.padding, groups=self.groups)
+        outputs = routed_expert_outputs(x, weight, bias,
+                            stride=self.stride, padding=self.padding, groups=self.groups)
+        outputs = self.expert_batch_norm(outputs)
+        return memory_format_like(route_expert_outputs(outputs, routing_weight), x)
+
+    @torch.jit.unused
+    def modulated_loop_forward(self, x: torch.Tensor, routing_weight: torch.Tensor) -> torch.Tensor:
+        # the 'loop' backend of modulated_forward, k convs and k batch norms
+        outputs = []
+        for i, (conv, bn) in enumerate(zip(self.convs, self.bns)):
+            c_in = conv.in_channels
+            route = routing_weight[:, i * c_in : (i+1) * c_in]
+            outputs.append(bn(conv(x * route.expand_as(x))))
+        return sum(outputs)
+
+    @torch.jit.unused
+    def routed_loop_forward(self, x: torch.Tensor, routing_weight: torch.Tensor) -> torch.Tensor:
+        # the 'loop' backend of routed_forward
+        outputs = []
+        for i, (conv, bn) in enumerate(zip(self.convs, self.bns)):
+            c_out = conv.out_channels
+            route = routing_weight[:, i * c_out : (i+1) * c_out]
+            out = bn(conv(x))
+            outputs.append(out * route.expand_as(out))
+        return sum(outputs)
@@ -0,0 +1,754 @@
+import torch
+import torch.nn.functional as F
+from typing import List, Optional, Tuple
+
+__all__ = ['per_sample_conv2d', 'per_sample_conv2d_backward', 'dynamic_conv2d', 'topk_dynamic_conv2d', 'lowrank_dynamic_conv2d', 'lowrank_expert_weight', 'expert_conv2d', 'mixed_expert_conv2d', 'select_backend', 'is_onnx_export', 'BACKENDS',
+           'modulate_experts', 'modulated_expert_conv2d', 'routed_expert_conv2d', 'modulated_expert_outputs', 'routed_expert_outputs',
+           'sum_expert_outputs', 'route_expert_outputs', 'stacked_batch_norm', 'expert_batch_norm',
+           'stack_expert_params', 'fuse_expert_bn', 'fold_expert_bn', 'group_major_experts', 'concat_expert_weight', 'aggregate_experts', 'aggregate_channel_experts', 'aggregate_channel_bias', 'EXPERT_BACKENDS', 'is_channels_last', 'memory_format_like', 'at_least_fp32',
+           'weightnet_basis', 'weightnet_coefficients', 'basis_conv2d', 'WEIGHTNET_BACKENDS', 'adaptive_pool_matrix', 'pyramid_avg_pool2d',
+           'bicubic_upsample_matrix', 'attention_conv1x1', 'attention_grouped_conv3x3']
+
+'''
+    Execution backends for convolutions whose kernels differ per sample
+    'grouped': fold the batch into channels and run one grouped conv (groups = groups * N)
+    'bmm'    : unfold the input once and run the per-sample kernels as one batched matmul
+    'mix'    : (expert banks only) run the k experts as static convs over the whole batch and
+               mix their outputs with the routing weights, which is exact since conv is linear
+    'auto'   : pick one of the above from the batch size, the number of experts and the layer shape
+    Under torch.onnx.export every backend is replaced by 'mix' (expert banks) or 'bmm', since 'grouped'
+    bakes the batch size into the groups of the exported conv
+'''
+BACKENDS = ('auto', 'grouped', 'bmm', 'mix')
+
+def _backend_thresholds() -> Tuple[int, int, int]:
+    # Heuristic thresholds for 'auto', re-tune with benchmark_backends.py on new hardware. Literals in a
+    # function, since scripted code cannot read module-level ints
+    bmm_min_batch = 8 # below this the grouped conv has too few groups to be slow
+    bmm_max_unfold_numel = 64 * 1024 * 1024 # 256MB in fp32, the unfolded input is kH*kW times the input
+    mix_min_batch_per_expert = 8 # mixing does k dense convs, so it pays off once N >> k
+    return bmm_min_batch, bmm_max_unfold_numel, mix_min_batch_per_expert
+
+BMM_MIN_BATCH, BMM_MAX_UNFOLD_NUMEL, MIX_MIN_BATCH_PER_EXPERT = _backend_thresholds()
+
+'''
+    Execution backends for layers that keep one Conv2d + BatchNorm2d per expert (DyResConv, DDSConv, ...)
+    'loop' : python loop over the experts, k convs and k batch norms
+    'fused': a single conv over all experts and a single batch norm call
+'''
+EXPERT_BACKENDS = ('loop', 'fused')
+
+'''
+    Execution backends for the WeightNet layers, whose kernels are generated by a grouped 1x1 conv
+    'kernel': generate the N per-sample kernels and run them as one grouped conv
+    'basis' : every generated kernel is a combination of static basis kernels (the generator weights),
+              so run the basis as one static conv and combine its outputs per sample
+'''
+WEIGHTNET_BACKENDS = ('kernel', 'basis')
+
+'''
+    The functions the layers call in forward compile with torch.jit.script: they only take tensors,
+    ints, floats, bools and strings, the module-level helpers (stack_expert_params, fuse_expert_bn,
+    expert_batch_norm) are for python code working on nn.Modules
+'''
+
+def is_channels_last(x: torch.Tensor) -> bool:
+    # N x C x H x W tensor stored NHWC (a 1x1 map is both, and counts as NCHW)
+    return x.dim() == 4 and not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last)
+
+def memory_format_like(output: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+    # a layer returns its output in the memory format of its input
+    if is_channels_last(x):
+        return output.contiguous(memory_format=torch.channels_last)
+    return output
+
+def at_least_fp32(x: torch.Tensor) -> torch.Tensor:
+    # bf16/fp16 -> fp32 for the routing and the aggregations, fp32 and fp64 are kept
+    return x.to(torch.promote_types(x.dtype, torch.float))
+
+@torch.jit.unused
+def _matmul_without_autocast(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    with torch.autocast(device_type=b.device.type, enabled=False):
+        return torch.matmul(at_least_fp32(a), at_least_fp32(b))
+
+def _fp32_matmul(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    # expert aggregations run in at least fp32 under autocast (fp64 stays fp64), the result has the dtype of the expert bank
+    if torch.jit.is_scripting():
+        # scripted modules do not autocast, the inputs already have the dtype they run in
+        return torch.matmul(at_least_fp32(a), at_least_fp32(b)).to(b.dtype)
+    return _matmul_without_autocast(a, b).to(b.dtype)
+
+@torch.jit.unused
+def _in_onnx_export() -> bool:
+    return torch.onnx.is_in_onnx_export()
+
+def is_onnx_export() -> bool:
+    # True while torch.onnx.export traces the model, scripted modules are never exported this way
+    if torch.jit.is_scripting():
+        return False
+    return _in_onnx_export()
+
+def conv2d_output_size(size: int, kernel_size: int, stride: int, padding: int) -> int:
+    return (size + 2 * padding - kernel_size) // stride + 1
+
+def select_backend(x: torch.Tensor, weight: torch.Tensor, stride: int = 1, padding: int = 0, groups: int = 1, num_experts: int = 0) -> str:
+    # x: N x C_in x H x W, weight: ... x kH x kW, num_experts > 0 if the kernels come from an expert bank
+    if is_onnx_export():
+        # keeps the batch dimension of the exported graph dynamic
+        return 'mix' if num_experts > 0 else 'bmm'
+    bmm_min_batch, bmm_max_unfold_numel, mix_min_batch_per_expert = _backend_thresholds()
+    b, c_in, h, w = x.size()
+    kh, kw = weight.size(-2), weight.size(-1)
+    if num_experts > 0 and b >= mix_min_batch_per_expert * num_experts:
+        return 'mix'
+    if num_experts > 0 and b >= bmm_min_batch and is_channels_last(x):
+        # mixing keeps NHWC end to end, the per-sample backends need NCHW copies in and out
+        return 'mix'
+    if b < bmm_min_batch or groups > 1 or x.is_cuda:
+        # cuDNN handles the grouped conv well, and depthwise kernels make the GEMMs degenerate
+        return 'grouped'
+    out_h = conv2d_output_size(h, kh, stride, padding)
+    out_w = conv2d_output_size(w, kw, stride, padding)
+    if b * c_in * kh * kw * out_h * out_w > bmm_max_unfold_numel:
+        return 'grouped'
+    return 'bmm'
+
+def _conv2d(x: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor], stride: int, padding: int, groups: int) -> torch.Tensor:
+    # a frozen None bias typed Optional[Tensor] breaks the MKLDNN pass of torch.jit.optimize_for_inference, leave it out
+    if bias is None:
+        return F.conv2d(x, weight=weight, stride=stride, padding=padding, groups=groups)
+    return F.conv2d(x, weight=weight, bias=bias, stride=stride, padding=padding, groups=groups)
+
+def _conv2d_grouped(x: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor], stride: int, padding: int, groups: int) -> torch.Tensor:
+    b, c_in, h, w = x.size()
+    _, c_out, c_in_g, kh, kw = weight.size()
+    x = x.reshape(1, -1, h, w) # 1 x N*C_in x H x W, a copy for NHWC inputs
+    weight = weight.reshape(-1, c_in_g, kh, kw) # N*C_out x C_in/groups x kH x kW
+    if bias is not None:
+        bias = bias.reshape(-1) # N*C_out
+    output = _conv2d(x, weight, bias, stride, padding, groups * b)
+    output = output.view(b, c_out, output.size(-2), output.size(-1))
+    return output
+
+def _conv2d_bmm(x: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor], stride: int, padding: int, groups: int) -> torch.Tensor:
+    b, c_in, h, w = x.size()
+    _, c_out, c_in_g, kh, kw = weight.size()
+    out_h = conv2d_output_size(h, kh, stride, padding)
+    out_w = conv2d_output_size(w, kw, stride, padding)
+    cols = F.unfold(x, (kh, kw), padding=padding, stride=stride) # N x C_in*kH*kW x L
+    cols = cols.view(b, groups, c_in_g * kh * kw, out_h * out_w) # N x G x C_in/G*kH*kW x L
+    weight = weight.reshape(b, groups, c_out // groups, c_in_g * kh * kw) # N x G x C_out/G x C_in/G*kH*kW
+    output = torch.matmul(weight, cols) # N x G x C_out/G x L
+    output = output.view(b, c_out, out_h, out_w)
+    if bias is not None:
+        output = output + bias.view(b, c_out, 1, 1)
+    return output
+
+def per_sample_conv2d(x: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor] = None, stride: int = 1, padding: int = 0, groups: int = 1,
+                      backend: str = 'auto') -> torch.Tensor:
+    '''
+        x: N x C_in x H x W
+        weight: N x C_out x C_in/groups x kH x kW, one kernel per sample
+        bias: N x C_out or None
+    '''
+    if backend == 'auto' or is_onnx_export():
+        backend = select_backend(x, weight, stride, padding, groups)
+    if backend == 'bmm':
+        output = _conv2d_bmm(x, weight, bias, stride, padding, groups)
+    else:
+        output = _conv2d_grouped(x, weight, bias, stride, padding, groups)
+    return memory_format_like(output, x)
+
+def per_sample_conv2d_backward(x: torch.Tensor, weight: torch.Tensor, grad_output: torch.Tensor, stride: int = 1, padding: int = 0,
+                               groups: int = 1, backend: str = 'grouped', input_grad: bool = True, weight_grad: bool = True):
+    '''
+        Gradients of per_sample_conv2d (without bias) w.r.t. x and the per-sample kernels, computed directly
+        for a backward that does not rerun the conv (see convs.recompute)
+        'grouped': the input and weight gradients of the grouped conv over the folded batch
+        'bmm'    : the transposed batched matmuls, the input gradient is folded back from the unfolded layout
+        returns (N x C_in x H x W or None, N x C_out x C_in/groups x kH x kW or None)
+    '''
+    b, c_in, h, w = x.size()
+    _, c_out, c_in_g, kh, kw = weight.size()
+    out_h, out_w = grad_output.size(-2), grad_output.size(-1)
+    grad_x = grad_weight = None
+    if backend == 'bmm':
+        grad_output = grad_output.reshape(b, groups, c_out // groups, out_h * out_w) # N x G x C_out/G x L
+        if weight_grad:
+            cols = F.unfold(x, (kh, kw), padding=padding, stride=stride).view(b, groups, c_in_g * kh * kw, out_h * out_w)
+            grad_weight = torch.matmul(grad_output, cols.transpose(-1, -2)).view(b, c_out, c_in_g, kh, kw)
+        if input_grad:
+            weight = weight.reshape(b, groups, c_out // groups, c_in_g * kh * kw)
+            grad_cols = torch.matmul(weight.transpose(-1, -2), grad_output) # N x G x C_in/G*kH*kW x L
+            grad_x = F.fold(grad_cols.view(b, c_in * kh * kw, out_h * out_w), (h, w), (kh, kw), padding=padding, stride=stride)
+        return grad_x, grad_weight
+    grad_output = grad_output.reshape(1, b * c_out, out_h, out_w)
+    if weight_grad:
+        grad_weight = torch.nn.grad.conv2d_weight(x.reshape(1, b * c_in, h, w), (b * c_out, c_in_g, kh, kw), grad_output,
+                                                  stride=stride, padding=padding, groups=groups * b).view(b, c_out, c_in_g, kh, kw)
+    if input_grad:
+        grad_x = torch.nn.grad.conv2d_input((1, b * c_in, h, w), weight.reshape(b * c_out, c_in_g, kh, kw), grad_output,
+                                            stride=stride, padding=padding, groups=groups * b).view(b, c_in, h, w)
+    return grad_x, grad_weight
+
+def group_major_experts(weight: torch.Tensor, bias: Optional[torch.Tensor], groups: int) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    # k x C_out x C_in/G x kH x kW -> G*k*C_out/G x C_in/G x kH x kW, a grouped conv needs the output channels of each group to be contiguous
+    k, c_out, c_in_g, kh, kw = weight.size()
+    weight = weight.view(k, groups, c_out // groups, c_in_g, kh, kw).transpose(0, 1)
+    weight = weight.reshape(-1, c_in_g, kh, kw)
+    if bias is not None:
+        bias = bias.view(k, groups, c_out // groups).transpose(0, 1).reshape(-1)
+    return weight, bias
+
+def _expert_conv2d(x: torch.Tensor, weight: torch.Tensor, stride: int, padding: int, groups: int, bias: Optional[torch.Tensor] = None) -> torch.Tensor:
+    # Returns N x G x k x C_out/G x H x W, the layout a grouped conv over the stacked experts produces
+    k, c_out = weight.size(0), weight.size(1)
+    weight, bias = group_major_experts(weight, bias, groups) # G*k*C_out/G x C_in/G x kH x kW
+    output = _conv2d(x, weight, bias, stride, padding, groups)
+    return output.view(x.size(0), groups, k, c_out // groups, output.size(-2), output.size(-1))
+
+def expert_conv2d(x: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor] = None, stride: int = 1, padding: int = 0, groups: int = 1) -> torch.Tensor:
+    '''
+        Runs every expert as a static conv over the whole batch
+        x: N x C_in x H x W
+        weight: k x C_out x C_in/groups x kH x kW
+        bias: k x C_out or None
+        returns N x k x C_out x H' x W'
+    '''
+    b = x.size(0)
+    k, c_out = weight.size(0), weight.size(1)
+    output = _expert_conv2d(x, weight, stride, padding, groups)
+    output = output.transpose(1, 2).reshape(b, k, c_out, output.size(-2), output.size(-1))
+    if bias is not None:
+        output = output + bias.view(1, k, c_out, 1, 1)
+    return output
+
+def mixed_expert_conv2d(x: torch.Tensor, routing_weight: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor] = None,
+                        stride: int = 1, padding: int = 0, groups: int = 1) -> torch.Tensor:
+    '''
+        sum_i r_i * conv(x, W_i) == conv(x, sum_i r_i * W_i), without building per-sample kernels
+        routing_weight: N x k
+    '''
+    b = x.size(0)
+    k, c_out = weight.size(0), weight.size(1)
+    if is_channels_last(x):
+        # mix over the channels of the NHWC output, which stays NHWC
+        weight, _ = group_major_experts(weight, None, groups)
+        outputs = F.conv2d(x, weight=weight, stride=stride, padding=padding, groups=groups)
+        out_h, out_w = outputs.size(-2), outputs.size(-1)
+        outputs = outputs.permute(0, 2, 3, 1).view(b, out_h * out_w * groups, k, c_out // groups) # N x H*W*G x k x C_out/G
+        output = torch.matmul(routing_weight.view(b, 1, 1, k), outputs) # N x H*W*G x 1 x C_out/G
+        output = output.view(b, out_h, out_w, c_out).permute(0, 3, 1, 2)
+        if bias is not None:
+            output = output + _fp32_matmul(routing_weight, bias).view(b, c_out, 1, 1)
+        return output
+
+    outputs = _expert_conv2d(x, weight, stride, padding, groups) # N x G x k x C_out/G x H x W
+    out_h, out_w = outputs.size(-2), outputs.size(-1)
+    outputs = outputs.view(b, groups, k, -1) # N x G x k x C_out/G*H*W
+    output = torch.matmul(routing_weight.view(b, 1, 1, k), outputs) # N x G x 1 x C_out/G*H*W
+    output = output.view(b, c_out, out_h, out_w)
+    if bias is not None:
+        output = output + _fp32_matmul(routing_weight, bias).view(b, c_out, 1, 1)
+    return output
+
+def dynamic_conv2d(x: torch.Tensor, routing_weight: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor] = None,
+                   stride: int = 1, padding: int = 0, groups: int = 1, backend: str = 'auto') -> torch.Tensor:
+    '''
+        Conv with per-sample kernels aggregated from an expert bank
+        x: N x C_in x H x W
+        routing_weight: N x k
+        weight: k x C_out x C_in/groups x kH x kW
+        bias: k x C_out or None
+    '''
+    if backend == 'auto' or is_onnx_export():
+        backend = select_backend(x, weight, stride, padding, groups, num_experts=weight.size(0))
+    if backend == 'mix':
+        return mixed_expert_conv2d(x, routing_weight, weight, bias, stride, padding, groups)
+
+    combined_weight = aggregate_experts(routing_weight, weight)
+    combined_bias: Optional[torch.Tensor] = None
+    if bias is not None:
+        combined_bias = aggregate_experts(routing_weight, bias) # N x C_out
+    return per_sample_conv2d(x, combined_weight, combined_bias, stride, padding, groups, backend)
+
+def topk_dynamic_conv2d(x: torch.Tensor, routing_weight: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor] = None, top_k: int = 1,
+                        stride: int = 1, padding: int = 0, groups: int = 1, backend: str = 'auto', normalize: bool = False) -> torch.Tensor:
+    '''
+        dynamic_conv2d over the top_k highest-weighted experts of every sample only
+        The kernels are gathered with an embedding bag over the selected experts, so the aggregation
+        costs top_k instead of k kernels and the gradients only reach the selected experts
+        normalize: rescale the kept routing weights to sum to 1 (for softmax routing)
+        backend: 'grouped', 'bmm' or 'auto', mixing would run every expert
+    '''
+    b = x.size(0)
+    k, c_out, c_in, kh, kw = weight.size()
+    routing_weight, indices = torch.topk(routing_weight, top_k, dim=1) # N x top_k
+    if normalize:
+        routing_weight = routing_weight / routing_weight.sum(1, keepdim=True)
+    combined_weight = F.embedding_bag(indices, weight.view(k, -1), mode='sum',
+                            per_sample_weights=routing_weight).view(b, c_out, c_in, kh, kw)
+    combined_bias: Optional[torch.Tensor] = None
+    if bias is not None:
+        combined_bias = F.embedding_bag(indices, bias, mode='sum', per_sample_weights=routing_weight) # N x C_out
+    if backend == 'mix':
+        backend = 'auto'
+    return per_sample_conv2d(x, combined_weight, combined_bias, stride, padding, groups, backend)
+
+def lowrank_expert_weight(base: torch.Tensor, expert_u: torch.Tensor, expert_v: torch.Tensor) -> torch.Tensor:
+    '''
+        Dense k x C_out x C_in/groups x kH x kW bank of a low-rank expert bank, W_i = base + U_i V_i
+        base: C_out x C_in/groups x kH x kW
+        expert_u: k x C_out x rank
+        expert_v: k x rank x C_in/groups*kH*kW
+    '''
+    k = expert_u.size(0)
+    c_out, c_in_g, kh, kw = base.size()
+    return base.unsqueeze(0) + torch.bmm(expert_u, expert_v).view(k, c_out, c_in_g, kh, kw)
+
+def lowrank_dynamic_conv2d(x: torch.Tensor, routing_weight: torch.Tensor, base: torch.Tensor, expert_u: torch.Tensor, expert_v: torch.Tensor,
+                           bias: Optional[torch.Tensor] = None, stride: int = 1, padding: int = 0, groups: int = 1, backend: str = 'auto') -> torch.Tensor:
+    '''
+        dynamic_conv2d for a low-rank expert bank (see lowrank_expert_weight)
+        sum_i r_i W_i = (sum_i r_i) base + [r_1 U_1 .. r_k U_k] [V_1; ..; V_k], so the routing only scales
+        the C_out x k*rank factors and the kernels are expanded once
+        'mix' (groups == 1): conv with the base and with the stacked V_i over the whole batch, then a
+        per-sample 1x1 mix with the routed U_i, no per-sample kernels at all
+    '''
+    b = x.size(0)
+    k, c_out, rank = expert_u.size()
+    _, c_in_g, kh, kw = base.size()
+    scale = routing_weight.sum(1).view(b, 1, 1) # weight of the shared base
+    route_u = (expert_u.unsqueeze(0) * routing_weight.view(b, k, 1, 1)).transpose(1, 2).reshape(b, c_out, k * rank) # N x C_out x k*rank
+    expert_v = expert_v.reshape(k * rank, -1) # k*rank x C_in/G*kH*kW
+    combined_bias: Optional[torch.Tensor] = None
+    if bias is not None:
+        combined_bias = _fp32_matmul(routing_weight, bias) # N x C_out
+    if backend == 'auto' or is_onnx_export():
+        bmm_min_batch = _backend_thresholds()[0]
+        backend = 'mix' if groups == 1 and (b >= bmm_min_batch or is_onnx_export()) else 'auto'
+    if backend == 'mix' and groups == 1:
+        output = F.conv2d(x, weight=base, stride=stride, padding=padding) # N x C_out x H x W
+        out_h, out_w = output.size(-2), output.size(-1)
+        z = F.conv2d(x, weight=expert_v.view(k * rank, c_in_g, kh, kw), stride=stride, padding=padding) # N x k*rank x H x W
+        output = output * scale.view(b, 1, 1, 1) + torch.bmm(route_u, z.view(b, k * rank, -1)).view(b, c_out, out_h, out_w)
+        if combined_bias is not None:
+            output = output + combined_bias.view(b, c_out, 1, 1)
+        return memory_format_like(output, x)
+    if backend == 'mix':
+        backend = 'auto'
+
+    combined_weight = _fp32_matmul(route_u, expert_v) + scale * base.view(1, c_out, -1) # N x C_out x C_in/G*kH*kW
+    combined_weight = combined_weight.view(b, c_out, c_in_g, kh, kw)
+    return per_sample_conv2d(x, combined_weight, combined_bias, stride, padding, groups, backend)
+
+def aggregate_experts(routing_weight: torch.Tensor, weight: torch.Tensor) -> torch.Tensor:
+    '''
+        Per-sample tensors from an expert bank routed per expert: W_n = sum_i r_{n,i} * W_i
+        routing_weight: N x k
+        weight: k x ..., e.g. the k x C_out x C_in/groups x kH x kW kernels or the k x C_out biases
+        returns N x ...
+    '''
+    k = weight.size(0)
+    return _fp32_matmul(routing_weight, weight.reshape(k, -1)).view(routing_weight.size()[:1] + weight.size()[1:])
+
+def aggregate_channel_experts(routing_weight: torch.Tensor, weight: torch.Tensor, groups: int = 1, routed: str = 'in') -> torch.Tensor:
+    '''
+        Per-sample kernels from an expert bank routed per channel: W_n = sum_i r_{n,i} * W_i
+        routing_weight: N x k*C (x 1 x 1), expert-major, C = C_in if routed == 'in' else C_out
+        weight: k x C_out x C_in/groups x kH x kW
+        returns N x C_out x C_in/groups x kH x kW
+        The sum over the experts is a batched matmul over the routed channels, so the
+        N x k x C_out x C_in x kH x kW broadcast product is never built
+    '''
+    b = routing_weight.size(0)
+    k, c_out, c_in_g, kh, kw = weight.size()
+    if routed == 'out':
+        route = routing_weight.reshape(b, k, c_out).permute(2, 0, 1) # C_out x N x k
+        experts = weight.view(k, c_out, -1).transpose(0, 1) # C_out x k x C_in/G*kH*kW
+        combined = _fp32_matmul(route, experts) # C_out x N x C_in/G*kH*kW
+        return combined.transpose(0, 1).reshape(b, c_out, c_in_g, kh, kw)
+
+    route = routing_weight.reshape(b, k, groups, c_in_g).permute(2, 3, 0, 1).reshape(groups * c_in_g, b, k) # C_in x N x k
+    experts = weight.view(k, groups, c_out // groups, c_in_g, kh * kw).permute(1, 3, 0, 2, 4)
+    experts = experts.reshape(groups * c_in_g, k, -1) # C_in x k x C_out/G*kH*kW
+    combined = _fp32_matmul(route, experts) # C_in x N x C_out/G*kH*kW
+    combined = combined.view(groups, c_in_g, b, c_out // groups, kh, kw).permute(2, 0, 3, 1, 4, 5)
+    return combined.reshape(b, c_out, c_in_g, kh, kw)
+
+def aggregate_channel_bias(routing_weight: torch.Tensor, bias: torch.Tensor, routed: str = 'in') -> torch.Tensor:
+    '''
+        Per-sample bias of aggregate_channel_experts, N x C_out
+        bias: k x C_out, the biases are summed (routed == 'in', the routing modulates the inputs of the experts)
+        or weighted per output channel (routed == 'out')
+    '''
+    b = routing_weight.size(0)
+    k, c_out = bias.size()
+    if routed == 'out':
+        route = routing_weight.reshape(b, k, c_out)
+        return (at_least_fp32(route) * at_least_fp32(bias)).sum(1).to(bias.dtype)
+    return bias.sum(0).expand(b, c_out)
+
+def stack_expert_params(convs):
+    # k Conv2d -> k x C_out x C_in/groups x kH x kW weight and k x C_out bias (or None)
+    weight = torch.stack([conv.weight for conv in convs])
+    bias = None
+    if convs[0].bias is not None:
+        bias = torch.stack([conv.bias for conv in convs])
+    return weight, bias
+
+def fold_expert_bn(weight: torch.Tensor, bias: Optional[torch.Tensor], running_mean: torch.Tensor, running_var: torch.Tensor,
+                   bn_weight: Optional[torch.Tensor], bn_bias: Optional[torch.Tensor], eps: float) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''
+        BN_i(conv(x, W_i) + b_i) == conv(x, W_i * s_i) + b_i * s_i + t_i with the running statistics
+        weight: k x C_out x C_in/groups x kH x kW, bias: k x C_out or None
+        running_mean, running_var, bn_weight, bn_bias: k x C_out, the stacked statistics and affine parameters
+    '''
+    # BN at inference is affine: bn(y) == y * scale + shift
+    scale = torch.rsqrt(running_var + eps)
+    shift = -running_mean * scale
+    if bn_weight is not None and bn_bias is not None:
+        scale = scale * bn_weight
+        shift = shift * bn_weight + bn_bias
+    weight = weight * scale.view(scale.size(0), scale.size(1), 1, 1, 1)
+    if bias is None:
+        return weight, shift
+    return weight, bias * scale + shift
+
+def fuse_expert_bn(weight, bias, bns):
+    # fold_expert_bn for the k per-expert BatchNorm2d
+    bn = bns[0]
+    bn_weight = bn_bias = None
+    if bn.affine:
+        bn_weight = torch.stack([m.weight for m in bns])
+        bn_bias = torch.stack([m.bias for m in bns])
+    running_mean = torch.stack([m.running_mean for m in bns])
+    running_var = torch.stack([m.running_var for m in bns])
+    return fold_expert_bn(weight, bias, running_mean, running_var, bn_weight, bn_bias, bn.eps)
+
+def _uses_batch_stats(bns):
+    return bns[0].training or not bns[0].track_running_stats
+
+def _stats_group_major(stats: torch.Tensor, groups: int) -> torch.Tensor:
+    # k x C_out -> G*k*C_out/G
+    k = stats.size(0)
+    return stats.view(k, groups, -1).transpose(0, 1).reshape(-1)
+
+def stacked_batch_norm(x: torch.Tensor, running_mean: Optional[torch.Tensor], running_var: Optional[torch.Tensor],
+                       weight: Optional[torch.Tensor], bias: Optional[torch.Tensor], training: bool, momentum: float, eps: float) -> torch.Tensor:
+    '''
+        One batch norm call for k batch norms of C_out channels each
+        x: N x G x k x C_out/G x H x W as produced by a grouped conv over the stacked experts
+        running_mean, running_var, weight, bias: k x C_out or None, the running statistics are updated in place
+    '''
+    b, groups, k, c, h, w = x.size()
+    mean: Optional[torch.Tensor] = None
+    var: Optional[torch.Tensor] = None
+    if running_mean is not None and running_var is not None:
+        # copies (a view for groups == 1), F.batch_norm updates them in place and keeps them for backward
+        mean = _stats_group_major(running_mean, groups).clone()
+        var = _stats_group_major(running_var, groups).clone()
+    if weight is not None:
+        weight = _stats_group_major(weight, groups)
+    if bias is not None:
+        bias = _stats_group_major(bias, groups)
+
+    output = F.batch_norm(x.reshape(b, -1, h, w), mean, var, weight, bias, training, momentum, eps)
+
+    if training and running_mean is not None and running_var is not None and mean is not None and var is not None:
+        # F.batch_norm updated the group-major copies
+        running_mean.copy_(mean.view(groups, k, c).transpose(0, 1).reshape(k, -1))
+        running_var.copy_(var.view(groups, k, c).transpose(0, 1).reshape(k, -1))
+    return output.view(b, groups, k, c, h, w)
+
+def expert_batch_norm(x, bns):
+    '''
+        stacked_batch_norm for the k per-expert BatchNorm2d, the running statistics are written back
+        x: N x G x k x C_out/G x H x W
+    '''
+    bn = bns[0]
+    weight = bias = None
+    if bn.affine:
+        weight = torch.stack([m.weight for m in bns])
+        bias = torch.stack([m.bias for m in bns])
+
+    running_mean = running_var = None
+    exponential_average_factor = 0.0 if bn.momentum is None else bn.momentum
+    if bn.track_running_stats:
+        running_mean = torch.stack([m.running_mean for m in bns])
+        running_var = torch.stack([m.running_var for m in bns])
+        if bn.training:
+            for m in bns:
+                m.num_batches_tracked.add_(1)
+            if bn.momentum is None: # cumulative moving average
+                exponential_average_factor = 1.0 / float(bn.num_batches_tracked)
+
+    output = stacked_batch_norm(x, running_mean, running_var, weight, bias,
+                                _uses_batch_stats(bns), exponential_average_factor, bn.eps)
+
+    if bn.training and bn.track_running_stats:
+        with torch.no_grad():
+            for i, m in enumerate(bns):
+                m.running_mean.copy_(running_mean[i])
+                m.running_var.copy_(running_var[i])
+    return output
+
+def modulate_experts(x: torch.Tensor, routing_weight: torch.Tensor, num_experts: int, groups: int = 1) -> torch.Tensor:
+    '''
+        [x * r_1, ..., x * r_k] concatenated along channels, laid out G x k x C/G for a grouped conv
+        x: N x C x H x W
+        routing_weight: N x k*C (x 1 x 1), expert-major as the routers produce it
+    '''
+    b, c, h, w = x.size()
+    route = routing_weight.view(b, num_experts, groups, c // groups).transpose(1, 2) # N x G x k x C/G
+    if is_channels_last(x):
+        x = x.permute(0, 2, 3, 1).view(b, h, w, groups, 1, c // groups)
+        x = x * route.unsqueeze(1).unsqueeze(1) # N x H x W x G x k x C/G
+        return x.reshape(b, h, w, -1).permute(0, 3, 1, 2)
+    x = x.view(b, groups, 1, c // groups, h, w)
+    x = x * route.unsqueeze(-1).unsqueeze(-1) # N x G x k x C/G x H x W
+    return x.reshape(b, -1, h, w)
+
+def concat_expert_weight(weight: torch.Tensor, groups: int = 1) -> torch.Tensor:
+    # k x C_out x C_in/G x kH x kW -> C_out x k*C_in/G x kH x kW, matching the layout of modulate_experts
+    k, c_out, c_in_g, kh, kw = weight.size()
+    weight = weight.view(k, groups, c_out // groups, c_in_g, kh, kw).permute(1, 2, 0, 3, 4, 5)
+    return weight.reshape(c_out, k * c_in_g, kh, kw)
+
+def modulated_expert_conv2d(x: torch.Tensor, routing_weight: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor] = None,
+                            stride: int = 1, padding: int = 0, groups: int = 1) -> torch.Tensor:
+    '''
+        sum_i conv(x * r_i, W_i) + b_i with a single conv call, r_i modulates the input channels
+        The sum of k convs over the modulated inputs is one conv over their concatenation,
+        per-expert batch norms have to be folded in first (see fold_expert_bn)
+        routing_weight: N x k*C_in (x 1 x 1)
+        weight: k x C_out x C_in/groups x kH x kW, bias: k x C_out or None
+    '''
+    k = weight.size(0)
+    modulated = modulate_experts(x, routing_weight, k, groups) # N x G*k*C_in/G x H x W
+    if bias is not None:
+        bias = bias.sum(0)
+    output = _conv2d(modulated, concat_expert_weight(weight, groups), bias, stride, padding, groups)
+    return memory_format_like(output, x)
+
+def modulated_expert_outputs(x: torch.Tensor, routing_weight: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor] = None,
+                             stride: int = 1, padding: int = 0, groups: int = 1) -> torch.Tensor:
+    '''
+        The k terms conv(x * r_i, W_i) + b_i of modulated_expert_conv2d kept apart, for per-expert batch statistics
+        returns N x G x k x C_out/G x H x W, see stacked_batch_norm and sum_expert_outputs
+    '''
+    b = x.size(0)
+    k, c_out = weight.size(0), weight.size(1)
+    modulated = modulate_experts(x, routing_weight, k, groups) # N x G*k*C_in/G x H x W
+    weight, bias = group_major_experts(weight, bias, groups)
+    output = _conv2d(modulated, weight, bias, stride, padding, groups * k)
+    return output.view(b, groups, k, c_out // groups, output.size(-2), output.size(-1))
+
+def routed_expert_outputs(x: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor] = None,
+                          stride: int = 1, padding: int = 0, groups: int = 1) -> torch.Tensor:
+    # the k terms conv(x, W_i) + b_i, N x G x k x C_out/G x H x W, see route_expert_outputs
+    return _expert_conv2d(x, weight, stride, padding, groups, bias)
+
+def sum_expert_outputs(outputs: torch.Tensor) -> torch.Tensor:
+    # N x G x k x C_out/G x H x W -> N x C_out x H x W
+    b, groups, k, c, h, w = outputs.size()
+    return outputs.sum(2).reshape(b, groups * c, h, w)
+
+def route_expert_outputs(outputs: torch.Tensor, routing_weight: torch.Tensor) -> torch.Tensor:
+    '''
+        sum_i r_i * y_i, r_i weights the output channels
+        outputs: N x G x k x C_out/G x H x W
+        routing_weight: N x k*C_out (x 1 x 1)
+    '''
+    b, groups, k, c, h, w = outputs.size()
+    route = routing_weight.view(b, k, groups, c).transpose(1, 2) # N x G x k x C_out/G
+    output = (outputs * route.unsqueeze(-1).unsqueeze(-1)).sum(2)
+    return output.reshape(b, groups * c, h, w)
+
+def routed_expert_conv2d(x: torch.Tensor, routing_weight: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor] = None,
+                         stride: int = 1, padding: int = 0, groups: int = 1) -> torch.Tensor:
+    '''
+        sum_i r_i * (conv(x, W_i) + b_i) with a single conv call, r_i weights the output channels
+        per-expert batch norms have to be folded in first (see fold_expert_bn)
+        routing_weight: N x k*C_out (x 1 x 1)
+        weight: k x C_out x C_in/groups x kH x kW, bias: k x C_out or None
+    '''
+    output = routed_expert_outputs(x, weight, bias, stride, padding, groups) # N x G x k x C_out/G x H x W
+    return memory_format_like(route_expert_outputs(output, routing_weight), x)
+
+def adaptive_pool_matrix(size: int, output_sizes: List[int], device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    '''
+        sum(output_sizes) x size matrix averaging one axis as adaptive_avg_pool2d does, the bins of every output
+        size stacked: bin i of output size o averages [floor(i * size / o), ceil((i + 1) * size / o))
+    '''
+    starts = []
+    ends = []
+    for output_size in output_sizes:
+        index = torch.arange(output_size, device=device)
+        starts.append(torch.div(index * size, output_size, rounding_mode='floor'))
+        ends.append(torch.div((index + 1) * size + output_size - 1, output_size, rounding_mode='floor'))
+    start = torch.cat(starts).unsqueeze(1)
+    end = torch.cat(ends).unsqueeze(1)
+    position = torch.arange(size, device=device).unsqueeze(0)
+    mask = (position >= start) & (position < end)
+    return mask.to(dtype) / (end - start).to(dtype)
+
+# eager-mode cache of the pooling matrices, keyed by (size, output sizes, device, dtype)
+_POOL_MATRICES = {}
+
+@torch.jit.unused
+def _cached_pool_matrix(size: int, output_sizes: List[int], device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    key = (size, tuple(output_sizes), device, dtype)
+    if key not in _POOL_MATRICES:
+        _POOL_MATRICES[key] = adaptive_pool_matrix(size, output_sizes, device, dtype)
+    return _POOL_MATRICES[key]
+
+def _pool_matrix(size: int, output_sizes: List[int], device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    if torch.jit.is_scripting():
+        return adaptive_pool_matrix(size, output_sizes, device, dtype)
+    return _cached_pool_matrix(size, output_sizes, device, dtype)
+
+@torch.jit.unused
+def _matmul_in_dtype(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    with torch.autocast(device_type=b.device.type, enabled=False):
+        return torch.matmul(a, b)
+
+def _pool_matmul(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    # the pooling keeps the dtype of its input under autocast, as adaptive_avg_pool2d
+    if torch.jit.is_scripting():
+        return torch.matmul(a, b)
+    return _matmul_in_dtype(a, b)
+
+def pyramid_avg_pool2d(x: torch.Tensor, output_sizes: List[int]) -> List[torch.Tensor]:
+    '''
+        [adaptive_avg_pool2d(x, o) for o in output_sizes] from a single read of x: W and H are reduced by the
+        stacked averaging matrices of all the output sizes (S = sum(output_sizes) bins), the pooled maps are
+        the diagonal blocks of the N x C x S x S result. Equal to adaptive_avg_pool2d up to rounding
+    '''
+    h, w = x.size(-2), x.size(-1)
+    pool_h = _pool_matrix(h, output_sizes, x.device, x.dtype) # S x H
+    pool_w = _pool_matrix(w, output_sizes, x.device, x.dtype) # S x W
+    if is_channels_last(x):
+        # N x H x W*C, reduced over H then W with C kept innermost
+        b, c = x.size(0), x.size(1)
+        pooled = _pool_matmul(pool_h, x.permute(0, 2, 3, 1).reshape(b, h, w * c)) # N x S x W*C
+        pooled = _pool_matmul(pool_w, pooled.view(b, -1, w, c)) # N x S x S x C
+        pooled = pooled.permute(0, 3, 1, 2) # N x C x S x S (NHWC)
+    else:
+        pooled = _pool_matmul(x, pool_w.t()) # N x C x H x S
+        pooled = _pool_matmul(pool_h, pooled) # N x C x S x S
+    outputs = []
+    offset = 0
+    for output_size in output_sizes:
+        outputs.append(pooled[:, :, offset : offset + output_size, offset : offset + output_size])
+        offset += output_size
+    return outputs
+
+def bicubic_upsample_matrix(in_size: int, out_size: int) -> torch.Tensor:
+    # in_size^2 x out_size^2 matrix of F.interpolate(mode='bicubic', align_corners=False) on an in_size x in_size map
+    basis = torch.eye(in_size * in_size).view(-1, 1, in_size, in_size)
+    return F.interpolate(basis, out_size, mode='bicubic', align_corners=False).view(in_size * in_size, -1)
+
+'''
+    The first layer of the DyRes A/B routers applied to the pyramid [a1, a3, a5] (N x C x 1x1, 3x3, 5x5) as
+    conv(cat([a1.expand_as(a5), interpolate(a3, 5, 'bicubic'), a5])), without the concatenation or the
+    interpolation: the conv is split over the three inputs, the 1x1 map stays broadcast, and the bicubic
+    upsampling (upsample, 9 x 25, see bicubic_upsample_matrix) is applied to a 3x3 result instead
+'''
+
+def attention_conv1x1(a1: torch.Tensor, a3: torch.Tensor, a5: torch.Tensor, weight: torch.Tensor, upsample: torch.Tensor) -> torch.Tensor:
+    # mode A, weight: S x 3C x 1 x 1, the 1x1 conv commutes with the upsampling
+    b, c = a5.size(0), a5.size(1)
+    w1, w3, w5 = weight[:, :c], weight[:, c : 2 * c], weight[:, 2 * c:]
+    z3 = F.conv2d(a3, w3) # N x S x 3 x 3
+    z3 = torch.matmul(z3.reshape(b, -1, 9), upsample.to(z3.dtype)).view(b, -1, 5, 5)
+    return F.conv2d(a5, w5) + z3 + F.conv2d(a1, w1)
+
+def attention_grouped_conv3x3(a1: torch.Tensor, a3: torch.Tensor, a5: torch.Tensor, weight: torch.Tensor, upsample: torch.Tensor) -> torch.Tensor:
+    # mode B, weight: C x 3 x 3 x 3 (groups = C): input channel j of the 3C concatenated ones is seen by output channel j // 3
+    b, c = a5.size(0), a5.size(1)
+    kernels = weight.reshape(3 * c, 1, 3, 3)
+    # a1 is constant over the 5x5 map, its 3x3 valid conv is a1 times the sum of the kernel
+    r1 = a1 * kernels[:c].sum((1, 2, 3)).view(1, c, 1, 1)
+    # the upsampling folded into the kernels: response of every kernel to the 9 upsampled unit maps
+    responses = F.conv2d(upsample.to(weight.dtype).view(9, 1, 5, 5), kernels[c : 2 * c]) # 9 x C x 3 x 3
+    r3 = torch.einsum('ncq,qcp->ncp', a3.reshape(b, c, 9), responses.reshape(9, c, 9)).view(b, c, 3, 3)
+    r5 = F.conv2d(a5, kernels[2 * c:], groups=c)
+    # the 3 inputs of a group can come from different maps, so the 3x3 responses are summed by triplets
+    responses = torch.cat([r1.expand(b, c, 3, 3), r3, r5], dim=1)
+    return responses.view(b, c, 3, 3, 3).sum(2)
+
+def weightnet_basis(fc, out_channels, kernel_size, groups):
+    '''
+        Basis kernels of a WeightNet kernel generator: fc is a 1x1 conv with groups * C_out groups, each
+        mapping M/groups activations to a 1/groups slice of the kernel of one output channel
+        fc.bias is appended as one more basis kernel, whose coefficient is always 1
+        returns groups*C_out*B x C_in/groups x kH x kW, B = M/groups (+ 1), ordered group-major
+    '''
+    basis = fc.weight.view(out_channels, groups, -1, fc.weight.size(1)) # C_out x G x C_in/G*kH*kW x M/G
+    if fc.bias is not None:
+        basis = torch.cat([basis, fc.bias.view(out_channels, groups, -1, 1)], dim=3)
+    basis = basis.permute(1, 0, 3, 2) # G x C_out x B x C_in/G*kH*kW
+    return basis.reshape(-1, basis.size(-1) // (kernel_size * kernel_size), kernel_size, kernel_size)
+
+def weightnet_coefficients(activation, out_channels, groups, bias=True):
+    '''
+        Per-sample coefficients of the basis kernels of weightnet_basis
+        activation: N x M*C_out (x 1 x 1), the input of the kernel generator
+        returns N x G x C_out x B
+    '''
+    b = activation.size(0)
+    coefficient = activation.reshape(b, out_channels, groups, -1) # N x C_out x G x M/G
+    if bias:
+        coefficient = torch.cat([coefficient, coefficient.new_ones(b, out_channels, groups, 1)], dim=3)
+    return coefficient.transpose(1, 2)
+
+def basis_conv2d(x, coefficient, basis, stride=1, padding=0, groups=1):
+    '''
+        Static conv with a bank of basis kernels, followed by a per-sample combination of its outputs
+        coefficient: N x groups x P x B
+        basis: groups*P*B x C_in/groups x kH x kW
+        returns N x groups x P x H x W
+    '''
+    b, g, p, n_basis = coefficient.size()
+    output = F.conv2d(x, weight=basis, stride=stride, padding=padding, groups=groups)
+    h, w = output.size(-2), output.size(-1)
+    output = output.view(b, g, p, n_basis, h * w)
+    output = torch.matmul(coefficient.unsqueeze(-2), output) # N x groups x P x 1 x H*W
+    return output.view(b, g, p, h, w) # NCHW, see memory_format_like
+
+def test():
+    x = torch.randn(16, 32, 16, 16)
+    weight = torch.randn(16, 64, 8, 3, 3)
+    bias = torch.randn(16, 64)
+    for groups in [1, 4]:
+        w = weight if groups == 4 else torch.randn(16, 64, 32, 3, 3)
+        y1 = per_sample_conv2d(x, w, bias, stride=2, padding=1, groups=groups, backend='grouped')
+        y2 = per_sample_conv2d(x, w, bias, stride=2, padding=1, groups=groups, backend='bmm')
+        print(y1.size(), (y1 - y2).abs().max().item())
+
+    routing_weight = torch.rand(16, 3)
+    for groups in [1, 32]:
+        w = torch.randn(3, 64, 32 // groups, 3, 3)
+        b = torch.randn(3, 64)
+        y1 = dynamic_conv2d(x, routing_weight, w, b, stride=1, padding=1, groups=groups, backend='grouped')
+        y2 = dynamic_conv2d(x, routing_weight, w, b, stride=1, padding=1, groups=groups, backend='mix')
+        print(y1.size(), (y1 - y2).abs().max().item())
+
+    # the pyramid pooling matches adaptive_avg_pool2d, NCHW and NHWC
+    for size in [32, 17, 8, 4]:
+        x = torch.randn(4, 8, size, size)
+        for memory_format in [torch.contiguous_format, torch.channels_last]:
+            pooled = pyramid_avg_pool2d(x.contiguous(memory_format=memory_format), [1, 3, 5])
+            print(size, [(p - F.adaptive_avg_pool2d(x, o)).abs().max().item() for p, o in zip(pooled, [1, 3, 5])])
+
+    # the folded router layers match the concatenation of the interpolated pyramid
+    a1, a3, a5 = pyramid_avg_pool2d(torch.randn(4, 16, 32, 32), [1, 3, 5])
+    attention = torch.cat([a1.expand_as(a5), F.interpolate(a3, 5, mode='bicubic', align_corners=False), a5], dim=1)
+    upsample = bicubic_upsample_matrix(3, 5)
+    weight = torch.randn(8, 48, 1, 1)
+    print((attention_conv1x1(a1, a3, a5, weight, upsample) - F.conv2d(attention, weight)).abs().max().item())
+    weight = torch.randn(16, 3, 3, 3)
+    print((attention_grouped_conv3x3(a1, a3, a5, weight, upsample) - F.conv2d(attention, weight, groups=16)).abs().max().item())
+
+# test()
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from convs.functional import at_least_fp32, per_sample_conv2d, weightnet_basis, weightnet_coefficients, basis_conv2d, memory_format_like, WEIGHTNET_BACKENDS
+
 __all__ = ['GC_WeightNet']
 
 class GC_Attention(nn.Module):
@@ -42,8 +44,10 @@ class GC_Attention(nn.Module):
         return out
 
 class GC_WeightNet(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, reduction=16, M=2, G=2, normalized=False):
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, reduction=16, M=2, G=2, normalized=False, backend='basis'):
         super().__init__()
+        assert backend in WEIGHTNET_BACKENDS
+        self.backend = backend
 
         self.M = M
         self.G = G
@@ -63,19 +67,22 @@ class GC_WeightNet(nn.Module):
         b, _, _, _ = x.size()
 
         x_w = self.gc_att(x) # N x M(C_out) x 1 x 1
-        x_w = self.sigmoid(x_w)
+        x_w = self.sigmoid(at_least_fp32(x_w))
+        if self.backend == 'basis':
+            coefficient = weightnet_coefficients(x_w, self.out_channels, self.G, self.fc.bias is not None) # N x G x C_out x M/G+1
+            basis = weightnet_basis(self.fc, self.out_channels, self.kernel_size, self.G)
+            output = basis_conv2d(x, coefficient, basis, stride=self.stride, padding=self.padding, groups=self.G) # N x G x C_out x H x W
+            return memory_format_like(output.sum(1), x)
         x_w = self.fc(x_w) # N x (C_out)(C_in)(kH)(kW) x 1 x 1
-
-        x = x.view(1, -1, x.size(2), x.size(3)) # 1 x N(C_in) x H x W
-        x_w = x_w.view(-1, self.in_channels, self.kernel_size, self.kernel_size) # (C_out)(N) x C_in x kH, kW
-        x = F.conv2d(x, weight=x_w, stride=self.stride, padding=self.padding, groups=b)
-        x = x.view(-1, self.out_channels, x.size(2), x.size(3)) # N x C_out x H x W
-        return x
+        x_w = x_w.view(b, self.out_channels, self.in_channels, self.kernel_size, self.kernel_size)
+        return per_sample_conv2d(x, x_w, None, stride=self.stride, padding=self.padding)
 
 def test():
     x = torch.randn(64, 128, 32, 32)
     gcwn = GC_WeightNet(128, 128, 3)
     y = gcwn(x)
     print(y.size())
+    gcwn.backend = 'kernel'
+    print((gcwn(x) - y).abs().max().item())
 
 # test()
\ No newline at end of file
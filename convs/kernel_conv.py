@@ -1,10 +1,16 @@
 import torch
+import torch.fx
 import torch.nn as nn
 import torch.nn.functional as F
 import math
 
+from convs.functional import per_sample_conv2d
+
 __all__ = ['Kernel_Conv']
 
+# leaf of torch.fx.symbolic_trace, it reads tensor shapes
+torch.fx.wrap('per_sample_conv2d')
+
 class Kernel_Conv(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, groups=1):
         super().__init__()
@@ -26,18 +32,9 @@ class Kernel_Conv(nn.Module):
         avg = self.avgpool(x)
         att = self.conv_att(avg)
         att = self.sigmoid(att) # N x C_out*C_in x kH x kW
-        att = att.view(-1, self.in_channels, self.kernel_size, self.kernel_size)
-        print(att.shape)
-
-        weight = self.weight
-        weight = weight.view(-1, self.in_channels, self.kernel_size, self.kernel_size)
-        print(weight.shape)
-        b, _, h, w = x.size()
-        x = x.view(1, -1, h, w)
-        output = F.conv2d(x, weight=weight * att, bias=None,
-                            stride=self.stride, padding=self.padding, groups=self.groups * b)
-        output = output.view(b, self.out_channels, output.size(-2), output.size(-1))
-        return output
+        att = att.view(-1, self.out_channels, self.in_channels, self.kernel_size, self.kernel_size)
+        weight = self.weight.unsqueeze(0) * att # N x C_out x C_in/groups x kH x kW
+        return per_sample_conv2d(x, weight, None, stride=self.stride, padding=self.padding, groups=self.groups)
 
 def test():
     x = torch.randn(4, 16 , 32, 32)
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from convs.functional import per_sample_conv2d
+
 __all__ = ['NLCWNNet', 'NLCWNNet_DW']
 
 class NLC_Attention(nn.Module):
@@ -47,11 +49,8 @@ class NLCWNNet(nn.Module):
         b, c_in, h, w = x.size()
         att = self.gc_att(x)
         att = self.sigmoid(att).view(b, -1, 1).unsqueeze(-1)
-        weight = self.fc(att).view(-1, c_in, self.kernel_size, self.kernel_size)
-        x = x.view(1, -1, h, w)
-        out = F.conv2d(x, weight, stride=self.stride, padding=self.padding, groups=b)
-        out = out.view(-1, self.out_channels, out.size(2), out.size(3))
-        return out
+        weight = self.fc(att).view(b, self.out_channels, c_in, self.kernel_size, self.kernel_size)
+        return per_sample_conv2d(x, weight, None, stride=self.stride, padding=self.padding)
 
 # Depthwise Model for MobileNetV2 in our experiments
 class NLCWNNet_DW(nn.Module):
@@ -74,11 +73,8 @@ class NLCWNNet_DW(nn.Module):
         b, c_in, h, w = x.size()
         att = self.gc_att(x)
         att = self.sigmoid(att).view(b, -1, 1).unsqueeze(-1)
-        weight = self.fc(att).view(-1, 1, self.kernel_size, self.kernel_size)
-        x = x.view(1, -1, h, w)
-        out = F.conv2d(x, weight, stride=self.stride, padding=self.padding, groups=self.channels * b)
-        out = out.view(-1, self.channels, out.size(2), out.size(3))
-        return out
+        weight = self.fc(att).view(b, self.channels, 1, self.kernel_size, self.kernel_size)
+        return per_sample_conv2d(x, weight, None, stride=self.stride, padding=self.padding, groups=self.channels)
 
 def test():
     x = torch.randn(64, 128, 32, 32)
@@ -0,0 +1,218 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.nn.quantized as nnq
+from torch.quantization import MinMaxObserver, PerChannelMinMaxObserver, quantize_dynamic
+
+from convs.functional import stack_expert_params, fuse_expert_bn, group_major_experts, concat_expert_weight, \
+                             modulate_experts, route_expert_outputs
+from convs.condconv import CondConv
+from convs.dyconv import DyConv
+from convs.dyres_conv import DyResConv
+from convs.ddsnet import DDSConv
+from convs.shared_routing import SharedRouting
+
+__all__ = ['QuantExpertConv', 'calibrate', 'convert_to_int8']
+
+'''
+    Post-training int8 quantization of the dynamic layers (CPU, fbgemm or qnnpack). Every layer keeps its
+    routing (fp32, or dynamically quantized int8 linears) and runs its experts as one static int8 conv:
+    mode 'mix': CondConv / DyConv, the k experts over x, mixed per sample with the routing (see mixed_expert_conv2d),
+               with top_k the routing weights outside the top_k of every sample are zeroed (see topk_dynamic_conv2d)
+    mode 'in' : DyResConv / DDSConv('in'), the experts concatenated over the modulated copies of x
+    mode 'out': DDSConv('out'), the k experts over x, weighted per output channel
+    The expert banks are quantized per output channel and the batch norms are folded in first.
+    The conv input and output ranges are calibrated with observers (see calibrate), the rest of the
+    network stays fp32
+'''
+
+def _is_quantizable(module):
+    if isinstance(module, (DyResConv, DDSConv)):
+        return not module.deploy
+    return isinstance(module, (CondConv, DyConv))
+
+def _int8_conv_params(module):
+    '''
+        (mode, weight, bias, groups) of the static conv that runs the experts of module, followed by
+        the k x C_out bias mixed by the routing after it (mode 'mix' only, else None)
+    '''
+    if isinstance(module, (CondConv, DyConv)):
+        weight, _ = group_major_experts(module.expert_weight(), None, module.groups)
+        return 'mix', weight, None, module.groups, module.bias
+    weight, bias = stack_expert_params(module.convs)
+    weight, bias = fuse_expert_bn(weight, bias, module.bns)
+    if isinstance(module, DDSConv) and module.mode == 'out':
+        weight, bias = group_major_experts(weight, bias, module.groups)
+        return 'out', weight, bias, module.groups, None
+    return 'in', concat_expert_weight(weight, module.groups), bias.sum(0), module.groups, None
+
+def _routing(module, inputs):
+    # the routing of module for its forward inputs, passed by the block under shared routing
+    if module.routing_func is None:
+        return inputs[1]
+    return module.routing_func(inputs[0])
+
+def _int8_conv_input(module, mode, inputs):
+    if mode == 'in':
+        return modulate_experts(inputs[0], _routing(module, inputs), module.num_experts, module.groups)
+    return inputs[0]
+
+class QuantExpertConv(nn.Module):
+    def __init__(self, routing_func, conv, num_experts, groups=1, mode='mix', bias=None, input_scale=1.0, input_zero_point=0,
+                 top_k=None, normalize=False):
+        super().__init__()
+        assert mode in ('mix', 'in', 'out')
+        assert top_k is None or mode == 'mix'
+        self.mode = mode
+        self.num_experts = num_experts
+        self.groups = groups
+        # None mixes all the experts, normalize rescales the kept routing weights to sum to 1 (DyConv)
+        self.top_k = top_k
+        self.normalize = normalize
+        self.input_scale = input_scale
+        self.input_zero_point = input_zero_point
+
+        # routing function, None if the block computes the routing (see convs.shared_routing)
+        self.routing_func = routing_func
+        # experts, an int8 nn.quantized.Conv2d
+        self.conv = conv
+        # k x C_out, mixed by the routing after the conv (mode 'mix')
+        self.register_buffer('bias', bias)
+
+    def forward(self, x, routing_weight=None):
+        if routing_weight is None:
+            routing_weight = self.routing_func(x)
+        if self.top_k is not None:
+            routing_weight = self.topk_routing(routing_weight)
+        b = x.size(0)
+        if self.mode == 'in':
+            x = modulate_experts(x, routing_weight, self.num_experts, self.groups) # N x G*k*C_in/G x H x W
+        x = torch.quantize_per_tensor(x.float(), self.input_scale, self.input_zero_point, torch.quint8)
+        # the int8 conv returns NHWC
+        outputs = self.conv(x).dequantize().contiguous()
+        if self.mode == 'in':
+            return outputs
+        h, w = outputs.size(-2), outputs.size(-1)
+        outputs = outputs.view(b, self.groups, self.num_experts, -1, h, w) # N x G x k x C_out/G x H x W
+        if self.mode == 'out':
+            return route_expert_outputs(outputs, routing_weight)
+        output = torch.matmul(routing_weight.view(b, 1, 1, self.num_experts), outputs.view(b, self.groups, self.num_experts, -1))
+        output = output.view(b, -1, h, w)
+        if self.bias is not None:
+            output = output + torch.mm(routing_weight, self.bias).view(b, -1, 1, 1)
+        return output
+
+    def topk_routing(self, routing_weight):
+        # N x k routing with zeros outside the top_k experts of every sample, mixing them is exact
+        values, indices = torch.topk(routing_weight, self.top_k, dim=1)
+        if self.normalize:
+            values = values / values.sum(1, keepdim=True)
+        return torch.zeros_like(routing_weight).scatter(1, indices, values)
+
+def calibrate(net, dataloader, device, num_batches=None):
+    '''
+        Runs net over (at most num_batches of) dataloader in eval mode and returns
+        {layer name: (input observer, output observer)} of the int8 conv of every CondConv, DyConv, DyResConv
+        and DDSConv, keyed by name so that they also apply to a copy of net
+    '''
+    observers = {}
+
+    def hook(layer):
+        def observe(module, inputs, output):
+            input_observer, output_observer = observers[layer]
+            mode, weight, bias, groups, _ = _int8_conv_params(module)
+            x = _int8_conv_input(module, mode, inputs)
+            input_observer(x.float())
+            output_observer(F.conv2d(x, weight=weight, bias=bias, stride=module.stride, padding=module.padding, groups=groups).float())
+        return observe
+
+    handles = []
+    for name, module in net.named_modules():
+        if _is_quantizable(module):
+            # fbgemm needs a 7-bit input range to avoid overflows in its int16 accumulation
+            observers[name] = (MinMaxObserver(dtype=torch.quint8, reduce_range=True), MinMaxObserver(dtype=torch.quint8))
+            handles.append(module.register_forward_hook(hook(name)))
+    net.eval()
+    with torch.no_grad():
+        for i, (images, _) in enumerate(dataloader):
+            if num_batches is not None and i >= num_batches:
+                break
+            net(images.to(device))
+    for handle in handles:
+        handle.remove()
+    return observers
+
+def _int8_routing(routing_func, routing):
+    if routing == 'int8':
+        # the linear routers (CondConv, DyConv) run as int8 linears, the conv routers stay fp32
+        routing_func = quantize_dynamic(routing_func, {nn.Linear}, dtype=torch.qint8)
+    return routing_func
+
+def _int8_layer(module, input_observer, output_observer, routing):
+    with torch.no_grad():
+        mode, weight, bias, groups, mixed_bias = _int8_conv_params(module)
+    weight = weight.detach().float().cpu()
+    weight_observer = PerChannelMinMaxObserver(ch_axis=0, dtype=torch.qint8, qscheme=torch.per_channel_symmetric)
+    weight_observer(weight)
+    scales, zero_points = weight_observer.calculate_qparams()
+    weight = torch.quantize_per_channel(weight, scales.double(), zero_points.long(), 0, torch.qint8)
+
+    out_channels, in_channels_g, kh, kw = weight.size()
+    conv = nnq.Conv2d(in_channels_g * groups, out_channels, (kh, kw), stride=module.stride, padding=module.padding, groups=groups)
+    conv.set_weight_bias(weight, None if bias is None else bias.detach().float().cpu())
+    scale, zero_point = output_observer.calculate_qparams()
+    conv.scale = float(scale)
+    conv.zero_point = int(zero_point)
+
+    routing_func = module.routing_func
+    if routing_func is not None:
+        routing_func = _int8_routing(routing_func.cpu(), routing)
+    if mixed_bias is not None:
+        mixed_bias = mixed_bias.detach().float().cpu()
+    # CondConv / DyConv keep their top_k selection, DyConv renormalises the kept weights
+    top_k = module.top_k if mode == 'mix' else None
+    scale, zero_point = input_observer.calculate_qparams()
+    return QuantExpertConv(routing_func, conv, module.num_experts, groups, mode, mixed_bias,
+                           input_scale=float(scale), input_zero_point=int(zero_point),
+                           top_k=top_k, normalize=isinstance(module, DyConv)).eval()
+
+def _convert(module, observers, routing, prefix=''):
+    for name, child in module.named_children():
+        if prefix + name in observers:
+            setattr(module, name, _int8_layer(child, *observers[prefix + name], routing))
+        elif isinstance(child, SharedRouting):
+            child.routing_func = _int8_routing(child.routing_func, routing)
+        else:
+            _convert(child, observers, routing, prefix + name + '.')
+
+def convert_to_int8(net, observers, routing='fp32'):
+    '''
+        Replaces every layer of observers (from calibrate) with a QuantExpertConv, in place.
+        routing: 'fp32' or 'int8'. The network is moved to the CPU and put in eval mode.
+    '''
+    assert routing == 'fp32' or routing == 'int8'
+    net.cpu().eval()
+    _convert(net, observers, routing)
+    return net
+
+def test():
+    from cifar.cc_resnet import CC_ResNet18
+    from cifar.dds_mobilenetv2 import DDS_MobileNetV2
+    for net in [CC_ResNet18(), DDS_MobileNetV2(mode='out')]:
+        x = torch.randn(8, 3, 32, 32)
+        observers = calibrate(net, [(x, None)], torch.device('cpu'))
+        with torch.no_grad():
+            reference = net(x)
+            convert_to_int8(net, observers)
+            print(len(observers), (net(x) - reference).abs().max().item(), reference.abs().max().item())
+    # top_k layers
+    for conv in [CondConv, DyConv]:
+        net = nn.Sequential(conv(16, 32, 3, padding=1, num_experts=4, top_k=2))
+        x = torch.randn(8, 16, 16, 16)
+        observers = calibrate(net, [(x, None)], torch.device('cpu'))
+        with torch.no_grad():
+            reference = net(x)
+            convert_to_int8(net, observers)
+            print(conv.__name__, (net(x) - reference).abs().max().item(), reference.abs().max().item())
+
+# test()
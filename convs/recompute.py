@@ -0,0 +1,116 @@
+import torch
+from torch.autograd.function import once_differentiable
+from typing import Optional
+
+from convs.functional import aggregate_experts, aggregate_channel_experts, per_sample_conv2d, per_sample_conv2d_backward, \
+                             mixed_expert_conv2d, select_backend
+
+__all__ = ['recomputed_dynamic_conv2d', 'ROUTINGS']
+
+'''
+    Expert aggregation fused with the per-sample conv: autograd would keep the N x C_out x C_in/groups x kH x kW
+    combined kernels of every layer until its backward, which dominates the memory of layer3/layer4. The fused
+    function saves the input, the routing weights and the expert bank only. Its backward does not rerun the conv:
+    it rebuilds the combined kernels (needed by the input gradient), computes the input and kernel gradients of the
+    per-sample conv directly (see per_sample_conv2d_backward), and backpropagates d(combined) through the
+    aggregation only, d(bank) = routing^T d(combined) and d(routing) = d(combined) bank^T. The conv FLOPs are those
+    of autograd, plus one aggregation per step. The routing weights select the experts
+    'expert' : N x k, one weight per expert (CondConv, DyConv)
+    'in'     : N x k*C_in, expert-major, one weight per expert and input channel (RouterConv)
+    'out'    : N x k*C_out, one weight per expert and output channel
+'''
+ROUTINGS = ('expert', 'in', 'out')
+
+def _aggregate(routing_weight, weight, groups, routing):
+    if routing == 'expert':
+        return aggregate_experts(routing_weight, weight)
+    return aggregate_channel_experts(routing_weight, weight, groups, routed=routing)
+
+class _RecomputedExpertConv(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, routing_weight, weight, stride, padding, groups, routing, backend):
+        combined_weight = _aggregate(routing_weight, weight, groups, routing)
+        output = per_sample_conv2d(x, combined_weight, None, stride, padding, groups, backend)
+        ctx.save_for_backward(x, routing_weight, weight)
+        ctx.conv_args = (stride, padding, groups, routing, backend)
+        # the dtype the conv ran in, bfloat16 under autocast
+        ctx.dtype = output.dtype
+        return output
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        stride, padding, groups, routing, backend = ctx.conv_args
+        x, routing_weight, weight = ctx.saved_tensors
+        needs_x, needs_routing, needs_weight = ctx.needs_input_grad[:3]
+        grad_x = grad_routing = grad_weight = None
+        # the backward does not run under the forward's autocast, the casts are explicit
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            with torch.enable_grad():
+                routing_weight = routing_weight.detach().requires_grad_(needs_routing)
+                weight = weight.detach().requires_grad_(needs_weight)
+                combined_weight = _aggregate(routing_weight, weight, groups, routing)
+            grad_x, grad_combined = per_sample_conv2d_backward(x.to(ctx.dtype), combined_weight.detach().to(ctx.dtype),
+                            grad_output.to(ctx.dtype), stride, padding, groups, backend,
+                            input_grad=needs_x, weight_grad=needs_routing or needs_weight)
+            if grad_combined is not None:
+                inputs = [t for t, needs in [(routing_weight, needs_routing), (weight, needs_weight)] if needs]
+                grads = iter(torch.autograd.grad(combined_weight, inputs, grad_combined.to(combined_weight.dtype)))
+                grad_routing = next(grads) if needs_routing else None
+                grad_weight = next(grads) if needs_weight else None
+        if grad_x is not None:
+            grad_x = grad_x.to(x.dtype)
+        return (grad_x, grad_routing, grad_weight) + (None,) * 5
+
+def recomputed_dynamic_conv2d(x: torch.Tensor, routing_weight: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor] = None,
+                              stride: int = 1, padding: int = 0, groups: int = 1, backend: str = 'auto', routing: str = 'expert') -> torch.Tensor:
+    '''
+        dynamic_conv2d (routing 'expert') or the per-sample conv of aggregate_channel_experts (routing 'in' or
+        'out') that does not keep the combined kernels for backward, eager only
+        weight: k x C_out x C_in/groups x kH x kW
+        bias: C_out, or k x C_out for routing 'expert', or None
+    '''
+    assert routing in ROUTINGS
+    num_experts = weight.size(0) if routing == 'expert' else 0
+    if backend == 'auto':
+        backend = select_backend(x, weight, stride, padding, groups, num_experts=num_experts)
+    if backend == 'mix':
+        # no per-sample kernels to rebuild
+        assert routing == 'expert', "'mix' needs one routing weight per expert"
+        return mixed_expert_conv2d(x, routing_weight, weight, bias, stride, padding, groups)
+    output = _RecomputedExpertConv.apply(x, routing_weight, weight, stride, padding, groups, routing, backend)
+    if bias is not None:
+        if routing == 'expert':
+            bias = aggregate_experts(routing_weight, bias) # N x C_out
+        output = output + bias.to(output.dtype).view(-1, output.size(1), 1, 1)
+    return output
+
+def test():
+    from convs.functional import dynamic_conv2d
+    from convs.dyconv import DyConv
+    from convs.router import RouterConv
+    x = torch.randn(4, 8, 6, 6, dtype=torch.double, requires_grad=True)
+    weight = torch.randn(3, 16, 4, 3, 3, dtype=torch.double, requires_grad=True)
+    routing_weight = torch.rand(4, 3, dtype=torch.double, requires_grad=True)
+    channel_routing = torch.rand(4, 3 * 8, dtype=torch.double, requires_grad=True)
+    output_routing = torch.rand(4, 3 * 16, dtype=torch.double, requires_grad=True)
+    for backend in ['grouped', 'bmm']:
+        # against the layers' autograd
+        output = recomputed_dynamic_conv2d(x, routing_weight, weight, stride=2, padding=1, groups=2, backend=backend)
+        reference = dynamic_conv2d(x, routing_weight, weight, stride=2, padding=1, groups=2, backend=backend)
+        print(backend, (output - reference).abs().max().item())
+        print(torch.autograd.gradcheck(lambda x, r, w: recomputed_dynamic_conv2d(x, r, w, stride=2, padding=1, groups=2, backend=backend),
+                                       (x, routing_weight, weight)))
+        print(torch.autograd.gradcheck(lambda x, r, w: recomputed_dynamic_conv2d(x, r, w, padding=1, groups=2, backend=backend, routing='in'),
+                                       (x, channel_routing, weight)))
+        print(torch.autograd.gradcheck(lambda x, r, w: recomputed_dynamic_conv2d(x, r, w, stride=2, groups=2, backend=backend, routing='out'),
+                                       (x, output_routing, weight)))
+    # the layers with and without recompute, same output and gradients
+    for conv in [DyConv, RouterConv]:
+        layers = [conv(8, 16, 3, padding=1, recompute=recompute).double() for recompute in [False, True]]
+        layers[1].load_state_dict(layers[0].state_dict())
+        outputs = [layer(x) for layer in layers]
+        grads = [torch.autograd.grad(output.sum(), [x] + list(layer.parameters())) for output, layer in zip(outputs, layers)]
+        print(conv.__name__, (outputs[0] - outputs[1]).abs().max().item(), max((a - b).abs().max().item() for a, b in zip(*grads)))
+
+# test()
@@ -3,6 +3,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import math
 
+from convs.functional import at_least_fp32, aggregate_channel_experts, per_sample_conv2d
+from convs.recompute import recomputed_dynamic_conv2d
+
 __all__ = ['RouterConv']
 
 class route_func(nn.Module):
@@ -23,21 +26,22 @@ class route_func(nn.Module):
         # [n, in_channels]
         channel_weight = self.channel_extractor(gap)
         # [n, pool_size*pool_size]
-        channel_pool = (self.adp_pool(x)).mean(dim=1,keepdim=False).view(x.shape[0],-1)
+        channel_pool = (self.adp_pool(x)).mean(dim=1,keepdim=False).reshape(x.shape[0],-1)
         expert_weight = self.expert_extractor(channel_pool)
         # [n, in_channel, experts]
         general = channel_weight.unsqueeze(1)*expert_weight.unsqueeze(-1)
-        general = torch.sigmoid(general)
+        general = torch.sigmoid(at_least_fp32(general))
         return general
 
 class RouterConv(nn.Module):
 
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, groups=1, num_experts=3, reduction=16, spatial=4):
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, groups=1, num_experts=3, reduction=16, spatial=4, recompute=False):
         super().__init__()
 
         self.stride = stride
         self.padding = padding
         self.groups = groups
+        self.recompute = recompute # rebuild the combined kernels in backward instead of keeping them (training only)
 
         # routing function
         self.routing_func = route_func(in_channels, num_experts, reduction, spatial)
@@ -49,18 +53,12 @@ class RouterConv(nn.Module):
 
     def forward(self, x):
         routing_weight = self.routing_func(x) # N x k x C_in
-        routing_weight = routing_weight.unsqueeze(dim=2).unsqueeze(dim=-1).unsqueeze(dim=-1) # N x k x 1 x C_in x 1 x 1
-
-        b, c_in, h, w = x.size()
-        k, c_out, c_in, kh, kw = self.weight.size()
-        x = x.view(1, -1, h, w) # 1 x N*C_in x H x W
-        weight = self.weight.unsqueeze(dim=0) # 1 x k x C_out x C_in x kH x hW 
-
-        combined_weight = (routing_weight * weight).sum(1).view(-1, c_in, kh, kw)
-        output = F.conv2d(x, weight=combined_weight, bias=None, 
-                            stride=self.stride, padding=self.padding, groups=self.groups * b)
-
-        output = output.view(b, c_out, output.size(-2), output.size(-1))
+        if self.recompute and self.training:
+            return recomputed_dynamic_conv2d(x, routing_weight.reshape(x.size(0), -1), self.weight, self.bias,
+                            stride=self.stride, padding=self.padding, groups=self.groups, routing='in')
+        combined_weight = aggregate_channel_experts(routing_weight.reshape(x.size(0), -1), self.weight, self.groups, routed='in') # N x C_out x C_in x kH x kW
+        output = per_sample_conv2d(x, combined_weight, self.bias,
+                            stride=self.stride, padding=self.padding, groups=self.groups)
         return output
 
 class route_func_dw(nn.Module):
@@ -81,11 +79,11 @@ class route_func_dw(nn.Module):
         # [n, in_channels]
         channel_weight = self.channel_extractor(gap)
         # [n, pool_size*pool_size]
-        channel_pool = (self.adp_pool(x)).mean(dim=1,keepdim=False).view(x.shape[0],-1)
+        channel_pool = (self.adp_pool(x)).mean(dim=1,keepdim=False).reshape(x.shape[0],-1)
         expert_weight = self.expert_extractor(channel_pool)
         # [n, in_channel, experts]
         general = channel_weight.unsqueeze(-1)*expert_weight.unsqueeze(1)
-        general = torch.sigmoid(general)
+        general = torch.sigmoid(at_least_fp32(general))
 
         return general
 
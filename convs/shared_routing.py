@@ -0,0 +1,66 @@
+import torch
+import torch.nn as nn
+from typing import Tuple
+
+from convs import condconv, dyconv, dyres_conv, ddsnet
+
+__all__ = ['SharedRouting', 'build_shared_routing']
+
+'''
+    Block-level routing: a single routing function run on the block input computes the routing of both
+    convs of a residual block (built with routing=False), which saves the pooling of the second conv's
+    input and one routing function per block. The routing of the second conv then depends on the block
+    input instead of the first conv's output
+'''
+
+class SharedRouting(nn.Module):
+    def __init__(self, routing_func, split):
+        super().__init__()
+        self.routing_func = routing_func
+        # size of the first conv's routing along dim 1, the second conv gets the rest
+        self.split = split
+
+    def forward(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
+        routing_weight = self.routing_func(x)
+        return routing_weight[:, :self.split], routing_weight[:, self.split:]
+
+def build_shared_routing(conv1, conv2, reduction=16):
+    '''
+        A SharedRouting computing the routing of conv1 and conv2 (CondConv, DyConv, DyResConv or DDSConv of
+        the same type) from the input of conv1
+    '''
+    assert type(conv1) == type(conv2)
+    k = conv1.num_experts
+    if isinstance(conv1, condconv.CondConv):
+        # independent sigmoids, one per expert of each conv
+        return SharedRouting(condconv.route_func(conv1.in_channels, k + conv2.num_experts), k)
+
+    assert conv2.num_experts == k
+    if isinstance(conv1, dyconv.DyConv):
+        # one softmax over the experts of each conv
+        return SharedRouting(dyconv.route_func(conv1.in_channels, k, reduction, num_routes=2), k)
+    if isinstance(conv1, dyres_conv.DyResConv):
+        routed_channels = conv1.in_channels + conv2.in_channels
+        routing_func = dyres_conv.route_func(conv1.in_channels, k, reduction, conv1.mode, routed_channels=routed_channels)
+        return SharedRouting(routing_func, k * conv1.in_channels)
+    if isinstance(conv1, ddsnet.DDSConv):
+        assert conv1.mode == conv2.mode
+        if conv1.mode == 'out':
+            channels1, channels2 = conv1.out_channels, conv2.out_channels
+        else:
+            channels1, channels2 = conv1.in_channels, conv2.in_channels
+        routing_func = ddsnet.route_func(conv1.in_channels, conv1.out_channels, k, reduction, conv1.mode,
+                            routed_channels=channels1 + channels2)
+        return SharedRouting(routing_func, k * channels1)
+    raise ValueError('no shared routing for {}'.format(type(conv1).__name__))
+
+def test():
+    x = torch.randn(8, 16, 32, 32)
+    for conv in [condconv.CondConv, dyconv.DyConv, dyres_conv.DyResConv, ddsnet.DDSConv]:
+        conv1 = conv(16, 32, 3, padding=1, routing=False)
+        conv2 = conv(32, 32, 3, padding=1, routing=False)
+        route1, route2 = build_shared_routing(conv1, conv2)(x)
+        y = conv2(conv1(x, route1), route2)
+        print(conv.__name__, route1.shape, route2.shape, y.shape)
+
+# test()
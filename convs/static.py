@@ -0,0 +1,156 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from convs.functional import aggregate_channel_experts, stack_expert_params, fuse_expert_bn
+from convs.condconv import CondConv
+from convs.dyconv import DyConv
+from convs.dyres_conv import DyResConv
+from convs.ddsnet import DDSConv
+from convs.router import RouterConv
+from convs.shared_routing import SharedRouting
+
+__all__ = ['record_routing', 'convert_to_static']
+
+'''
+    Frozen-routing export: the routing of every dynamic layer is replaced by its mean over a
+    calibration set, which turns the layer into a plain nn.Conv2d. The batch norm the block applies
+    right after the layer (bnX after convX, or the next layer of an nn.Sequential) is folded into that
+    conv and replaced with nn.Identity. This is an approximation, check the accuracy (see
+    export_static.py) before using the static network
+'''
+
+def _is_dynamic(module):
+    if isinstance(module, (DyResConv, DDSConv)):
+        return not module.deploy
+    return isinstance(module, (CondConv, DyConv, RouterConv))
+
+def record_routing(net, dataloader, device, num_batches=None):
+    '''
+        Runs net over (at most num_batches of) dataloader in eval mode and returns
+        {layer: mean routing vector (1 x ...)} for every CondConv, DyConv, DyResConv, DDSConv and RouterConv
+    '''
+    sums = {}
+    counts = {}
+
+    def record(layer, routing_weight):
+        routing_weight = routing_weight.detach().double()
+        sums[layer] = sums.get(layer, 0) + routing_weight.sum(0, keepdim=True)
+        counts[layer] = counts.get(layer, 0) + routing_weight.size(0)
+
+    def hook(layer):
+        return lambda module, inputs, output: record(layer, output)
+
+    def pre_hook(layer):
+        # shared routing (see convs.shared_routing), the block passes the routing to the layer
+        return lambda module, inputs: record(layer, inputs[1])
+
+    handles = []
+    for module in net.modules():
+        if not _is_dynamic(module):
+            continue
+        if module.routing_func is not None:
+            handles.append(module.routing_func.register_forward_hook(hook(module)))
+        else:
+            handles.append(module.register_forward_pre_hook(pre_hook(module)))
+    net.eval()
+    with torch.no_grad():
+        for i, (images, _) in enumerate(dataloader):
+            if num_batches is not None and i >= num_batches:
+                break
+            net(images.to(device))
+    for handle in handles:
+        handle.remove()
+    return {layer: (sums[layer] / counts[layer]).float() for layer in sums}
+
+def _static_params(module, route):
+    # (weight, bias) of the plain conv equivalent to module under the fixed routing route
+    if isinstance(module, (CondConv, DyConv)):
+        k = module.num_experts
+        route = route.view(1, k)
+        expert_weight = module.expert_weight()
+        weight = torch.mm(route, expert_weight.view(k, -1)).view(expert_weight.shape[1:])
+        bias = None if module.bias is None else torch.mm(route, module.bias).view(-1)
+        return weight, bias
+    if isinstance(module, RouterConv):
+        # N x k x C_in, routed per input channel
+        weight = aggregate_channel_experts(route.reshape(1, -1), module.weight, module.groups, routed='in')[0]
+        return weight, None
+
+    # DyResConv and DDSConv, the per-expert batch norms are folded first
+    weight, bias = stack_expert_params(module.convs)
+    weight, bias = fuse_expert_bn(weight, bias, module.bns)
+    if isinstance(module, DDSConv) and module.mode == 'out':
+        combined_weight = aggregate_channel_experts(route, weight, module.groups, routed='out')[0]
+        return combined_weight, (route.view(bias.size()) * bias).sum(0)
+    return aggregate_channel_experts(route, weight, module.groups, routed='in')[0], bias.sum(0)
+
+def _following_bn(module, name):
+    # name of the BatchNorm2d (with running statistics) that module applies right after its child name, or None
+    if isinstance(module, nn.Sequential):
+        bn_name = str(int(name) + 1) if name.isdigit() else None
+    else:
+        # the blocks run self.bnX(self.convX(...))
+        bn_name = 'bn' + name[len('conv'):] if name.startswith('conv') else None
+    bn = getattr(module, bn_name, None) if bn_name is not None else None
+    if isinstance(bn, nn.BatchNorm2d) and bn.track_running_stats:
+        return bn_name
+    return None
+
+def _static_layer(module, route, bn=None):
+    with torch.no_grad():
+        weight, bias = _static_params(module, route)
+        if bn is not None:
+            weight, bias = fuse_expert_bn(weight.unsqueeze(0), None if bias is None else bias.unsqueeze(0), [bn])
+            weight, bias = weight[0], bias[0]
+    c_out, c_in_g, kh, kw = weight.size()
+    conv = nn.Conv2d(c_in_g * module.groups, c_out, (kh, kw), stride=module.stride, padding=module.padding,
+                    groups=module.groups, bias=bias is not None)
+    conv.to(weight.device)
+    with torch.no_grad():
+        conv.weight.copy_(weight)
+        if bias is not None:
+            conv.bias.copy_(bias)
+    return conv.eval()
+
+def _convert(module, routing):
+    for name, child in list(module.named_children()):
+        if child in routing:
+            bn_name = _following_bn(module, name)
+            bn = None if bn_name is None else getattr(module, bn_name)
+            setattr(module, name, _static_layer(child, routing[child], bn))
+            if bn_name is not None:
+                setattr(module, bn_name, nn.Identity())
+        else:
+            _convert(child, routing)
+    if isinstance(getattr(module, 'routing_func', None), SharedRouting) and not _is_dynamic(module.conv1):
+        # the convs of the block are static, the block no longer computes their routing
+        module.routing_func = None
+
+def convert_to_static(net, routing):
+    '''
+        Replaces every layer of routing (from record_routing) with an nn.Conv2d that uses
+        the recorded mean routing, in place. The network is put in eval mode.
+    '''
+    net.eval()
+    _convert(net, routing)
+    return net
+
+def test():
+    from cifar.cc_resnet import CC_ResNet18
+    from cifar.dds_mobilenetv2 import DDS_MobileNetV2
+    for net in [CC_ResNet18(), DDS_MobileNetV2(mode='out')]:
+        # some training steps so that the batch norms have non-trivial statistics
+        net.train()
+        for _ in range(3):
+            net(torch.randn(8, 3, 32, 32))
+        # calibrated on a single sample, the static network is exact on that sample
+        x = torch.randn(1, 3, 32, 32)
+        routing = record_routing(net, [(x, None)], torch.device('cpu'))
+        with torch.no_grad():
+            reference = net(x)
+            convert_to_static(net, routing)
+            folded = sum(isinstance(m, nn.Identity) for m in net.modules())
+            print(len(routing), folded, (net(x) - reference).abs().max().item())
+
+# test()
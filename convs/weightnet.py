@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from convs.functional import at_least_fp32, per_sample_conv2d, weightnet_basis, weightnet_coefficients, basis_conv2d, memory_format_like, WEIGHTNET_BACKENDS
+
 ''' 
 https://github.com/megvii-model/WeightNet/blob/master/weightnet.py
 '''
@@ -9,8 +11,10 @@ https://github.com/megvii-model/WeightNet/blob/master/weightnet.py
 __all__ = ['WeightNet', 'WeightNet_DW']
 
 class WeightNet(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, reduction_ratio=16, M=2, G=2):
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, reduction_ratio=16, M=2, G=2, backend='basis'):
         super().__init__()
+        assert backend in WEIGHTNET_BACKENDS
+        self.backend = backend
 
         self.M = M
         self.G = G
@@ -35,18 +39,21 @@ class WeightNet(nn.Module):
         x_gap = self.reduce(x_gap) # N x C_in / r x 1 x 1
 
         x_w = self.fc1(x_gap) # N x M(C_out) x 1 x 1
-        x_w = self.sigmoid(x_w)
+        x_w = self.sigmoid(at_least_fp32(x_w))
+        if self.backend == 'basis':
+            coefficient = weightnet_coefficients(x_w, self.out_channels, self.G, self.fc2.bias is not None) # N x G x C_out x M/G+1
+            basis = weightnet_basis(self.fc2, self.out_channels, self.kernel_size, self.G)
+            output = basis_conv2d(x, coefficient, basis, stride=self.stride, padding=self.padding, groups=self.G) # N x G x C_out x H x W
+            return memory_format_like(output.sum(1), x)
         x_w = self.fc2(x_w) # N x (C_out)(C_in)(kH)(kW) x 1 x 1
-
-        x = x.view(1, -1, x.size(2), x.size(3)) # 1 x N(C_in) x H x W
-        x_w = x_w.view(-1, self.in_channels, self.kernel_size, self.kernel_size) # (C_out)(N) x C_in x kH, kW
-        x = F.conv2d(x, weight=x_w, stride=self.stride, padding=self.padding, groups=b)
-        x = x.view(-1, self.out_channels, x.size(2), x.size(3)) # N x C_out x H x W
-        return x
+        x_w = x_w.view(b, self.out_channels, self.in_channels, self.kernel_size, self.kernel_size)
+        return per_sample_conv2d(x, x_w, None, stride=self.stride, padding=self.padding)
 
 class WeightNet_DW(nn.Module):
-    def __init__(self, channels, kernel_size, stride=1, reduction_ratio=16, M=2, G=2):
+    def __init__(self, channels, kernel_size, stride=1, reduction_ratio=16, M=2, G=2, backend='basis'):
         super().__init__()
+        assert backend in WEIGHTNET_BACKENDS
+        self.backend = backend
 
         self.M = M
         self.G = G # lambda = M // G
@@ -70,19 +77,27 @@ class WeightNet_DW(nn.Module):
         x_gap = self.reduce(x_gap) # N x C_in / r x 1 x 1
 
         x_w = self.fc1(x_gap)
-        x_w = self.sigmoid(x_w)
+        x_w = self.sigmoid(at_least_fp32(x_w))
+        if self.backend == 'basis':
+            coefficient = weightnet_coefficients(x_w, self.channels, 1, self.fc2.bias is not None) # N x 1 x C x M/G+1
+            coefficient = coefficient.view(b, self.channels, 1, -1)
+            basis = weightnet_basis(self.fc2, self.channels, self.kernel_size, 1)
+            output = basis_conv2d(x, coefficient, basis, stride=self.stride, padding=self.padding, groups=self.channels) # N x C x 1 x H x W
+            return memory_format_like(output.view(b, self.channels, output.size(-2), output.size(-1)), x)
         x_w = self.fc2(x_w)
-
-        x = x.view(1, -1, x.size(2), x.size(3))
-        x_w = x_w.view(-1, 1, self.kernel_size, self.kernel_size)
-        x = F.conv2d(x, weight=x_w, stride=self.stride, padding=self.padding, groups=b * self.channels)
-        x = x.view(-1, self.channels, x.size(2), x.size(3))
-        return x
+        x_w = x_w.view(b, self.channels, 1, self.kernel_size, self.kernel_size)
+        return per_sample_conv2d(x, x_w, None, stride=self.stride, padding=self.padding, groups=self.channels)
 
 def test():
     x = torch.randn(64, 128, 32, 32)
     wn = WeightNet(128, 256, 3, stride=2)
     y = wn(x)
     print(y.size())
+    for layer in [wn, WeightNet_DW(128, 3, stride=2)]:
+        layer.backend = 'kernel'
+        y1 = layer(x)
+        layer.backend = 'basis'
+        y2 = layer(x)
+        print(y2.size(), (y1 - y2).abs().max().item())
 
 # test()
@@ -0,0 +1,48 @@
+import torch
+
+import argparse
+from utils import get_dataloader, get_network, calculate_acc, time_function
+from convs.static import record_routing, convert_to_static
+
+parser = argparse.ArgumentParser(description='Exporting a dynamic network with its routing frozen to the calibration mean')
+
+parser.add_argument('--network', '-n', required=True)
+parser.add_argument('--checkpoint', '-c', type=str, required=True)
+parser.add_argument('--dataset', type=str, help='cifar100 or tiny or imagenet', default='cifar100')
+parser.add_argument('--batch', '-b', type=int, default=128)
+parser.add_argument('--calib-batches', type=int, default=20, help='training batches used to average the routing')
+parser.add_argument('--repeat', '-r', type=int, default=10)
+parser.add_argument('--output', '-o', type=str, help='where to save the static network')
+parser.add_argument('--cuda', action='store_true')
+
+args = parser.parse_args()
+print(args)
+
+device = torch.device('cuda' if (torch.cuda.is_available() and args.cuda) else 'cpu')
+
+net = get_network(args.network, args.dataset, device)
+state = torch.load(args.checkpoint, map_location=device)
+net.load_state_dict(state['net'])
+net.eval()
+
+trainloader, testloader = get_dataloader(args.dataset, args.batch)
+inputs, _ = next(iter(testloader))
+inputs = inputs.to(device)
+
+acc = calculate_acc(testloader, net, device)
+latency = time_function(lambda: net(inputs), device, repeat=args.repeat)
+
+routing = record_routing(net, trainloader, device, num_batches=args.calib_batches)
+convert_to_static(net, routing)
+
+static_acc = calculate_acc(testloader, net, device)
+static_latency = time_function(lambda: net(inputs), device, repeat=args.repeat)
+
+print('Froze the routing of {} layers over {} batches'.format(len(routing), args.calib_batches))
+print('Dynamic: {:.2f}%\t{:.3f} ms / batch of {}'.format(acc, latency, inputs.size(0)))
+print('Static:  {:.2f}%\t{:.3f} ms / batch of {}'.format(static_acc, static_latency, inputs.size(0)))
+print('Accuracy delta: {:+.2f}%\tSpeedup: {:.2f}x'.format(static_acc - acc, latency / static_latency))
+
+if args.output:
+    # the static network no longer matches get_network, so the whole module is saved
+    torch.save(net, args.output)
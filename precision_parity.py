@@ -0,0 +1,61 @@
+import torch
+import torch.nn as nn
+
+import argparse
+import copy
+from utils import get_network, get_dataloader, init_params, autocast
+
+parser = argparse.ArgumentParser(description='Loss-curve parity of bf16 autocast training against fp32')
+
+parser.add_argument('--network', '-n', required=True)
+parser.add_argument('--dataset', type=str, default='cifar100')
+parser.add_argument('--batch', '-b', type=int, default=128)
+parser.add_argument('--steps', '-s', type=int, default=200)
+parser.add_argument('--lr', '-l', type=float, default=0.01)
+parser.add_argument('--log-every', type=int, default=20)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--cuda', action='store_true')
+
+args = parser.parse_args()
+print(args)
+
+device = torch.device('cuda' if (torch.cuda.is_available() and args.cuda) else 'cpu')
+torch.manual_seed(args.seed)
+
+trainloader, _ = get_dataloader(args.dataset, args.batch)
+# the same batches for both runs
+batches = []
+for inputs, labels in trainloader:
+    batches.append((inputs, labels))
+    if len(batches) == args.steps:
+        break
+
+net = get_network(args.network, args.dataset, device)
+init_params(net)
+nets = {'fp32': net, 'bf16': copy.deepcopy(net)}
+
+criterion = nn.CrossEntropyLoss()
+losses = {}
+for precision, net in nets.items():
+    net.train()
+    optimizer = torch.optim.SGD(net.parameters(), lr=args.lr, momentum=0.9, weight_decay=5e-4)
+    losses[precision] = []
+    for inputs, labels in batches:
+        inputs, labels = inputs.to(device), labels.to(device)
+        optimizer.zero_grad()
+        with autocast(device, precision):
+            loss = criterion(net(inputs), labels)
+        loss.backward()
+        optimizer.step()
+        losses[precision].append(loss.item())
+
+print('{:>6} {:>10} {:>10} {:>10}'.format('step', 'fp32', 'bf16', 'rel diff'))
+for step in range(0, len(batches), args.log_every):
+    fp32, bf16 = losses['fp32'][step], losses['bf16'][step]
+    print('{:>6} {:>10.4f} {:>10.4f} {:>10.2%}'.format(step + 1, fp32, bf16, abs(bf16 - fp32) / fp32))
+
+# compare the smoothed curves, single steps are noisy in both precisions
+window = min(args.log_every, len(batches))
+fp32 = sum(losses['fp32'][-window:]) / window
+bf16 = sum(losses['bf16'][-window:]) / window
+print('Mean loss over the last {} steps: fp32 {:.4f}, bf16 {:.4f} ({:.2%})'.format(window, fp32, bf16, abs(bf16 - fp32) / fp32))
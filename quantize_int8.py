@@ -0,0 +1,54 @@
+import torch
+
+import argparse
+import copy
+from utils import get_dataloader, get_network, calculate_acc, time_function
+from convs.quantized import calibrate, convert_to_int8
+
+parser = argparse.ArgumentParser(description='Post-training int8 quantization of dynamic networks, accuracy and CPU latency against fp32')
+
+parser.add_argument('--network', '-n', nargs='+', required=True, help='e.g. cc3resnet18 dy3mobilenetv2')
+parser.add_argument('--checkpoint', '-c', nargs='+', required=True, help='one per network')
+parser.add_argument('--dataset', type=str, help='cifar100 or tiny or imagenet', default='cifar100')
+parser.add_argument('--batch', '-b', type=int, default=128)
+parser.add_argument('--calib-batches', type=int, default=20, help='training batches used to calibrate the activation ranges')
+parser.add_argument('--routing', type=str, nargs='+', default=['fp32', 'int8'], help='precision of the routing functions')
+parser.add_argument('--repeat', '-r', type=int, default=10)
+parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 keeps the default')
+parser.add_argument('--output', '-o', type=str, help='where to save the quantized networks, formatted with the network and routing')
+
+args = parser.parse_args()
+print(args)
+assert len(args.network) == len(args.checkpoint)
+
+# int8 kernels (fbgemm / qnnpack) run on the CPU
+device = torch.device('cpu')
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+
+trainloader, testloader = get_dataloader(args.dataset, args.batch)
+inputs, _ = next(iter(testloader))
+
+rows = []
+for network, checkpoint in zip(args.network, args.checkpoint):
+    net = get_network(network, args.dataset, device)
+    state = torch.load(checkpoint, map_location=device)
+    net.load_state_dict(state['net'])
+    net.eval()
+
+    acc = calculate_acc(testloader, net, device)
+    latency = time_function(lambda: net(inputs), device, repeat=args.repeat)
+    rows.append((network, 'fp32', '-', acc, latency, 1.0))
+
+    observers = calibrate(net, trainloader, device, num_batches=args.calib_batches)
+    for routing in args.routing:
+        int8_net = convert_to_int8(copy.deepcopy(net), observers, routing=routing)
+        int8_acc = calculate_acc(testloader, int8_net, device)
+        int8_latency = time_function(lambda: int8_net(inputs), device, repeat=args.repeat)
+        rows.append((network, 'int8', routing, int8_acc, int8_latency, latency / int8_latency))
+        if args.output:
+            torch.save(int8_net, args.output.format(network=network, routing=routing))
+
+print('{:<20} {:>6} {:>8} {:>10} {:>14} {:>8}'.format('network', 'convs', 'routing', 'acc(%)', 'ms / batch', 'speedup'))
+for network, precision, routing, acc, latency, speedup in rows:
+    print('{:<20} {:>6} {:>8} {:>10.2f} {:>14.3f} {:>7.2f}x'.format(network, precision, routing, acc, latency, speedup))
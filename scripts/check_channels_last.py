@@ -0,0 +1,51 @@
+import torch
+
+import argparse
+import os
+import sys
+# run from anywhere, the networks and convs are imported from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import get_network, to_channels_last
+from config import INPUT_SIZES
+
+parser = argparse.ArgumentParser(description='Checking that a network converted to channels_last matches its NCHW copy')
+
+parser.add_argument('--network', '-n', nargs='+', default=['resnet18', 'cc3resnet18', 'dy3resnet18', 'dyresA3resnet18', 'dyresB3resnet18',
+                        'dyresS3resnet18', 'ddsin3resnet18', 'dds3resnet18', 'cc3alexnet', 'dy3alexnet', 'dyresA3alexnet',
+                        'cc3mobilenetv2', 'dy3mobilenetv2', 'dyresA3mobilenetv2', 'dds3mobilenetv2'])
+parser.add_argument('--dataset', type=str, help='cifar100 or tiny or imagenet', default='cifar100')
+parser.add_argument('--batch', '-b', type=int, default=8, help='from 8 the expert banks are mixed in NHWC')
+parser.add_argument('--rtol', type=float, default=1e-8, help='max abs error over max abs value')
+parser.add_argument('--cuda', action='store_true')
+
+args = parser.parse_args()
+
+device = torch.device('cuda' if (torch.cuda.is_available() and args.cuda) else 'cpu')
+size = INPUT_SIZES[args.dataset]
+
+for network in args.network:
+    # compared in double precision, the gradients of an untrained network are too ill-conditioned to compare in fp32
+    net = get_network(network, args.dataset, device).double()
+    converted = get_network(network, args.dataset, device).double()
+    converted.load_state_dict(net.state_dict())
+    converted = to_channels_last(converted)
+    x = torch.randn(args.batch, 3, size, size, device=device, dtype=torch.double)
+    inputs = [x.clone().requires_grad_(), x.contiguous(memory_format=torch.channels_last).requires_grad_()]
+
+    # errors relative to the max abs value, of the eval mode outputs and of the training mode (batch statistics)
+    # input gradients, a random projection of the output is backpropagated. Both passes draw the same dropout masks
+    net.eval()
+    converted.eval()
+    with torch.no_grad():
+        outputs = [net(inputs[0]), converted(inputs[1])]
+    net.train()
+    converted.train()
+    projection = torch.randn_like(outputs[0])
+    seed = torch.seed()
+    grads = []
+    for layer, i in zip([net, converted], inputs):
+        torch.manual_seed(seed)
+        grads.append(torch.autograd.grad((layer(i) * projection).sum(), [i])[0])
+    errors = [((a - b).abs().max() / a.abs().max()).item() for a, b in [outputs, grads]]
+    print('{:<20} output {:.2e}  input grad {:.2e}'.format(network, *errors))
+    assert max(errors) <= args.rtol, '{} differs in channels_last'.format(network)
@@ -0,0 +1,59 @@
+import torch
+import numpy as np
+import onnx
+import onnxruntime
+
+import argparse
+import os
+import sys
+# run from anywhere, the networks and convs are imported from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import get_network
+from config import INPUT_SIZES
+
+parser = argparse.ArgumentParser(description='Exporting a network to ONNX with a dynamic batch size, checked with ONNX Runtime on CPU')
+
+parser.add_argument('--network', '-n', required=True)
+parser.add_argument('--dataset', type=str, help='cifar100 or tiny or imagenet', default='cifar100')
+parser.add_argument('--checkpoint', '-c', type=str, help='randomly initialised if not given')
+parser.add_argument('--output', '-o', type=str, required=True)
+parser.add_argument('--opset', type=int, default=13)
+parser.add_argument('--export-batch', type=int, default=2, help='batch size of the traced input')
+parser.add_argument('--batches', '-b', type=int, nargs='+', default=[1, 4, 16], help='batch sizes of the parity check')
+parser.add_argument('--atol', type=float, default=1e-4)
+
+args = parser.parse_args()
+print(args)
+
+device = torch.device('cpu')
+
+net = get_network(args.network, args.dataset, device)
+if args.checkpoint:
+    state = torch.load(args.checkpoint, map_location=device)
+    net.load_state_dict(state['net'])
+net.eval()
+
+size = INPUT_SIZES[args.dataset]
+inputs = torch.randn(args.export_batch, 3, size, size)
+
+# the dynamic layers switch to batch-independent backends while exporting, see convs/functional.py
+torch.onnx.export(net, inputs, args.output, opset_version=args.opset, do_constant_folding=True,
+                  input_names=['input'], output_names=['output'],
+                  dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}})
+onnx.checker.check_model(onnx.load(args.output))
+print('Exported to {}'.format(args.output))
+
+session = onnxruntime.InferenceSession(args.output, providers=['CPUExecutionProvider'])
+failed = []
+for batch in args.batches:
+    inputs = torch.randn(batch, 3, size, size)
+    with torch.no_grad():
+        reference = net(inputs).numpy()
+    output = session.run(None, {'input': inputs.numpy()})[0]
+    error = np.abs(output - reference).max()
+    print('batch {:>4}: max abs error {:.2e}'.format(batch, error))
+    if error > args.atol:
+        failed.append(batch)
+
+if failed:
+    sys.exit('ONNX Runtime does not match PyTorch at batch sizes {}'.format(failed))
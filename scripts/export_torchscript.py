@@ -0,0 +1,56 @@
+import torch
+import torch.fx
+
+import argparse
+import os
+import sys
+# run from anywhere, the networks and convs are imported from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import get_network
+from config import INPUT_SIZES
+
+parser = argparse.ArgumentParser(description='Exporting a network to TorchScript, checked against the eager network and its torch.fx trace')
+
+parser.add_argument('--network', '-n', nargs='+', default=[family + backbone for backbone in ['resnet18', 'alexnet', 'mobilenetv2']
+                        for family in ['', 'cc3', 'dy3', 'dyresA3', 'dyresB3', 'dyresS3', 'ddsin3', 'dds3']])
+parser.add_argument('--dataset', type=str, help='cifar100 or tiny or imagenet', default='cifar100')
+parser.add_argument('--checkpoint', '-c', type=str, help='randomly initialised if not given')
+parser.add_argument('--output', '-o', type=str, help='where to save the scripted network, for a single network')
+parser.add_argument('--batch', '-b', type=int, default=8, help='batch of the parity check')
+parser.add_argument('--freeze', action='store_true', help='freeze and optimize the scripted network for inference')
+parser.add_argument('--atol', type=float, default=1e-4)
+parser.add_argument('--cuda', action='store_true')
+
+args = parser.parse_args()
+print(args)
+assert args.output is None or len(args.network) == 1, '--output saves a single network'
+
+device = torch.device('cuda' if (torch.cuda.is_available() and args.cuda) else 'cpu')
+size = INPUT_SIZES[args.dataset]
+
+for network in args.network:
+    net = get_network(network, args.dataset, device)
+    if args.checkpoint:
+        state = torch.load(args.checkpoint, map_location=device)
+        net.load_state_dict(state['net'])
+    net.eval()
+
+    inputs = torch.randn(args.batch, 3, size, size, device=device)
+
+    scripted = torch.jit.script(net)
+    traced = torch.fx.symbolic_trace(net)
+    if args.freeze:
+        scripted = torch.jit.optimize_for_inference(torch.jit.freeze(scripted))
+
+    with torch.no_grad():
+        reference = net(inputs)
+        outputs = {'torchscript': scripted(inputs), 'torch.fx': traced(inputs)}
+
+    for name, output in outputs.items():
+        error = (output - reference).abs().max().item()
+        print('{:<20} {}: max abs error {:.2e}'.format(network, name, error))
+        assert error <= args.atol, '{} {} does not match the eager network'.format(network, name)
+
+if args.output:
+    scripted.save(args.output)
+    print('Saved to {}'.format(args.output))
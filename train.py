@@ -2,12 +2,18 @@ import torch
 import torchvision
 import torchvision.transforms as transforms
 import torch.nn as nn
+import torch.distributed as dist
 
 import argparse
+import contextlib
+import math
+import os
+import sys
 import time
 from datetime import timedelta
 
-from utils import calculate_acc, get_network, get_dataloader, init_params, count_parameters
+from convs.checkpoint import REENTRANT_CHECKPOINT
+from utils import calculate_acc, get_network, get_dataloader, init_params, count_parameters, autocast, CheckpointWriter, periodic_checkpoints, to_channels_last
 
 parser = argparse.ArgumentParser(description='Training CNN models')
 
@@ -24,12 +30,49 @@ parser.add_argument('--resume', type=str, help='resume training')
 parser.add_argument('--save', action='store_true')
 parser.add_argument('--cuda', action='store_true')
 parser.add_argument('--ngpu', type=int, default=1)
+parser.add_argument('--channels-last', action='store_true', help='run the network in NHWC memory format')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='bf16 runs under autocast')
+parser.add_argument('--shared-routing', action='store_true', help='one routing function per residual block (dynamic ResNets)')
+parser.add_argument('--threads', type=int, help='intra-op threads of each process, defaults to the cores divided by the local processes')
+parser.add_argument('--bucket-cap-mb', type=int, default=25, help='DDP gradient bucket size in MB')
+parser.add_argument('--accum-steps', type=int, default=1, help='micro-batches of --batch accumulated per optimizer step')
+parser.add_argument('--checkpoint-segments', type=int, default=0, help='recompute the blocks in that many segments during backward (ResNet18 and MobileNetV2)')
+parser.add_argument('--save-every-steps', type=int, help='with --save, also save the training state every that many optimizer steps')
+parser.add_argument('--save-every-minutes', type=float, help='with --save, also save the training state every that many minutes')
+parser.add_argument('--keep-last', type=int, default=3, help='periodic checkpoints kept on disk')
+parser.add_argument('--base-batch', type=int, help='scale the learning rate by the effective batch over this batch')
 
 args = parser.parse_args()
-print(args)
+
+# Distributed data parallel when launched by torchrun, e.g. torchrun --nproc_per_node 4 train.py ...
+# one process per GPU with NCCL, or per group of CPU cores with gloo. --batch is the batch of each process
+distributed = 'LOCAL_RANK' in os.environ
+if distributed:
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ['LOCAL_RANK'])
+    world_size = int(os.environ['WORLD_SIZE'])
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+else:
+    rank, local_rank, world_size, local_world_size = 0, 0, 1, 1
+is_main = rank == 0
+
+# DDP runs the reentrant checkpoint (torch 1.10) with a static graph, which does not support no_sync
+if distributed and args.checkpoint_segments > 0 and REENTRANT_CHECKPOINT and args.accum_steps > 1:
+    parser.error('--checkpoint-segments with --accum-steps under DDP needs torch 1.11+')
+
+# Give each local process its share of the cores, torch would otherwise start one thread per core in every process
+if args.threads is not None:
+    torch.set_num_threads(args.threads)
+elif local_world_size > 1:
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+
+if is_main:
+    print(args)
 
 RESULT_FILE = 'results.txt'
-LOG_FILE = 'logs/{}-{}-b{}-e{}.txt'.format(args.network, args.dataset, args.batch, args.epoch)
+# shared-routing and accumulated runs are kept apart from the others
+RUN_NAME = args.network + ('-shared' if args.shared_routing else '') + ('-acc{}'.format(args.accum_steps) if args.accum_steps > 1 else '')
+LOG_FILE = 'logs/{}-{}-b{}-e{}.txt'.format(RUN_NAME, args.dataset, args.batch, args.epoch)
 
 # Dict to keep the final result
 stats = {
@@ -39,9 +82,14 @@ stats = {
 
 # Device
 device = torch.device('cuda' if (torch.cuda.is_available() and args.cuda) else 'cpu')
+if distributed:
+    if device.type == 'cuda':
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+    dist.init_process_group(backend='nccl' if device.type == 'cuda' else 'gloo')
 
 # Dataloader
-trainloader, testloader = get_dataloader(args.dataset, args.batch)
+trainloader, testloader = get_dataloader(args.dataset, args.batch, distributed=distributed)
 
 if args.dataset == 'cifar100' or args.dataset == 'tiny':
     VAL_LEN = 10000
@@ -49,65 +97,137 @@ elif args.dataset == 'imagenet':
     VAL_LEN = 150000
 
 # Get network
-net = get_network(args.network, args.dataset, device)
+net = get_network(args.network, args.dataset, device, shared_routing=args.shared_routing, checkpoint_segments=args.checkpoint_segments)
 
-# Handle multi-gpu
-if args.cuda and args.ngpu > 1:
-    net = nn.DataParallel(net, list(range(args.ngpu)))
+if args.channels_last:
+    net = to_channels_last(net)
 
 # Init parameters
 init_params(net)
 
-print('Training {} with {} parameters...'.format(args.network, count_parameters(net)))
+# Handle multi-gpu and multi-process, model is what gets evaluated and saved
+model = net
+if distributed:
+    # DDP broadcasts the parameters of rank 0 at construction. An expert bank (k x C_out x C_in x k x k) larger than
+    # the bucket gets a bucket of its own, the gradients are views of the buckets so they are not held twice
+    net = nn.parallel.DistributedDataParallel(net, device_ids=[local_rank] if device.type == 'cuda' else None,
+                bucket_cap_mb=args.bucket_cap_mb, gradient_as_bucket_view=True)
+    if args.checkpoint_segments > 0 and REENTRANT_CHECKPOINT:
+        # the reentrant checkpoint (torch 1.10) runs the segment backward inside the network backward, DDP would mark
+        # the segment parameters ready a second time unless the graph is declared static
+        net._set_static_graph()
+    model = net.module
+elif args.cuda and args.ngpu > 1:
+    net = nn.DataParallel(net, list(range(args.ngpu)))
+
+# Samples per optimizer step, over the micro-batches and the processes
+EFFECTIVE_BATCH = args.batch * args.accum_steps * world_size
+# Linear scaling rule, the recipes' learning rate is given for base-batch
+LR = args.lr * EFFECTIVE_BATCH / args.base_batch if args.base_batch else args.lr
+
+if is_main:
+    print('Training {} with {} parameters on {} process(es)...'.format(args.network, count_parameters(model), world_size))
+    print('Effective batch {}, learning rate {}'.format(EFFECTIVE_BATCH, LR))
 
 net.train()
 
 # Loss and optimizer
 criterion = nn.CrossEntropyLoss()
-optimizer = torch.optim.SGD(net.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+optimizer = torch.optim.SGD(net.parameters(), lr=LR, momentum=args.momentum, weight_decay=args.weight_decay)
 
 # Learning rate scheduler
 scheduler = torch.optim.lr_scheduler.StepLR(optimizer=optimizer, step_size=args.step_size, gamma=args.gamma)
 
-if args.save and not args.resume:
+if args.save and not args.resume and is_main:
     # Log basic hyper-params to log file
     with open(LOG_FILE, 'w') as f:
         f.write('Training model {}\n'.format(args.network))
         f.write('Hyper-parameters:\n')
         f.write('Epoch {}; Batch {}; LR {}; SGD Momentum {}; SGD Weight Decay {};\n'.format(str(args.epoch), str(args.batch), str(args.lr), str(args.momentum), str(args.weight_decay)))
         f.write('LR Scheduler Step {}; LR Scheduler Gamma {}; {};\n'.format(str(args.step_size), str(args.gamma), str(args.dataset)))
+        f.write('Accumulation Steps {}; Processes {}; Effective Batch {}; Scaled LR {};\n'.format(str(args.accum_steps), str(world_size), str(EFFECTIVE_BATCH), str(LR)))
         f.write('Epoch,TrainLoss,ValAcc\n')
 
+# Periodic checkpoints are saved to trained_nets/<run>-step<N>.tar, the best one to checkpoint_path
+CHECKPOINT_PREFIX = 'trained_nets/{}-{}-b{}-e{}'.format(RUN_NAME, args.dataset, args.batch, args.epoch)
+
+checkpoint_path = CHECKPOINT_PREFIX + '.tar'
+
 if args.resume is not None:
-    checkpoint_path = args.resume
-    state = torch.load(checkpoint_path)
+    # from the best or a periodic checkpoint, the saved epoch runs again from the step it started at
+    state = torch.load(args.resume, map_location=device)
     optimizer.load_state_dict(state['optimizer'])
-    net.load_state_dict(state['net'])
+    model.load_state_dict(state['net'])
+    if 'scheduler' in state:
+        scheduler.load_state_dict(state['scheduler'])
     start_epoch = state['epoch']
+    global_step = state.get('step', 0)
     stats = state['stats'] if state['stats'] else { 'best_acc': 0.0, 'best_epoch': 0 }
 else:
-    checkpoint_path = 'trained_nets/{}-{}-b{}-e{}.tar'.format(args.network, args.dataset, args.batch, args.epoch)
     start_epoch = 0
+    global_step = 0
+# the step count at the start of the current epoch, the one a resumed run replays from
+epoch_start_step = global_step
+
+def training_state(epoch):
+    # without the DDP wrapper so it loads in a single process
+    return {
+        'epoch': epoch,
+        'step': epoch_start_step,
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
+        'net': model.state_dict(),
+        'stats': stats
+    }
+
+# Checkpoints are written by rank 0 on a background thread
+writer = None
+if args.save and is_main:
+    # the periodic checkpoints of an earlier run count towards --keep-last
+    writer = CheckpointWriter(args.save_every_steps, args.save_every_minutes, args.keep_last, periodic_checkpoints(CHECKPOINT_PREFIX))
 
 # Train the model
 start = time.time()
 for epoch in range(start_epoch, args.epoch):  # loop over the dataset multiple times
 
+    if distributed:
+        trainloader.sampler.set_epoch(epoch)
+    epoch_start_step = global_step
+
+    # the loss is the mean over the effective batches, one per optimizer step
     training_loss = 0.0
+    num_steps = math.ceil(len(trainloader) / args.accum_steps)
     for i, data in enumerate(trainloader):
         # Get the inputs; data is a list of [inputs, labels]
         inputs, labels = data
         inputs = inputs.to(device)
         labels = labels.to(device)
+        if args.channels_last:
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
         
-        # Zero the parameter gradients
-        optimizer.zero_grad()
+        # Micro-batches of the current optimizer step, the last step of the epoch can have fewer
+        group_start = i - i % args.accum_steps
+        group_size = min(args.accum_steps, len(trainloader) - group_start)
+        last_micro_step = i == group_start + group_size - 1
 
-        # Forward + backward + optimize
-        outputs = net(inputs)
-        loss = criterion(outputs, labels)
-        loss.backward()
-        optimizer.step()
+        # Zero the parameter gradients
+        if i == group_start:
+            optimizer.zero_grad()
+
+        # Forward + backward, the gradients are only all-reduced on the last micro-batch of the step
+        with net.no_sync() if distributed and not last_micro_step else contextlib.nullcontext():
+            with autocast(device, args.precision):
+                outputs = net(inputs)
+                # the accumulated gradient is the one of the mean loss over the effective batch
+                loss = criterion(outputs, labels) / group_size
+            loss.backward()
+
+        # Optimize
+        if last_micro_step:
+            optimizer.step()
+            global_step += 1
+            if writer is not None and writer.due(global_step):
+                writer.save(training_state(epoch), '{}-step{}.tar'.format(CHECKPOINT_PREFIX, global_step), periodic=True)
 
         training_loss += loss.item()
 
@@ -126,35 +246,52 @@ for epoch in range(start_epoch, args.epoch):  # loop over the dataset multiple t
     # Calculate training accuracy, top-1
     # train_acc = calculate_acc(trainloader, net, device)
 
+    if distributed:
+        # mean of the training loss over the processes
+        training_loss = torch.tensor(training_loss, device=device)
+        dist.all_reduce(training_loss)
+        training_loss = training_loss.item() / world_size
+
+    if not is_main:
+        # rank 0 validates and saves, the others wait for it
+        dist.barrier()
+        scheduler.step()
+        continue
+
     # Calculate validation accuracy
-    net.eval()
-    val_acc = calculate_acc(testloader, net, device)
+    model.eval()
+    with autocast(device, args.precision):
+        val_acc = calculate_acc(testloader, model, device, channels_last=args.channels_last)
     if val_acc > stats['best_acc']:
         stats['best_acc'] = val_acc
         stats['best_epoch'] = epoch + 1
-        if args.save:
+        if writer is not None:
             # Save the checkpoint
-            state = {
-                'epoch': epoch, 
-                'optimizer': optimizer.state_dict(),
-                'net': net.state_dict(),
-                'stats': stats
-            }
-            torch.save(state, checkpoint_path)
+            writer.save(training_state(epoch), checkpoint_path)
 
     # Switch back to training mode
-    net.train()
+    model.train()
+    if distributed:
+        dist.barrier()
 
-    print('[Epoch: %d]  Train Loss: %.3f   Val Acc: %.3f%%' % ( epoch + 1, training_loss / len(trainloader), val_acc ))
+    print('[Epoch: %d]  Train Loss: %.3f   Val Acc: %.3f%%' % ( epoch + 1, training_loss / num_steps, val_acc ))
     
     if args.save:
         with open(LOG_FILE, 'a+') as f:
-            f.write('%d,%.3f,%.3f\n' % (epoch + 1, training_loss / len(trainloader), val_acc))
+            f.write('%d,%.3f,%.3f\n' % (epoch + 1, training_loss / num_steps, val_acc))
 
     # Step the scheduler after every epoch
     scheduler.step()
 
+if writer is not None:
+    writer.close()
+
 end = time.time()
+if distributed:
+    dist.destroy_process_group()
+if not is_main:
+    sys.exit()
+
 print('Total time trained: {}'.format( str(timedelta(seconds=int(end - start)) ) ))
 
 # Test the model
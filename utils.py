@@ -5,15 +5,26 @@ import torchvision
 import torchvision.transforms as transforms
 
 import os
+import re
 import sys
+import glob
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('Agg')
 import time
+import queue
+import threading
 
 from config import *
 
+def to_channels_last(net):
+    '''
+        Converts the 4-D parameters and buffers of net to channels_last, in place. net.to(memory_format=...) also
+        tries the 5-D k x C_out x C_in x kH x kW expert banks and fails on them
+    '''
+    return net._apply(lambda t: t.contiguous(memory_format=torch.channels_last) if t.dim() == 4 else t)
+
 def init_params(net):
     '''Init layer parameters.'''
     for m in net.modules():
@@ -47,13 +58,33 @@ def count_parameters(net, all=True):
     # If all= Flase, we only return the trainable parameters; tested
     return sum(p.numel() for p in net.parameters() if p.requires_grad or all)
 
-def calculate_acc(dataloader, net, device):
+def time_function(fn, device, warmup=3, repeat=10, grad=False):
+    '''Average wall time of fn() in milliseconds, set grad to time a training step.'''
+    with torch.set_grad_enabled(grad):
+        for _ in range(warmup):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def autocast(device, precision='fp32'):
+    '''Autocast context for --precision, bf16 runs the convs and linears in bfloat16.'''
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+def calculate_acc(dataloader, net, device, channels_last=False):
     with torch.no_grad():
         correct = 0
         total = 0
         for data in dataloader:
             images, labels = data
             images = images.to(device)
+            if channels_last:
+                images = images.contiguous(memory_format=torch.channels_last)
             labels = labels.to(device)
             
             outputs = net(images)
@@ -81,7 +112,13 @@ def accuracy(output, target, topk=(1,5)):
             res.append(correct_k.mul(100.0/batch_size))
         return res
 
-def get_network(network, dataset, device):
+def get_network(network, dataset, device, shared_routing=False, checkpoint_segments=0):
+    # shared_routing: one routing function per residual block of the dynamic ResNets (see convs.shared_routing)
+    assert not shared_routing or (network.endswith('resnet18') and network != 'resnet18'), \
+        'shared routing is only defined for the dynamic ResNets'
+    # checkpoint_segments > 0: the blocks run in that many checkpointed segments during training (see convs.checkpoint)
+    assert checkpoint_segments == 0 or network.endswith('resnet18') or network.endswith('mobilenetv2'), \
+        'activation checkpointing is only defined for the ResNet18 and MobileNetV2 families'
 
     # ResNet18 and Related Work
     if network == 'resnet18':
@@ -90,56 +127,56 @@ def get_network(network, dataset, device):
         elif dataset == 'tiny':
             from tiny.resnet import ResNet18
 
-        net = ResNet18()
+        net = ResNet18(checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('cc') and network.endswith('resnet18'):
         if dataset == 'cifar100':
             from cifar.cc_resnet import CC_ResNet18
         elif dataset == 'tiny':
             from tiny.cc_resnet import CC_ResNet18
-        net = CC_ResNet18(num_experts=int( network[2] ))
+        net = CC_ResNet18(num_experts=int( network[2] ), shared_routing=shared_routing, checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('dyresA') and network.endswith('resnet18'):
         if dataset == 'cifar100':
             from cifar.dyresA_resnet import DyResA_ResNet18
         elif dataset == 'tiny':
             from tiny.dyresA_resnet import DyResA_ResNet18
-        net = DyResA_ResNet18(num_experts=int( network[6] ))
+        net = DyResA_ResNet18(num_experts=int( network[6] ), shared_routing=shared_routing, checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('dyresB') and network.endswith('resnet18'):
         if dataset == 'cifar100':
             from cifar.dyresB_resnet import DyResB_ResNet18
         elif dataset == 'tiny':
             from tiny.dyresB_resnet import DyResB_ResNet18
-        net = DyResB_ResNet18(num_experts=int( network[6] ))
+        net = DyResB_ResNet18(num_experts=int( network[6] ), shared_routing=shared_routing, checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('dyresS') and network.endswith('resnet18'):
         if dataset == 'cifar100':
             from cifar.dyresS_resnet import DyResS_ResNet18
         elif dataset == 'tiny':
             from tiny.dyresS_resnet import DyResS_ResNet18
-        net = DyResS_ResNet18(num_experts=int( network[6] ))
+        net = DyResS_ResNet18(num_experts=int( network[6] ), shared_routing=shared_routing, checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('dy') and network.endswith('resnet18'):
         if dataset == 'cifar100':
             from cifar.dy_resnet import Dy_ResNet18
         elif dataset == 'tiny':
             from tiny.dy_resnet import Dy_ResNet18
-        net = Dy_ResNet18(num_experts=int( network[2] ))
+        net = Dy_ResNet18(num_experts=int( network[2] ), shared_routing=shared_routing, checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('ddsin') and network.endswith('resnet18'):
         if dataset == 'cifar100':
             from cifar.dds_resnet import DDS_ResNet18
         elif dataset == 'tiny':
             from tiny.dds_resnet import DDS_ResNet18
-        net = DDS_ResNet18(num_experts=int( network[5] ), mode='in')
+        net = DDS_ResNet18(num_experts=int( network[5] ), mode='in', shared_routing=shared_routing, checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('dds') and network.endswith('resnet18'):
         if dataset == 'cifar100':
             from cifar.dds_resnet import DDS_ResNet18
         elif dataset == 'tiny':
             from tiny.dds_resnet import DDS_ResNet18
-        net = DDS_ResNet18(num_experts=int( network[3] ), mode='out')
+        net = DDS_ResNet18(num_experts=int( network[3] ), mode='out', shared_routing=shared_routing, checkpoint_segments=checkpoint_segments)
     
     # AlexNet and Related Work
 
@@ -208,7 +245,7 @@ def get_network(network, dataset, device):
         elif dataset == 'tiny':
             from tiny.mobilenetv2 import MobileNetV2
 
-        net = MobileNetV2()
+        net = MobileNetV2(checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('cc') and network.endswith('mobilenetv2'):
         if dataset == 'cifar100':
@@ -217,49 +254,49 @@ def get_network(network, dataset, device):
             from tiny.cc_mobilenetv2 import CC_MobileNetV2
         else:
             from imagenet.cc_mobilenetv2 import CC_MobileNetV2
-        net = CC_MobileNetV2(num_experts=int( network[2] ))
+        net = CC_MobileNetV2(num_experts=int( network[2] ), checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('dyresA') and network.endswith('mobilenetv2'):
         if dataset == 'cifar100':
             from cifar.dyresA_mobilenetv2 import DyResA_MobileNetV2
         elif dataset == 'tiny':
             from tiny.dyresA_mobilenetv2 import DyResA_MobileNetV2
-        net = DyResA_MobileNetV2(num_experts=int( network[6] ))
+        net = DyResA_MobileNetV2(num_experts=int( network[6] ), checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('dyresB') and network.endswith('mobilenetv2'):
         if dataset == 'cifar100':
             from cifar.dyresB_mobilenetv2 import DyResB_MobileNetV2
         elif dataset == 'tiny':
             from tiny.dyresB_mobilenetv2 import DyResB_MobileNetV2
-        net = DyResB_MobileNetV2(num_experts=int( network[6] ))
+        net = DyResB_MobileNetV2(num_experts=int( network[6] ), checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('dyresS') and network.endswith('mobilenetv2'):
         if dataset == 'cifar100':
             from cifar.dyresS_mobilenetv2 import DyResS_MobileNetV2
         elif dataset == 'tiny':
             from tiny.dyresS_mobilenetv2 import DyResS_MobileNetV2
-        net = DyResS_MobileNetV2(num_experts=int( network[6] ))
+        net = DyResS_MobileNetV2(num_experts=int( network[6] ), checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('dy') and network.endswith('mobilenetv2'):
         if dataset == 'cifar100':
             from cifar.dy_mobilenetv2 import Dy_MobileNetV2
         elif dataset == 'tiny':
             from tiny.dy_mobilenetv2 import Dy_MobileNetV2
-        net = Dy_MobileNetV2(num_experts=int( network[2] ))
+        net = Dy_MobileNetV2(num_experts=int( network[2] ), checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('ddsin') and network.endswith('mobilenetv2'):
         if dataset == 'cifar100':
             from cifar.dds_mobilenetv2 import DDS_MobileNetV2
         elif dataset == 'tiny':
             from tiny.dds_mobilenetv2 import DDS_MobileNetV2
-        net = DDS_MobileNetV2(num_experts=int( network[5] ), mode='in')
+        net = DDS_MobileNetV2(num_experts=int( network[5] ), mode='in', checkpoint_segments=checkpoint_segments)
 
     elif network.startswith('dds') and network.endswith('mobilenetv2'):
         if dataset == 'cifar100':
             from cifar.dds_mobilenetv2 import DDS_MobileNetV2
         elif dataset == 'tiny':
             from tiny.dds_mobilenetv2 import DDS_MobileNetV2
-        net = DDS_MobileNetV2(num_experts=int( network[3] ), mode='out')
+        net = DDS_MobileNetV2(num_experts=int( network[3] ), mode='out', checkpoint_segments=checkpoint_segments)
         
     else:
         print('the network is not supported')
@@ -269,7 +306,7 @@ def get_network(network, dataset, device):
 
     return net
 
-def get_dataloader(dataset, batch_size):
+def get_dataloader(dataset, batch_size, distributed=False):
     if dataset == 'cifar100':
         train_transform = transforms.Compose(
             [transforms.RandomCrop(size=32, padding=4),
@@ -324,7 +361,9 @@ def get_dataloader(dataset, batch_size):
         print('Dataset not supported yet...')
         sys.exit()
 
-    trainloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, shuffle=True, num_workers=4, pin_memory=True)
+    # with distributed, each process of the group loads its own shard of the training set (call set_epoch every epoch)
+    train_sampler = torch.utils.data.distributed.DistributedSampler(trainset, shuffle=True) if distributed else None
+    trainloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, shuffle=train_sampler is None, sampler=train_sampler, num_workers=4, pin_memory=True)
     testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size, shuffle=False, num_workers=4, pin_memory=True)
 
     return trainloader, testloader
@@ -351,4 +390,87 @@ def save_plot(train_losses, train_accuracy, val_losses, val_accuracy, args, time
     ax2.set_xlabel('batches')
     ax2.set_ylabel('acc')
 
-    plt.savefig('plots/{}-losses-{}-b{}-e{}-{}.png'.format(args.network, args.dataset, args.batch, args.epoch, time_stamp))
\ No newline at end of file
+    plt.savefig('plots/{}-losses-{}-b{}-e{}-{}.png'.format(args.network, args.dataset, args.batch, args.epoch, time_stamp))
+
+def cpu_snapshot(state):
+    '''Copy of a (nested) state dict with every tensor copied to CPU, training can go on modifying the original.'''
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, cpu_snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_snapshot(value) for value in state)
+    return state
+
+def periodic_checkpoints(prefix):
+    '''Paths of the periodic checkpoints <prefix>-step<N>.tar on disk, by increasing step.'''
+    pattern = re.compile(re.escape(prefix) + r'-step(\d+)\.tar')
+    paths = [path for path in glob.glob(glob.escape(prefix) + '-step*.tar') if pattern.fullmatch(path)]
+    return sorted(paths, key=lambda path: int(pattern.fullmatch(path).group(1)))
+
+class CheckpointWriter:
+    '''
+        Saves training states without blocking the training loop: save() snapshots the state to CPU memory and a
+        worker thread writes it to a temporary file that is then renamed, so a crash never leaves a truncated
+        checkpoint. Periodic checkpoints are due every_steps steps or every_minutes minutes apart and only the last
+        keep_last of them are kept on disk, the other ones (the best checkpoint) are never removed.
+        At most one snapshot waits while another is written, save() blocks beyond that
+        periodic: the periodic checkpoints already on disk, oldest first (see periodic_checkpoints), so that they
+        count towards keep_last after a restart
+    '''
+    def __init__(self, every_steps=None, every_minutes=None, keep_last=3, periodic=None):
+        self.every_steps = every_steps
+        self.every_minutes = every_minutes
+        self.keep_last = keep_last
+        self.last_save = time.time()
+        self.periodic = list(periodic or []) # paths of the periodic checkpoints on disk, oldest first
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def due(self, step):
+        # a periodic checkpoint is due at this step
+        if self.every_steps and step % self.every_steps == 0:
+            return True
+        return bool(self.every_minutes) and time.time() - self.last_save >= self.every_minutes * 60
+
+    def save(self, state, path, periodic=False):
+        self._raise_error()
+        if periodic:
+            self.last_save = time.time()
+        self.queue.put((cpu_snapshot(state), path, periodic))
+
+    def close(self):
+        # waits for the pending checkpoints
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError('writing a checkpoint failed') from self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            state, path, periodic = item
+            try:
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    torch.save(state, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+                if periodic:
+                    if path in self.periodic:
+                        self.periodic.remove(path)
+                    self.periodic.append(path)
+                    while len(self.periodic) > self.keep_last:
+                        old_path = self.periodic.pop(0)
+                        if os.path.exists(old_path):
+                            os.remove(old_path)
+            except Exception as e:
+                self.error = e
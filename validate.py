@@ -1,7 +1,7 @@
 import torch
 
 import argparse
-from utils import get_dataloader, get_network, accuracy
+from utils import get_dataloader, get_network, accuracy, autocast, to_channels_last
 
 parser = argparse.ArgumentParser(description='Validating CNN models')
 
@@ -9,6 +9,9 @@ parser.add_argument('--network', '-n', required=True)
 parser.add_argument('--checkpoint', '-c', type=str)
 parser.add_argument('--dataset', type=str, help='cifar10 or cifar100 or svhn or tinyimagenet', default='cifar10')
 parser.add_argument('--cuda', action='store_true')
+parser.add_argument('--channels-last', action='store_true', help='run the network in NHWC memory format')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='bf16 runs under autocast')
+parser.add_argument('--shared-routing', action='store_true', help='one routing function per residual block')
 
 args = parser.parse_args()
 print(args)
@@ -16,10 +19,10 @@ print(args)
 device = torch.device('cuda' if (torch.cuda.is_available() and args.cuda) else 'cpu')
 
 if args.dataset == 'cifar100':
-    net = get_network(args.network, args.dataset, device)
+    net = get_network(args.network, args.dataset, device, shared_routing=args.shared_routing)
     _, testloader = get_dataloader(args.dataset, 10000)
 elif args.dataset == 'imagenet':
-    net = get_network(args.network, args.dataset, device)
+    net = get_network(args.network, args.dataset, device, shared_routing=args.shared_routing)
     _, testloader = get_dataloader(args.dataset, 150000)
 
 inputs, labels = next(iter(testloader))
@@ -27,5 +30,11 @@ inputs, labels = next(iter(testloader))
 state = torch.load(args.checkpoint)
 net.load_state_dict(state['net'])
 net.eval()
-result = accuracy(net(inputs.to(device)), labels.to(device), (1, 5))
+inputs = inputs.to(device)
+if args.channels_last:
+    net = to_channels_last(net)
+    inputs = inputs.contiguous(memory_format=torch.channels_last)
+with torch.no_grad(), autocast(device, args.precision):
+    outputs = net(inputs)
+result = accuracy(outputs.float(), labels.to(device), (1, 5))
 print('Top1: {}%\tTop5: {}%'.format(round(float(result[0][0].data), 2), round(float(result[1][0].data), 2)))
\ No newline at end of file